@@ -0,0 +1,167 @@
+"""
+Live alignment tracking for the Auto-Settings on/off mode. The template is
+matched against the full frame once; after that each live frame only has its
+small shift measured, by phase correlation of a downsampled window against
+the same window of a key frame. Shifts are taken from the key frame rather
+than chained frame to frame so errors don't accumulate; the key frame moves
+along once the sample has drifted half the margin. A full re-match happens
+only when the correlation peak gets weak or the shift runs out of the window.
+
+    tracker = AlignmentTracker(template, circleDict.spotInfo)
+    offset, confidence, rematched = tracker.update(frame)
+    preview = drawOverlay(preview, circleDict.spotInfo, offset, frame.shape)
+"""
+
+import cv2
+import numpy as np
+
+from matching import TemplateMatcher
+from frameTools import displayView
+from stageTiming import span, count
+
+alignmentTracking = {"downsample": 4,      # window binning for phase correlation
+                     "margin": 32,         # full resolution pixels around the pattern
+                     "minResponse": 0.1}   # phaseCorrelate peak below which we re-match
+
+
+class AlignmentTracker():
+    """ Follows the template match from frame to frame
+
+    Args:
+        template (np array): 8 bit standard image (circle dictionary template)
+
+        spotInfo (list or np array): [x, y, r] per spot, kept for overlays
+
+        useFFT (bool): TemplateMatcher mode for the full matches
+
+        downsample, margin, minResponse: see alignmentTracking
+    """
+    def __init__(self, template, spotInfo=None, useFFT=True, downsample=None,
+                 margin=None, minResponse=None):
+        self.template = template
+        self.spotInfo = spotInfo
+        self.useFFT = useFFT
+        self.downsample = alignmentTracking["downsample"] if downsample is None else downsample
+        self.margin = alignmentTracking["margin"] if margin is None else margin
+        self.minResponse = alignmentTracking["minResponse"] if minResponse is None else minResponse
+        self.matchers = {}
+        self.offset = None
+        self.position = None
+        self.keyPosition = None
+        self.confidence = 0.0
+        self.box = None
+        self.reference = None
+        self.hann = None
+        self.tracked = 0
+        self.rematches = 0
+
+    def reset(self):
+        """ next update does a full match """
+        self.offset = None
+        self.reference = None
+
+    def _fullMatch(self, view8b):
+        matcher = self.matchers.get(view8b.shape)
+        if matcher is None:
+            matcher = TemplateMatcher(self.template, view8b.shape, useFFT=self.useFFT)
+            self.matchers[view8b.shape] = matcher
+        self.rematches = self.rematches + 1
+        count("align/rematch")
+        return tuple(int(each) for each in matcher.match(view8b))
+
+    def _windowBox(self, imageShape, offset):
+        """ (rowStart, rowEnd, colStart, colEnd) of the pattern plus margin,
+            moved inside the image and sized to a multiple of downsample
+        """
+        boxRows = min(self.template.shape[0] + 2 * self.margin, imageShape[0])
+        boxCols = min(self.template.shape[1] + 2 * self.margin, imageShape[1])
+        boxRows = boxRows - boxRows % self.downsample
+        boxCols = boxCols - boxCols % self.downsample
+        rowStart = int(np.clip(offset[1] - self.margin, 0, imageShape[0] - boxRows))
+        colStart = int(np.clip(offset[0] - self.margin, 0, imageShape[1] - boxCols))
+        return (rowStart, rowStart + boxRows, colStart, colStart + boxCols)
+
+    def _window(self, view8b, box):
+        rowStart, rowEnd, colStart, colEnd = box
+        window = view8b[rowStart:rowEnd, colStart:colEnd]
+        size = ((colEnd - colStart) // self.downsample, (rowEnd - rowStart) // self.downsample)
+        small = cv2.resize(window, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self.hann is None or self.hann.shape != small.shape:
+            self.hann = cv2.createHanningWindow(size, cv2.CV_32F)
+        return small
+
+    def _anchor(self, view8b, offset, position=None):
+        """ makes this frame the key frame, at offset """
+        self.offset = offset
+        self.position = offset if position is None else position
+        self.keyPosition = self.position
+        self.box = self._windowBox(view8b.shape, offset)
+        self.reference = self._window(view8b, self.box)
+
+    def update(self, frame):
+        """ alignment of one live frame
+
+        Args:
+            frame (np array): camera frame at any bit depth
+
+        Returns:
+            offset (tuple): topLeftMatch (col, row) of the template
+
+            confidence (float): phase correlation peak of the tracked shift,
+                1.0 right after a full match
+
+            rematched (bool): a full match was run for this frame
+        """
+        view8b = displayView(frame)
+        if self.offset is None or self.reference is None:
+            with span("align/match"):
+                self._anchor(view8b, self._fullMatch(view8b))
+            self.confidence = 1.0
+            return self.offset, self.confidence, True
+        with span("align/track"):
+            current = self._window(view8b, self.box)
+            (shiftCol, shiftRow), response = cv2.phaseCorrelate(self.reference, current,
+                                                                self.hann)
+            shiftCol = shiftCol * self.downsample
+            shiftRow = shiftRow * self.downsample
+        if response < self.minResponse or max(abs(shiftCol), abs(shiftRow)) > self.margin:
+            with span("align/match"):
+                self._anchor(view8b, self._fullMatch(view8b))
+            self.confidence = 1.0
+            return self.offset, self.confidence, True
+        # sub-pixel position, so rounding doesn't accumulate either
+        self.position = (self.keyPosition[0] + shiftCol, self.keyPosition[1] + shiftRow)
+        self.offset = (int(round(self.position[0])), int(round(self.position[1])))
+        if max(abs(shiftCol), abs(shiftRow)) > self.margin / 2.0:
+            self._anchor(view8b, self.offset, self.position)
+        self.tracked = self.tracked + 1
+        self.confidence = float(response)
+        count("align/tracked")
+        return self.offset, self.confidence, False
+
+
+def drawOverlay(preview, spotInfo, offset, frameShape, color=(255, 60, 60)):
+    """ draws every spot at the tracked offset on a display sized preview
+
+    Args:
+        preview (np array): 8 bit gray or RGB preview (the resized frame)
+
+        spotInfo (list or np array): [x, y, r] per spot
+
+        offset (tuple): topLeftMatch (col, row) in frame coordinates
+
+        frameShape (tuple): (rows, cols) of the frame the preview was made from
+
+    Returns:
+        overlay (np array): RGB copy of the preview with the spots drawn
+    """
+    overlay = preview.copy() if preview.ndim == 3 else cv2.cvtColor(preview, cv2.COLOR_GRAY2RGB)
+    scaleX = preview.shape[1] / float(frameShape[1])
+    scaleY = preview.shape[0] / float(frameShape[0])
+    spots = np.asarray(spotInfo, dtype=np.float64).reshape(-1, 3)
+    centersX = np.rint((spots[:, 0] + offset[0]) * scaleX).astype(int)
+    centersY = np.rint((spots[:, 1] + offset[1]) * scaleY).astype(int)
+    radii = np.maximum(np.rint(spots[:, 2] * scaleX).astype(int), 1)
+    for centerX, centerY, radius in zip(centersX, centersY, radii):
+        cv2.circle(overlay, (int(centerX), int(centerY)), int(radius), color, 1)
+    return overlay
@@ -0,0 +1,177 @@
+"""
+Histogram driven auto exposure / auto gain. Live frames are subsampled on a
+stride, histogrammed with one bincount, and the exposure x gain product is
+scaled so a chosen bright percentile lands on a target fraction of full
+scale. Exposure is used first (least noise); gain only makes up what the
+exposure limit can't. Once settled the values are handed to the single
+capture profile, keeping that profile's own gain preference:
+1) frameStats: percentile level, saturated fraction and mean of a frame
+2) ExposureController: one step per live frame, settles in a few frames
+3) ExposureController.handOff: the settled brightness as a profile config
+
+    controller = ExposureController(dict(videoConfig),
+                                    lambda config: cameraSetVals(camera, config, ("gain", "expo")))
+    while not controller.settled:
+        controller.step(frame)
+    singleProfile = controller.handOff(singleConfig)
+"""
+
+import math
+
+import numpy as np
+
+from frameTools import pixelBits
+from stageTiming import count
+
+autoExposureConfig = {"stride": 8,             # every 8th row and column
+                      "percentile": 99.5,      # bright level that is controlled
+                      "target": 0.8,           # of full scale, for that level
+                      "tolerance": 0.06,       # settled within target +/- this
+                      "saturated": 0.002,      # fraction at full scale seen as clipped
+                      "maxStep": 8.0,          # largest change of the product per step
+                      "settleFrames": 1,       # frames skipped after each change
+                      "maxSteps": 12,
+                      "expoRange": (50.0, 2e6),    # ExposureTime limits, us
+                      "gainRange": (0.0, 36.0)}    # Gain limits, dB
+
+
+def frameStats(frame, bits=None, stride=None, percentile=None):
+    """ histogram statistics of a strided subsample of frame
+
+    Args:
+        frame (np array): 2d uint8 / uint16 frame
+
+        bits (int): bits used in the container, 12 for uint16 by default
+
+        stride (int): subsample step in rows and columns
+
+        percentile (float): level to report, 0-100
+
+    Returns:
+        stats (dict): level (percentile value / full scale), saturated
+            (fraction at full scale), mean (/ full scale), samples
+    """
+    stride = autoExposureConfig["stride"] if stride is None else stride
+    percentile = autoExposureConfig["percentile"] if percentile is None else percentile
+    if bits is None:
+        bits = 8 if frame.dtype == np.uint8 else pixelBits["Mono12"]
+    fullScale = (1 << bits) - 1
+    samples = np.minimum(frame[::stride, ::stride].ravel(), fullScale)
+    histogram = np.bincount(samples, minlength=fullScale + 1)
+    cumulative = np.cumsum(histogram)
+    level = int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100.0))
+    return {"level": level / float(fullScale),
+            "saturated": histogram[fullScale] / float(cumulative[-1]),
+            "mean": float(np.dot(histogram, np.arange(fullScale + 1))) / cumulative[-1] / fullScale,
+            "samples": int(cumulative[-1])}
+
+
+def gainFactor(gainDb):
+    return 10**(gainDb / 20.0)
+
+
+def splitExposure(product, preferredGain, expoLimit=None):
+    """ exposure (us) and gain (dB) for an exposure x linear gain product,
+        keeping preferredGain (dB) where the exposure range allows it
+    """
+    expoMin, expoMax = autoExposureConfig["expoRange"]
+    gainMin, gainMax = autoExposureConfig["gainRange"]
+    if expoLimit is not None:
+        expoMax = min(expoMax, expoLimit)
+    gain = preferredGain
+    expo = product / gainFactor(gain)
+    if expo > expoMax:
+        gain = 20 * math.log10(product / expoMax)
+    elif expo < expoMin:
+        gain = 20 * math.log10(max(product / expoMin, 1e-12))
+    gain = float(np.clip(gain, gainMin, gainMax))
+    expo = float(np.clip(product / gainFactor(gain), expoMin, expoMax))
+    return expo, gain
+
+
+class ExposureController():
+    """ Steps ExposureTime / Gain toward the target from live frames
+
+    Args:
+        config (dict): profile being controlled (videoConfig format), its
+            'expo' and 'gain' are updated in place
+
+        apply (callable): apply(config) writes the new values to the camera,
+            e.g. cameraSetVals(camera, config, ("gain", "expo")) or a
+            CameraSession profile switch
+
+        expoLimit (float): longest exposure allowed while live (us), e.g.
+            the frame period. None uses autoExposureConfig["expoRange"]
+
+        bits (int): bits per pixel of the frames, see frameStats
+    """
+    def __init__(self, config, apply, expoLimit=None, bits=None, **settings):
+        self.config = config
+        self.apply = apply
+        self.expoLimit = expoLimit
+        self.bits = bits
+        # the profile's gain is where gain goes back to when exposure allows
+        self.preferredGain = config["gain"]
+        self.settings = dict(autoExposureConfig, **settings)
+        self.settled = False
+        self.steps = 0
+        self.skip = 0
+        self.history = []
+
+    def step(self, frame):
+        """ one control step
+
+        Returns:
+            settled (bool): the last frame was within tolerance (or the step
+                budget is used up, or the limits are reached)
+        """
+        if self.settled:
+            return True
+        if self.skip > 0:
+            # frames already exposed with the old values
+            self.skip = self.skip - 1
+            return False
+        settings = self.settings
+        stats = frameStats(frame, self.bits, settings["stride"], settings["percentile"])
+        self.history.append((self.config["expo"], self.config["gain"], stats["level"]))
+        error = stats["level"] - settings["target"]
+        if stats["saturated"] <= settings["saturated"] and abs(error) <= settings["tolerance"]:
+            self.settled = True
+            return True
+        if self.steps >= settings["maxSteps"]:
+            print("auto exposure: no convergence in " + str(self.steps) + " steps")
+            self.settled = True
+            return True
+        if stats["saturated"] > settings["saturated"]:
+            # clipped, the real level is unknown: come down hard
+            factor = 1.0 / min(4.0, settings["maxStep"])
+        else:
+            factor = settings["target"] / max(stats["level"], 1.0 / 255)
+        factor = float(np.clip(factor, 1.0 / settings["maxStep"], settings["maxStep"]))
+        product = self.config["expo"] * gainFactor(self.config["gain"])
+        expo, gain = splitExposure(product * factor, self.preferredGain, self.expoLimit)
+        if abs(expo - self.config["expo"]) < 1e-6 and abs(gain - self.config["gain"]) < 1e-6:
+            # pinned at a limit, nothing more to do
+            print("auto exposure: at the exposure / gain limit")
+            self.settled = True
+            return True
+        self.config["expo"] = expo
+        self.config["gain"] = gain
+        self.apply(self.config)
+        self.steps = self.steps + 1
+        self.skip = settings["settleFrames"]
+        count("autoExposure/steps")
+        return False
+
+    def handOff(self, profile):
+        """ profile (e.g. singleConfig) with expo / gain giving the settled
+            brightness: same exposure x gain product, split keeping the
+            profile's own gain where its exposure range allows
+
+        Returns:
+            config (dict): a copy of profile with the new 'expo' and 'gain'
+        """
+        product = self.config["expo"] * gainFactor(self.config["gain"])
+        config = dict(profile)
+        config["expo"], config["gain"] = splitExposure(product, profile["gain"])
+        return config
@@ -0,0 +1,253 @@
+"""
+Headless batch analysis. Runs template matching and per-spot quantification
+over a directory (or glob) of tiffs on every core, no windows or dialogs.
+Results are written as each file finishes:
+    .csv  -> one row per (file, spot)
+    .json -> json lines, one object per file
+    .db   -> appended to a results store (resultsStore), in chunked transactions
+
+usage:
+    python batchAnalysis.py captures/ --dict standard_image.json --out results.csv
+    python batchAnalysis.py captures/ --dict standard_image.cdict --out results.csv
+    python batchAnalysis.py "archive/2019-08-*/*.tiff" --dict standard_image.json --out results.json
+    python batchAnalysis.py captures/ --dict standard_image.cdict --out results.db
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from matching import TemplateMatcher
+from spotAnalysis import quantifySpots, refineSpotCenters, spotTableDtype
+from circleDictionary import loadCircleDictionary
+from resultsStore import ResultsStore
+
+# per worker process state, filled in by initWorker
+_workerState = {}
+# results per results store transaction
+storeChunk = 64
+
+
+def findImages(inputs):
+    """ expands directories and glob patterns into a sorted list of tiff paths """
+    paths = []
+    for each in inputs:
+        if os.path.isdir(each):
+            for ext in ("*.tiff", "*.tif"):
+                paths.extend(glob.glob(os.path.join(each, ext)))
+        else:
+            paths.extend(glob.glob(each))
+    return sorted(set(paths))
+
+
+def loadCircleDict(dictPath, templatePath=None):
+    """ reads a circle dictionary and its template image
+
+        dictPath is a .cdict (memory mapped, masks included) or a json; a
+        json's template defaults to the tiff with the same name, the pair
+        that patternGen saves, and a .cdict next to it is used if present
+    """
+    circleDict = loadCircleDictionary(dictPath, templatePath)
+    return circleDict, circleDict.template
+
+
+def initWorker(dictPath, templatePath, useFFT, refine=False):
+    # one process per core already, keep opencv from oversubscribing
+    cv2.setNumThreads(1)
+    circleDict, template = loadCircleDict(dictPath, templatePath)
+    _workerState["circleDict"] = circleDict
+    _workerState["template"] = template
+    _workerState["useFFT"] = useFFT
+    _workerState["refine"] = refine
+    _workerState["matchers"] = {}
+
+
+def analyzeFile(filePath):
+    """ matches and quantifies one tiff inside a worker process
+
+    Returns:
+        result (dict): file, match (col, row) and spotTable, or file and error
+    """
+    image = cv2.imread(filePath, -1)
+    if image is None:
+        return {"file": filePath, "error": "could not read image"}
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # one bad file mustn't take the unattended run (and its results) down
+    try:
+        result = analyzeImage(image)
+    except Exception as err:
+        return {"file": filePath, "error": repr(err)}
+    result["file"] = filePath
+    result["captured"] = os.path.getmtime(filePath)
+    return result
+
+
+def analyzeImage(image):
+    """ matches and quantifies one 2d image with the worker's circle
+        dictionary (see initWorker)
+
+    Returns:
+        result (dict): match (col, row) and spotTable
+    """
+    circleDict = _workerState["circleDict"]
+    matchers = _workerState["matchers"]
+    # one matcher per image shape, reused for every file of that shape
+    matcher = matchers.get(image.shape)
+    if matcher is None:
+        matcher = TemplateMatcher(_workerState["template"], image.shape,
+                                  useFFT=_workerState["useFFT"])
+        matchers[image.shape] = matcher
+    topLeftMatch = matcher.match(image)
+    spotShifts = None
+    if _workerState["refine"]:
+        centers = refineSpotCenters(image, topLeftMatch, circleDict.spotInfo)
+        spotShifts = np.column_stack((centers["dx"], centers["dy"]))
+    spotTable = quantifySpots(image, topLeftMatch,
+                              circleDict.spotInfo, circleDict.shape, spotShifts)
+    return {"match": topLeftMatch, "spotTable": spotTable}
+
+
+class ResultWriter():
+    """ streams results to csv (one row per spot), json lines (one per
+        file) or a results store (.db, inserted storeChunk results at a time)
+
+        tagFields are extra result keys written after the file, e.g.
+        ("device", "frame") for multiCamera
+    """
+    def __init__(self, outPath, batch, tagFields=()):
+        self.batch = batch
+        self.tagFields = list(tagFields)
+        self.asCSV = outPath.lower().endswith(".csv")
+        self.store = None
+        if outPath.lower().endswith(".db"):
+            self.store = ResultsStore(outPath)
+            self.pending = []
+            return
+        self.outFile = open(outPath, "w", newline="")
+        self.spotFields = [name for name in spotTableDtype.names if name != "image"]
+        if self.asCSV:
+            self.csvWriter = csv.writer(self.outFile)
+            self.csvWriter.writerow(["file"] + self.tagFields
+                                    + ["batch", "matchCol", "matchRow", "error"]
+                                    + self.spotFields)
+
+    def write(self, result):
+        if self.store is not None:
+            self.pending.append(result)
+            if len(self.pending) >= storeChunk:
+                self.store.addResults(self.pending, self.batch)
+                self.pending = []
+            return
+        tags = [result.get(name, "") for name in self.tagFields]
+        if self.asCSV:
+            if "error" in result:
+                self.csvWriter.writerow([result["file"]] + tags
+                                        + [self.batch, "", "", result["error"]])
+            else:
+                match = list(result["match"])
+                for row in result["spotTable"]:
+                    self.csvWriter.writerow([result["file"]] + tags + [self.batch] + match + [""]
+                                            + [row[name].item() for name in self.spotFields])
+        else:
+            record = {"file": result["file"]}
+            record.update(zip(self.tagFields, tags))
+            record["batch"] = self.batch
+            if "error" in result:
+                record["error"] = result["error"]
+            else:
+                record["match"] = list(result["match"])
+                record["spots"] = {name: result["spotTable"][name].tolist()
+                                   for name in self.spotFields}
+            self.outFile.write(json.dumps(record) + "\n")
+        self.outFile.flush()
+
+    def close(self):
+        if self.store is not None:
+            self.store.addResults(self.pending, self.batch)
+            self.pending = []
+            self.store.close()
+            return
+        self.outFile.close()
+
+
+def runBatch(inputs, dictPath, outPath, templatePath=None, workers=None,
+             useFFT=True, refine=False):
+    """ analyzes every tiff in inputs across a process pool
+
+    Args:
+        inputs (list): directories and/or glob patterns
+
+        dictPath (str): circle dictionary, .cdict or json (batch, spot_info, shape)
+
+        outPath (str): .csv, .json or .db output, written as files finish
+
+        templatePath (str): template tiff, defaults to the json's sibling
+
+        workers (int): processes, defaults to all cores
+
+        useFFT (bool): use the cached pattern spectrum in TemplateMatcher
+
+        refine (bool): move each spot to its refined center
+            (spotAnalysis.refineSpotCenters) before quantifying
+
+    Returns:
+        numDone, numFailed (int): files analyzed and files that failed
+    """
+    filePaths = findImages(inputs)
+    circleDict, _ = loadCircleDict(dictPath, templatePath)
+    writer = ResultWriter(outPath, circleDict.batch)
+    numDone = 0
+    numFailed = 0
+    print("analyzing " + str(len(filePaths)) + " images")
+    try:
+        with Pool(processes=workers,
+                  initializer=initWorker,
+                  initargs=(dictPath, templatePath, useFFT, refine)) as pool:
+            for result in pool.imap_unordered(analyzeFile, filePaths, chunksize=4):
+                writer.write(result)
+                if "error" in result:
+                    numFailed = numFailed + 1
+                    print("failed: " + result["file"] + " " + result["error"])
+                else:
+                    numDone = numDone + 1
+                if (numDone + numFailed) % 100 == 0:
+                    print(str(numDone + numFailed) + "/" + str(len(filePaths)))
+    finally:
+        writer.close()
+    print("done: " + str(numDone) + " analyzed, " + str(numFailed) + " failed")
+    return numDone, numFailed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="D4Scope headless batch analysis")
+    parser.add_argument("inputs", nargs="+", help="directories or glob patterns of tiffs")
+    parser.add_argument("--dict", required=True, dest="dictPath",
+                        help="circle dictionary .cdict or json, e.g. standard_image.json")
+    parser.add_argument("--template", default=None,
+                        help="template tiff, default: json name with .tiff")
+    parser.add_argument("--out", required=True, help="results .csv, .json or .db")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes, default: all cores")
+    parser.add_argument("--no-fft", action="store_true",
+                        help="use cv2.matchTemplate instead of the cached pattern spectrum")
+    parser.add_argument("--refine", action="store_true",
+                        help="refine every spot center around the match before quantifying")
+    args = parser.parse_args(argv)
+    _, numFailed = runBatch(args.inputs, args.dictPath, args.out,
+                            templatePath=args.template,
+                            workers=args.workers,
+                            useFFT=not args.no_fft,
+                            refine=args.refine)
+    return 1 if numFailed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Benchmarks for the imaging hot paths, run on the bundled test images and on
+synthetic spot lattices at several sizes:
+1) template matching: templateMatch8b (exhaustive, pyramid), TemplateMatcher
+2) spot masks: circlePixelID, spotMask (cold and cached)
+3) Hough detection as run in patternGen
+4) frame conversion: Mono8 and Mono12p grab results to arrays
+5) spot quantification: quantifySpots on single frames and stacks, and
+   refineSpotCenters
+
+Each case is warmed up, then repeated; the median is what gets compared.
+
+usage:
+    python benchmarks.py --out bench.json
+    python benchmarks.py --out bench.json --baseline bench_baseline.json --tolerance 0.25
+    python benchmarks.py --quick --only match
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import spotAnalysis
+from cmdDevTools import circlePixelID, houghParams
+from matching import templateMatch8b, TemplateMatcher
+from cameraBackend import SimulatedConverter, SimulatedGrabResult, packMono12p
+from frameTools import FrameUnpacker, grabToArray
+from spotAnalysis import quantifySpots, refineSpotCenters, spotMask
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def latticeSpots(numSpots, spacing=86, radius=28, margin=46):
+    """ square-ish lattice of spots like standard_image.json, as spot_info and shape """
+    cols = int(np.ceil(np.sqrt(numSpots)))
+    rows = int(np.ceil(numSpots / cols))
+    index = np.arange(numSpots)
+    spotInfo = np.column_stack((margin + (index % cols) * spacing,
+                                margin + (index // cols) * spacing,
+                                np.full(numSpots, radius)))
+    shape = (2 * margin + (rows - 1) * spacing, 2 * margin + (cols - 1) * spacing)
+    return spotInfo.tolist(), shape
+
+
+def latticeImage(spotInfo, shape, padding=200, seed=0):
+    """ 12 bit synthetic capture of a lattice: bright spots on a dim background """
+    rng = np.random.default_rng(seed)
+    image = rng.normal(400, 20, (shape[0] + 2 * padding, shape[1] + 2 * padding))
+    labelImg, _, _ = spotMask(spotInfo, shape)
+    image[padding:padding + shape[0], padding:padding + shape[1]][labelImg > 0] += 1500
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def timeit(func, repeat, warmup):
+    for each in range(warmup):
+        func()
+    times = []
+    for each in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {"median": float(np.median(times)),
+            "min": float(times.min()),
+            "mean": float(times.mean()),
+            "repeat": repeat}
+
+
+def quiet(func):
+    """ the core functions print progress, keep it out of the timings' output """
+    def wrapped():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return wrapped
+
+
+def matchCases(quick):
+    image = cv2.imread(os.path.join(repoDir, "test.tiff"), 0)
+    pattern = cv2.imread(os.path.join(repoDir, "standard_image.tiff"), 0)
+    scales = [1] if quick else [0.5, 1, 2]
+    for scale in scales:
+        img = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        pat = cv2.resize(pattern, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        size = str(img.shape[1]) + "x" + str(img.shape[0])
+        yield "match/templateMatch8b/" + size, quiet(lambda: templateMatch8b(img, pat))
+        yield ("match/templateMatch8b-pyramid2/" + size,
+               quiet(lambda: templateMatch8b(img, pat, pyramidLevels=2)))
+        matcher = TemplateMatcher(pat, img.shape)
+        yield "match/TemplateMatcher/" + size, lambda: matcher.match(img)
+        fftMatcher = TemplateMatcher(pat, img.shape, useFFT=True)
+        yield "match/TemplateMatcher-fft/" + size, lambda: fftMatcher.match(img)
+
+
+def maskCases(quick):
+    counts = [24] if quick else [24, 96, 384]
+    for numSpots in counts:
+        spotInfo, shape = latticeSpots(numSpots)
+        yield "mask/circlePixelID/" + str(numSpots), lambda: circlePixelID(spotInfo)
+
+        def cold():
+            spotAnalysis._spotMaskCache.clear()
+            spotMask(spotInfo, shape)
+        yield "mask/spotMask-cold/" + str(numSpots), cold
+        yield "mask/spotMask-cached/" + str(numSpots), lambda: spotMask(spotInfo, shape)
+
+
+def houghCases(quick):
+    counts = [24] if quick else [24, 96]
+    for numSpots in counts:
+        spotInfo, shape = latticeSpots(numSpots)
+        subImg = (latticeImage(spotInfo, shape, padding=0) >> 4).astype(np.uint8)
+
+        def hough():
+            smoothImg = cv2.medianBlur(subImg, 3)
+            cv2.HoughCircles(smoothImg, cv2.HOUGH_GRADIENT, 1,
+                             minDist=houghParams["minDist"],
+                             param1=houghParams["param1"],
+                             param2=houghParams["param2"],
+                             minRadius=houghParams["minRadius"],
+                             maxRadius=houghParams["maxRadius"])
+        yield "hough/patternGen/" + str(numSpots), hough
+
+
+def convertCases(quick):
+    shapes = [(1032, 1544)] if quick else [(1032, 1544), (2064, 3088)]
+    rng = np.random.default_rng(0)
+    converter = SimulatedConverter()
+    for shape in shapes:
+        size = str(shape[1]) + "x" + str(shape[0])
+        frame12 = rng.integers(0, 4096, shape).astype(np.uint16)
+        mono8 = SimulatedGrabResult((frame12 >> 4).astype(np.uint8), "Mono8", 0, 0)
+        mono12p = SimulatedGrabResult(frame12, "Mono12p", 0, 0)
+        packed = packMono12p(frame12).tobytes()
+        mono12p.GetBuffer = lambda: packed
+        unpacker = FrameUnpacker()
+        out8 = np.empty(shape, dtype=np.uint8)
+        yield "convert/Mono8-to-Mono8/" + size, lambda: converter.Convert(mono8).GetArray()
+        yield "convert/Mono8-into-buffer/" + size, lambda: grabToArray(mono8, out=out8)
+        yield "convert/Mono12p-unpack/" + size, lambda: grabToArray(mono12p, unpacker)
+        yield ("convert/Mono12p-to-Mono8/" + size,
+               lambda: converter.Convert(SimulatedGrabResult(grabToArray(mono12p, unpacker),
+                                                             "Mono12", 0, 0)).GetArray())
+
+
+def quantifyCases(quick):
+    settings = [(24, 1)] if quick else [(24, 1), (24, 16), (96, 1), (384, 1)]
+    for numSpots, stackSize in settings:
+        spotInfo, shape = latticeSpots(numSpots)
+        image = latticeImage(spotInfo, shape)
+        stack = [image] * stackSize
+        offset = (200, 200)
+        spotMask(spotInfo, shape)
+        yield ("quantify/quantifySpots/" + str(numSpots) + "spots-x" + str(stackSize),
+               lambda: quantifySpots(stack, offset, spotInfo, shape))
+        if stackSize == 1:
+            yield ("quantify/refineSpotCenters/" + str(numSpots) + "spots",
+                   lambda: refineSpotCenters(image, offset, spotInfo))
+
+
+benchGroups = {"match": matchCases,
+               "mask": maskCases,
+               "hough": houghCases,
+               "convert": convertCases,
+               "quantify": quantifyCases}
+
+
+def runBenchmarks(groups=None, repeat=7, warmup=2, quick=False):
+    results = {}
+    for groupName, cases in benchGroups.items():
+        if groups and groupName not in groups:
+            continue
+        for name, func in cases(quick):
+            results[name] = timeit(func, repeat, warmup)
+            print("%-48s %9.2f ms" % (name, results[name]["median"] * 1000))
+    return {"machine": {"platform": platform.platform(),
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "opencv": cv2.__version__,
+                        "cpus": os.cpu_count(),
+                        "cvThreads": cv2.getNumThreads()},
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results}
+
+
+def compareToBaseline(report, baseline, tolerance):
+    """ flags every case whose median got slower than baseline * (1 + tolerance)
+
+    Returns:
+        regressions (list): (name, baseline ms, current ms, ratio)
+    """
+    regressions = []
+    for name, current in sorted(report["results"].items()):
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = current["median"] / before["median"]
+        marker = ""
+        if ratio > 1 + tolerance:
+            marker = "  SLOWER"
+            regressions.append((name, before["median"] * 1000,
+                                current["median"] * 1000, ratio))
+        print("%-48s %9.2f -> %9.2f ms  x%.2f%s" % (name, before["median"] * 1000,
+                                                    current["median"] * 1000, ratio, marker))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="D4Scope imaging benchmarks")
+    parser.add_argument("--out", help="write results json here")
+    parser.add_argument("--baseline", help="results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown of the median, 0.25 = 25%%")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--quick", action="store_true", help="one size per case")
+    parser.add_argument("--only", nargs="+", choices=sorted(benchGroups),
+                        help="run only these groups")
+    args = parser.parse_args(argv)
+    report = runBenchmarks(args.only, args.repeat, args.warmup, args.quick)
+    if args.out:
+        with open(args.out, "w") as outFile:
+            json.dump(report, outFile, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = compareToBaseline(report, baseline, args.tolerance)
+        if regressions:
+            print(str(len(regressions)) + " case(s) slower than baseline")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,380 @@
+"""
+Camera backends. Every capture path (cameraControl, liveStream, singleCapture,
+CameraSession, GrabThread) gets its camera and pixel converter from the
+active backend instead of calling pypylon directly:
+1) PylonBackend: the Basler camera through pypylon (default)
+2) SimulatedBackend: replays tiffs (e.g. test.tiff) at a set frame rate, bit
+   depth (Mono8/Mono12p) and timing jitter, so the whole pipeline can be
+   load tested on a machine with no camera attached
+
+Both hand out objects with the InstantCamera surface the code already uses
+(Open, GrabOne, StartGrabbing, RetrieveResult, node.SetValue, ...).
+
+    setBackend(SimulatedBackend(["test.tiff"], fps=30, pixelFormat="Mono12p"))
+
+or from the shell, before starting cmdDevTools / einsteinUI:
+    D4SCOPE_SIM="test.tiff" D4SCOPE_SIM_FPS=30 python cmdDevTools.py
+"""
+
+import glob
+import os
+import random
+import threading
+import time
+
+import cv2
+import numpy as np
+
+try:
+    from pypylon import pylon
+except ImportError:  # simulator only machines
+    pylon = None
+
+
+class PylonBackend():
+    """ first Basler device through pypylon """
+    name = "pylon"
+
+    def __init__(self):
+        if pylon is None:
+            raise RuntimeError("pypylon is not installed, use SimulatedBackend")
+        self.latestImageOnly = pylon.GrabStrategy_LatestImageOnly
+        self.oneByOne = pylon.GrabStrategy_OneByOne
+        self.timeoutThrow = pylon.TimeoutHandling_ThrowException
+
+    def enumerateDevices(self):
+        """ serial numbers of every attached camera """
+        return [info.GetSerialNumber()
+                for info in pylon.TlFactory.GetInstance().EnumerateDevices()]
+
+    def createCamera(self, serial=None):
+        """ the camera with the given serial number, the first one by default """
+        factory = pylon.TlFactory.GetInstance()
+        if serial is None:
+            return pylon.InstantCamera(factory.CreateFirstDevice())
+        for info in factory.EnumerateDevices():
+            if info.GetSerialNumber() == serial:
+                return pylon.InstantCamera(factory.CreateDevice(info))
+        raise RuntimeError("no camera with serial number " + str(serial))
+
+    def makeConverter(self, pixelType=None):
+        """ converter to Mono8 (MsbAligned) by default. build once, reuse """
+        converter = pylon.ImageFormatConverter()
+        converter.OutputPixelFormat = pylon.PixelType_Mono8 if pixelType is None else pixelType
+        converter.OutputBitalignment = pylon.OutputBitAlignment_MsbAligned
+        return converter
+
+
+class SimulatedBackend():
+    """ replays image files as a camera
+
+    Args:
+        sources (list or str): tiff paths or glob patterns, played in a loop
+
+        fps (float): free running frame rate while grabbing
+
+        pixelFormat (str): 'Mono8' or 'Mono12p', can be changed later through
+            the PixelFormat node like the real camera
+
+        jitter (float): frame period jitter, as a fraction of the period
+
+        realTime (bool): sleep for frame periods and exposures. False delivers
+            frames as fast as they are asked for (throughput tests)
+
+        seed (int): jitter random seed, for repeatable runs
+
+        numDevices (int): cameras to simulate, serials SIM0000, SIM0001, ...
+    """
+    name = "simulated"
+    latestImageOnly = "LatestImageOnly"
+    oneByOne = "OneByOne"
+    timeoutThrow = "ThrowException"
+
+    def __init__(self, sources, fps=10.0, pixelFormat="Mono8", jitter=0.0,
+                 realTime=True, seed=None, numDevices=1):
+        if isinstance(sources, str):
+            sources = [sources]
+        paths = []
+        for each in sources:
+            paths.extend(sorted(glob.glob(each)))
+        if not paths:
+            raise FileNotFoundError("no simulator frames found in " + str(sources))
+        self.frames = [loadSimFrame(each) for each in paths]
+        self.fps = fps
+        self.pixelFormat = pixelFormat
+        self.jitter = jitter
+        self.realTime = realTime
+        self.seed = seed
+        self.numDevices = numDevices
+
+    def enumerateDevices(self):
+        return ["SIM" + str(index).zfill(4) for index in range(self.numDevices)]
+
+    def createCamera(self, serial=None):
+        serials = self.enumerateDevices()
+        serial = serials[0] if serial is None else serial
+        if serial not in serials:
+            raise RuntimeError("no camera with serial number " + str(serial))
+        return SimulatedCamera(self.frames, fps=self.fps,
+                               pixelFormat=self.pixelFormat,
+                               jitter=self.jitter,
+                               realTime=self.realTime,
+                               seed=self.seed,
+                               serial=serial)
+
+    def makeConverter(self, pixelType=None):
+        return SimulatedConverter()
+
+
+def loadSimFrame(filePath):
+    """ reads a tiff as a 12 bit (0-4095) uint16 frame, the sensor's native depth """
+    image = cv2.imread(filePath, -1)
+    if image is None:
+        raise FileNotFoundError("could not read " + str(filePath))
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if image.dtype == np.uint8:
+        return image.astype(np.uint16) << 4
+    return (image.astype(np.uint16) >> 4) if image.max() > 4095 else image.astype(np.uint16)
+
+
+def packMono12p(frame12):
+    """ packs 12 bit pixels two per 3 bytes, GenICam Mono12p (lsb first) """
+    flat = frame12.ravel()
+    if len(flat) % 2:
+        flat = np.append(flat, 0)
+    low = flat[0::2]
+    high = flat[1::2]
+    packed = np.empty((len(low), 3), dtype=np.uint8)
+    packed[:, 0] = low & 0xFF
+    packed[:, 1] = ((low >> 8) & 0x0F) | ((high & 0x0F) << 4)
+    packed[:, 2] = high >> 4
+    return packed.ravel()
+
+
+class SimulatedNode():
+    def __init__(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+    def SetValue(self, value):
+        self.value = value
+
+
+class SimulatedDeviceInfo():
+    def __init__(self, serial="SIM0000"):
+        self.serial = serial
+
+    def GetModelName(self):
+        return "D4Scope simulator"
+
+    def GetSerialNumber(self):
+        return self.serial
+
+
+class SimulatedGrabResult():
+    """ grab result with the pylon calls the pipeline uses
+
+        GetArray() is the unpacked frame (uint8 for Mono8, uint16 for
+        Mono12p); GetBuffer() is the raw payload, packed for Mono12p
+    """
+    def __init__(self, frame, pixelFormat, blockID, timeStamp):
+        self.frame = frame
+        self.pixelFormat = pixelFormat
+        self.BlockID = blockID
+        self.TimeStamp = timeStamp
+        self.Width = frame.shape[1]
+        self.Height = frame.shape[0]
+
+    def GrabSucceeded(self):
+        return True
+
+    def GetArray(self):
+        return self.frame
+
+    @property
+    def Array(self):
+        return self.frame
+
+    def GetBuffer(self):
+        if self.pixelFormat == "Mono12p":
+            return packMono12p(self.frame).tobytes()
+        return self.frame.tobytes()
+
+    def GetPixelType(self):
+        return self.pixelFormat
+
+    def Release(self):
+        self.frame = None
+
+    def __bool__(self):
+        return True
+
+
+class SimulatedImage():
+    def __init__(self, array):
+        self.array = array
+
+    def GetArray(self):
+        return self.array
+
+
+class SimulatedConverter():
+    """ Mono8, MsbAligned: keeps the top 8 of the frame's bits """
+    def Convert(self, grabResult):
+        frame = grabResult.GetArray()
+        if frame.dtype == np.uint8:
+            return SimulatedImage(frame.copy())
+        return SimulatedImage((frame >> 4).astype(np.uint8))
+
+
+class SimulatedCamera():
+    """ InstantCamera stand-in that plays frames back
+
+    Exposure and gain scale the replayed intensities relative to the profile
+    the files were captured with (referenceExpo/referenceGain), clipped at
+    the sensor maximum, so exposure control can be tested against it.
+    Binning is not simulated: the files are assumed to be at the binned size.
+    """
+    nodeNames = ("Gain", "ExposureTime", "DigitalShift", "PixelFormat",
+                 "BinningVertical", "BinningHorizontal")
+
+    def __init__(self, frames, fps=10.0, pixelFormat="Mono8", jitter=0.0,
+                 realTime=True, seed=None, referenceExpo=1e5, referenceGain=24,
+                 serial="SIM0000"):
+        object.__setattr__(self, "nodes", {"Gain": SimulatedNode(referenceGain),
+                                           "ExposureTime": SimulatedNode(referenceExpo),
+                                           "DigitalShift": SimulatedNode(0),
+                                           "PixelFormat": SimulatedNode(pixelFormat),
+                                           "BinningVertical": SimulatedNode(1),
+                                           "BinningHorizontal": SimulatedNode(1)})
+        self.frames = frames
+        self.fps = fps
+        self.jitter = jitter
+        self.realTime = realTime
+        self.random = random.Random(seed)
+        self.referenceExpo = referenceExpo
+        self.referenceGain = referenceGain
+        self.serial = serial
+        self.opened = False
+        self.grabbing = False
+        self.frameIndex = 0
+        self.blockID = 0
+        self.nextFrameTime = None
+        self.lock = threading.Lock()
+
+    # pypylon allows camera.Gain = 24 as well as camera.Gain.SetValue(24)
+    def __getattr__(self, name):
+        nodes = self.__dict__.get("nodes", {})
+        if name in nodes:
+            return nodes[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.nodeNames:
+            self.nodes[name].SetValue(value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def GetDeviceInfo(self):
+        return SimulatedDeviceInfo(self.serial)
+
+    def Open(self):
+        self.opened = True
+
+    def IsOpen(self):
+        return self.opened
+
+    def Close(self):
+        self.grabbing = False
+        self.opened = False
+
+    def StartGrabbing(self, strategy=None):
+        self.grabbing = True
+        self.nextFrameTime = time.monotonic()
+
+    def StopGrabbing(self):
+        self.grabbing = False
+
+    def IsGrabbing(self):
+        return self.grabbing
+
+    def _nextFrame(self):
+        with self.lock:
+            source = self.frames[self.frameIndex % len(self.frames)]
+            self.frameIndex = self.frameIndex + 1
+            self.blockID = self.blockID + 1
+            blockID = self.blockID
+        scale = (self.nodes["ExposureTime"].value / self.referenceExpo *
+                 10**((self.nodes["Gain"].value - self.referenceGain) / 20.0))
+        if scale == 1.0:
+            frame12 = source
+        else:
+            frame12 = np.minimum(source * scale, 4095).astype(np.uint16)
+        pixelFormat = self.nodes["PixelFormat"].value
+        if pixelFormat == "Mono8":
+            frame = (frame12 >> 4).astype(np.uint8)
+        else:
+            frame = frame12.copy() if frame12 is source else frame12
+        return SimulatedGrabResult(frame, pixelFormat, blockID,
+                                   int(time.monotonic() * 1e9))
+
+    def RetrieveResult(self, timeoutMs, timeoutHandling=None):
+        if not self.grabbing:
+            raise RuntimeError("simulated camera is not grabbing")
+        if self.realTime:
+            period = 1.0 / self.fps
+            if self.jitter:
+                period = period * (1.0 + self.random.uniform(-self.jitter, self.jitter))
+            self.nextFrameTime = max(self.nextFrameTime + period,
+                                     time.monotonic() - period)
+            wait = self.nextFrameTime - time.monotonic()
+            if wait > timeoutMs / 1000.0:
+                time.sleep(timeoutMs / 1000.0)
+                raise TimeoutError("simulated grab timed out")
+            if wait > 0:
+                time.sleep(wait)
+        return self._nextFrame()
+
+    def GrabOne(self, timeoutMs):
+        if self.realTime:
+            exposure = self.nodes["ExposureTime"].value / 1e6
+            if exposure > timeoutMs / 1000.0:
+                time.sleep(timeoutMs / 1000.0)
+                return None
+            time.sleep(exposure)
+        return self._nextFrame()
+
+
+# the backend every capture path uses, see getBackend / setBackend
+_activeBackend = []
+
+
+def getBackend():
+    if not _activeBackend:
+        _activeBackend.append(PylonBackend())
+    return _activeBackend[0]
+
+
+def setBackend(backend):
+    """ switches every capture path to backend (PylonBackend / SimulatedBackend) """
+    del _activeBackend[:]
+    _activeBackend.append(backend)
+    return backend
+
+
+def backendFromEnvironment():
+    """ uses SimulatedBackend when D4SCOPE_SIM (tiff glob) is set, with
+        D4SCOPE_SIM_FPS, D4SCOPE_SIM_FORMAT, D4SCOPE_SIM_JITTER and
+        D4SCOPE_SIM_DEVICES
+    """
+    sources = os.environ.get("D4SCOPE_SIM")
+    if sources:
+        return setBackend(SimulatedBackend(sources.split(os.pathsep),
+                                           fps=float(os.environ.get("D4SCOPE_SIM_FPS", 10)),
+                                           pixelFormat=os.environ.get("D4SCOPE_SIM_FORMAT", "Mono8"),
+                                           jitter=float(os.environ.get("D4SCOPE_SIM_JITTER", 0)),
+                                           numDevices=int(os.environ.get("D4SCOPE_SIM_DEVICES", 1))))
+    return getBackend()
@@ -0,0 +1,114 @@
+"""
+Persistent camera session. Opens the device once and keeps named config
+profiles (videoConfig, singleConfig, ...) that can be switched between.
+Only the GenICam nodes whose value actually changes are written, so going
+from live view to a single long exposure costs the exposure, not a device
+enumeration and a full reconfiguration.
+"""
+
+from cameraBackend import getBackend
+from frameTools import FrameUnpacker
+from stageTiming import span
+
+# config key -> GenICam node(s) it drives. structural nodes first, they can
+# change the valid range of the others
+configNodes = [("binval", ("BinningVertical", "BinningHorizontal")),
+               ("pixelform", ("PixelFormat",)),
+               ("digshift", ("DigitalShift",)),
+               ("gain", ("Gain",)),
+               ("expo", ("ExposureTime",))]
+
+
+class CameraSession():
+    """ One open camera plus switchable config profiles
+
+    Args:
+        profiles (dict): profile name -> config dict in the videoConfig format
+            ({'gain', 'expo', 'digshift', 'pixelform', 'binval'})
+
+        camera (pylon.InstantCamera): an already created camera. default is
+            the first device of the backend, created on open()
+
+        backend: camera backend, defaults to cameraBackend.getBackend()
+
+        serial (str): serial number of the device to open, default the first
+
+    unpacker is the session's FrameUnpacker (frameTools), kept so packed
+    captures reuse its buffers instead of allocating them per grab
+    """
+    def __init__(self, profiles, camera=None, backend=None, serial=None):
+        self.profiles = dict(profiles)
+        self.camera = camera
+        self.backend = backend
+        self.serial = serial
+        self.activeProfile = None
+        self.nodeValues = {}  # last value written to / read from each node
+        self.unpacker = FrameUnpacker()
+
+    def open(self):
+        if self.camera is None:
+            backend = getBackend() if self.backend is None else self.backend
+            self.camera = backend.createCamera(self.serial)
+            print("connected Device model: " +
+                  str(self.camera.GetDeviceInfo().GetModelName()))
+        if not self.camera.IsOpen():
+            self.camera.Open()
+            self.nodeValues = {}
+            self.activeProfile = None
+        return self
+
+    def isOpen(self):
+        return self.camera is not None and self.camera.IsOpen()
+
+    def close(self):
+        if self.camera is not None:
+            if self.camera.IsGrabbing():
+                self.camera.StopGrabbing()
+            if self.camera.IsOpen():
+                self.camera.Close()
+        self.nodeValues = {}
+        self.activeProfile = None
+
+    def _readNode(self, node):
+        if node not in self.nodeValues:
+            self.nodeValues[node] = getattr(self.camera, node).GetValue()
+        return self.nodeValues[node]
+
+    def applyProfile(self, name):
+        """ switches to a profile, writing only the nodes that differ
+
+        Returns:
+            written (list): names of the nodes that were actually written
+        """
+        if not self.isOpen():
+            self.open()
+        config = self.profiles[name]
+        written = []
+        wasGrabbing = self.camera.IsGrabbing()
+        for key, nodes in configNodes:
+            if key not in config:
+                continue
+            for node in nodes:
+                if self._readNode(node) != config[key]:
+                    if wasGrabbing and key in ("binval", "pixelform"):
+                        # structural nodes are locked while grabbing
+                        self.camera.StopGrabbing()
+                        wasGrabbing = False
+                    getattr(self.camera, node).SetValue(config[key])
+                    self.nodeValues[node] = config[key]
+                    written.append(node)
+        self.activeProfile = name
+        return written
+
+    def grabOne(self, profileName):
+        """ single capture with the given profile, waits exposure * 1.1 """
+        self.applyProfile(profileName)
+        if self.camera.IsGrabbing():
+            self.camera.StopGrabbing()
+        expo = self.profiles[profileName]['expo']
+        # ExposureTime is in us, the grab timeout in ms
+        with span("capture"):
+            buffer = self.camera.GrabOne(int(max(expo * 1.1 / 1000, 1000)))
+        if not buffer:
+            raise RuntimeError("Camera failed to capture single image")
+        return buffer
@@ -0,0 +1,234 @@
+"""
+Threaded capture pipeline. The camera is never paced by whoever looks at the
+frames:
+1) GrabThread owns the camera and one persistent pixel format converter
+2) FrameRing is a preallocated ring of frames, the oldest frame is dropped
+   when consumers fall behind
+3) FrameConsumer threads (display, save, analysis) read at their own rate,
+   either every frame or only the newest one
+
+    ring = FrameRing(capacity=8)
+    grabber = GrabThread(camera, ring)
+    saver = FrameConsumer(ring, saveFrame, latestOnly=False)
+    grabber.start(); saver.start()
+    ...
+    grabber.stop(); saver.stop()
+    print(grabber.stats(), saver.stats())
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from cameraBackend import getBackend
+from frameTools import FrameUnpacker, grabToArray, grabPixelFormat
+from stageTiming import span, count
+
+
+class FrameRing():
+    """ Fixed size ring buffer of frames with drop-oldest semantics
+
+    Slots are allocated once, on the first frame (or up front when shape and
+    dtype are given). put() copies into the next slot and never blocks on
+    readers. Every frame gets a sequence number, so a reader that falls more
+    than capacity frames behind can tell how many it lost.
+    """
+    def __init__(self, capacity=8, shape=None, dtype=np.uint8):
+        self.capacity = capacity
+        self.slots = None
+        self.stamps = np.zeros(capacity, dtype=np.float64)
+        self.nextSeq = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        if shape is not None:
+            self.slots = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+
+    def put(self, frame, stamp=None):
+        with self.condition:
+            if self.slots is None or self.slots.shape[1:] != frame.shape \
+                    or self.slots.dtype != frame.dtype:
+                self.slots = np.zeros((self.capacity,) + frame.shape, dtype=frame.dtype)
+            slot = self.nextSeq % self.capacity
+            np.copyto(self.slots[slot], frame)
+            self.stamps[slot] = time.monotonic() if stamp is None else stamp
+            self.nextSeq = self.nextSeq + 1
+            self.condition.notify_all()
+
+    def putWith(self, fill, shape, dtype, stamp=None):
+        """ like put, but fill(slot) writes the frame straight into the ring
+            slot (e.g. an unpacker), saving the intermediate frame and copy
+        """
+        with self.condition:
+            if self.slots is None or self.slots.shape[1:] != tuple(shape) \
+                    or self.slots.dtype != dtype:
+                self.slots = np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+            slot = self.nextSeq % self.capacity
+            fill(self.slots[slot])
+            self.stamps[slot] = time.monotonic() if stamp is None else stamp
+            self.nextSeq = self.nextSeq + 1
+            self.condition.notify_all()
+
+    def close(self):
+        """ wakes every waiting reader, later reads return None """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def read(self, seq, out=None, timeout=None):
+        """ copies frame seq (or the oldest one still held, if seq was
+            overwritten) into out
+
+        Returns:
+            seq (int): sequence number actually read, None on timeout/close
+
+            frame (np array): out, or a new array when out is None
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.nextSeq > seq or self.closed,
+                                           timeout):
+                return None, out
+            if self.nextSeq <= seq:
+                return None, out
+            oldest = max(self.nextSeq - self.capacity, 0)
+            seq = max(seq, oldest)
+            return seq, self._copyOut(seq, out)
+
+    def readLatest(self, afterSeq=-1, out=None, timeout=None):
+        """ copies the newest frame, waiting until one newer than afterSeq
+            exists. same return values as read()
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.nextSeq - 1 > afterSeq or self.closed,
+                                           timeout):
+                return None, out
+            if self.nextSeq - 1 <= afterSeq:
+                return None, out
+            seq = self.nextSeq - 1
+            return seq, self._copyOut(seq, out)
+
+    def _copyOut(self, seq, out):
+        slot = seq % self.capacity
+        if out is None or out.shape != self.slots.shape[1:] or out.dtype != self.slots.dtype:
+            out = np.empty_like(self.slots[slot])
+        np.copyto(out, self.slots[slot])
+        return out
+
+    def stamp(self, seq):
+        return self.stamps[seq % self.capacity]
+
+
+class GrabThread(threading.Thread):
+    """ Grabs from an open camera into a FrameRing as fast as it can
+
+    Uses GrabStrategy_LatestImageOnly so a slow pipeline never builds up a
+    backlog inside the driver, and one converter for the whole session.
+    backend defaults to the active one (cameraBackend.getBackend).
+    fullDepth keeps the sensor bit depth (frameTools.grabToArray, Mono12p
+    unpacked straight into the ring) instead of converting to Mono8.
+    """
+    def __init__(self, camera, ring, converter=None, timeoutMs=5000, backend=None,
+                 fullDepth=False):
+        super(GrabThread, self).__init__(daemon=True)
+        self.camera = camera
+        self.ring = ring
+        self.backend = getBackend() if backend is None else backend
+        self.converter = self.backend.makeConverter() if converter is None else converter
+        self.timeoutMs = timeoutMs
+        self.fullDepth = fullDepth
+        self.unpacker = FrameUnpacker()
+        self.running = threading.Event()
+        self.running.set()
+        self.grabbed = 0
+        self.failed = 0
+        self.startTime = None
+        self.error = None
+
+    def run(self):
+        self.startTime = time.monotonic()
+        self.camera.StartGrabbing(self.backend.latestImageOnly)
+        try:
+            while self.running.is_set() and self.camera.IsGrabbing():
+                buffer = self.camera.RetrieveResult(self.timeoutMs,
+                                                    self.backend.timeoutThrow)
+                try:
+                    if buffer.GrabSucceeded():
+                        if self.fullDepth:
+                            self.putFullDepth(buffer)
+                        else:
+                            with span("convert"):
+                                frame = self.converter.Convert(buffer).GetArray()
+                            self.ring.put(frame)
+                        self.grabbed = self.grabbed + 1
+                        count("frames/grabbed")
+                    else:
+                        self.failed = self.failed + 1
+                        count("frames/failed")
+                finally:
+                    buffer.Release()
+        except Exception as err:
+            self.error = err
+        finally:
+            self.camera.StopGrabbing()
+            self.ring.close()
+
+    def putFullDepth(self, buffer):
+        """ unpacks / copies the grab result straight into the next ring slot """
+        dtype = np.uint8 if grabPixelFormat(buffer) == "Mono8" else np.uint16
+        self.ring.putWith(lambda slot: grabToArray(buffer, self.unpacker, out=slot),
+                          (buffer.Height, buffer.Width), dtype)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.startTime if self.startTime else 0.0
+        return {"grabbed": self.grabbed,
+                "failed": self.failed,
+                "fps": self.grabbed / elapsed if elapsed > 0 else 0.0}
+
+
+class FrameConsumer(threading.Thread):
+    """ Calls callback(frame, seq) for frames from a FrameRing on its own thread
+
+    latestOnly=True (display, analysis) always jumps to the newest frame.
+    latestOnly=False (saving) walks every frame in order; frames that were
+    overwritten before it got to them are counted in dropped.
+    The frame handed to callback is a reused buffer, copy it to keep it.
+    """
+    def __init__(self, ring, callback, latestOnly=True):
+        super(FrameConsumer, self).__init__(daemon=True)
+        self.ring = ring
+        self.callback = callback
+        self.latestOnly = latestOnly
+        self.running = threading.Event()
+        self.running.set()
+        self.frame = None
+        self.lastSeq = -1
+        self.consumed = 0
+        self.dropped = 0
+
+    def run(self):
+        while self.running.is_set():
+            if self.latestOnly:
+                seq, self.frame = self.ring.readLatest(self.lastSeq, self.frame, timeout=0.5)
+            else:
+                seq, self.frame = self.ring.read(self.lastSeq + 1, self.frame, timeout=0.5)
+            if seq is None:
+                if self.ring.closed:
+                    break
+                continue
+            self.dropped = self.dropped + seq - self.lastSeq - 1
+            if seq - self.lastSeq > 1:
+                count("frames/dropped", seq - self.lastSeq - 1)
+            self.lastSeq = seq
+            self.callback(self.frame, seq)
+            self.consumed = self.consumed + 1
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def stats(self):
+        return {"consumed": self.consumed, "dropped": self.dropped}
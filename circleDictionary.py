@@ -0,0 +1,226 @@
+"""
+Single file circle dictionary (.cdict). One versioned file holds everything a
+standard needs, so loading it and starting analysis is a memory map:
+1) spots: typed spot table (x, y, radius)
+2) template: the 8 bit standard image patternGen made
+3) labels / pixelIdx / pixelLabels: the spotMask arrays
+4) bgXs / bgYs / bgLabels: the background annuli (backgroundPixels)
+
+layout: magic (8 bytes), version (uint32), header length (uint32), json
+header (batch, shape, annulus, section dtype/shape/offset), then the raw
+little endian sections, each 64 byte aligned.
+
+convert an existing json + tiff pair (patternGen output):
+    python circleDictionary.py standard_image.json
+    python circleDictionary.py standard_image.json --template std.tiff --out std.cdict
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+
+import cv2
+import numpy as np
+
+from spotAnalysis import (backgroundAnnulus, backgroundPixels, primeMaskCache,
+                          spotMask, _spotArray)
+
+formatMagic = b"D4CDICT\n"
+formatVersion = 1
+sectionAlign = 64
+spotDtype = np.dtype([("x", "<i4"), ("y", "<i4"), ("radius", "<i4")])
+sectionNames = ("spots", "template", "labels", "pixelIdx", "pixelLabels",
+                "bgXs", "bgYs", "bgLabels")
+
+
+class CircleDictionary():
+    """ A standard: spot table, template and precomputed masks
+
+    Build one from spots or fromJson, or load a .cdict with load (arrays
+    are then read only memory maps). Either way the masks are installed in
+    the spotAnalysis caches, so quantifySpots never rebuilds them.
+
+    Args:
+        batch (str): batch name, e.g. 'leptin-1'
+
+        spots (np array): spotDtype table, or [x, y, r] per spot
+
+        shape (tuple): (rows, cols) of the pattern
+
+        template (np array): 8 bit standard image
+
+        masks (dict): the label / index / annulus arrays by section name,
+            computed from the spots when missing
+
+        gap, width (int): background annulus the masks were built with
+    """
+    def __init__(self, batch, spots, shape, template, masks=None,
+                 gap=None, width=None, path=None):
+        self.batch = batch
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.gap = backgroundAnnulus["gap"] if gap is None else int(gap)
+        self.width = backgroundAnnulus["width"] if width is None else int(width)
+        self.path = path
+        if getattr(spots, "dtype", None) != spotDtype:
+            table = np.zeros(len(spots), dtype=spotDtype)
+            spotArray = _spotArray(spots)
+            table["x"], table["y"], table["radius"] = spotArray.T
+            spots = table
+        self.spots = spots
+        self.template = template
+        if masks is None:
+            labelImg, pixelIdx, pixelLabels = spotMask(self.spotInfo, self.shape)
+            bgXs, bgYs, bgLabels = backgroundPixels(self.spotInfo, self.shape,
+                                                    self.gap, self.width)
+            masks = {"labels": labelImg, "pixelIdx": pixelIdx,
+                     "pixelLabels": pixelLabels, "bgXs": bgXs, "bgYs": bgYs,
+                     "bgLabels": bgLabels}
+        self.masks = masks
+        primeMaskCache(self.spotInfo, self.shape,
+                       (masks["labels"], masks["pixelIdx"], masks["pixelLabels"]),
+                       (masks["bgXs"], masks["bgYs"], masks["bgLabels"]),
+                       self.gap, self.width)
+
+    @property
+    def spotInfo(self):
+        """ (n, 3) int32 [x, y, r] view of the spot table, spot_info style """
+        return self.spots.view("<i4").reshape(-1, 3)
+
+    @property
+    def labelImg(self):
+        return self.masks["labels"]
+
+    def __len__(self):
+        return len(self.spots)
+
+    def toJsonDict(self):
+        """ the old standard_image.json content """
+        return {"batch": self.batch,
+                "spot_info": self.spotInfo.tolist(),
+                "shape": list(self.shape)}
+
+    def save(self, filePath):
+        sections = {"spots": self.spots, "template": self.template}
+        sections.update(self.masks)
+        header = {"batch": self.batch,
+                  "shape": list(self.shape),
+                  "annulus": {"gap": self.gap, "width": self.width},
+                  "sections": {}}
+        blobs = []
+        offset = 0
+        for name in sectionNames:
+            array = np.ascontiguousarray(sections[name])
+            array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+            header["sections"][name] = {"dtype": np.lib.format.dtype_to_descr(array.dtype),
+                                        "shape": list(array.shape),
+                                        "offset": offset}
+            blobs.append(array.tobytes())
+            offset = offset + _aligned(array.nbytes)
+        headerBytes = json.dumps(header).encode("utf-8")
+        dataStart = _aligned(len(formatMagic) + 8 + len(headerBytes))
+        with open(filePath, "wb") as outFile:
+            outFile.write(formatMagic)
+            outFile.write(struct.pack("<II", formatVersion, len(headerBytes)))
+            outFile.write(headerBytes)
+            outFile.write(b"\0" * (dataStart - outFile.tell()))
+            for blob in blobs:
+                outFile.write(blob)
+                outFile.write(b"\0" * (_aligned(len(blob)) - len(blob)))
+        self.path = filePath
+        return filePath
+
+    @classmethod
+    def load(cls, filePath):
+        """ memory maps a .cdict, nothing is read until it is used """
+        with open(filePath, "rb") as inFile:
+            magic = inFile.read(len(formatMagic))
+            if magic != formatMagic:
+                raise ValueError(str(filePath) + " is not a circle dictionary file")
+            version, headerLength = struct.unpack("<II", inFile.read(8))
+            if version > formatVersion:
+                raise ValueError(str(filePath) + " is format version " + str(version)
+                                 + ", this reader handles up to " + str(formatVersion))
+            header = json.loads(inFile.read(headerLength).decode("utf-8"))
+        dataStart = _aligned(len(formatMagic) + 8 + headerLength)
+        mapped = np.memmap(filePath, dtype=np.uint8, mode="r")
+        sections = {}
+        for name, info in header["sections"].items():
+            dtype = np.lib.format.descr_to_dtype(info["dtype"])
+            count = int(np.prod(info["shape"], dtype=np.int64))
+            start = dataStart + info["offset"]
+            raw = mapped[start:start + count * dtype.itemsize]
+            sections[name] = raw.view(dtype).reshape(info["shape"])
+        spots = sections.pop("spots")
+        template = sections.pop("template")
+        return cls(header["batch"], spots, header["shape"], template,
+                   masks=sections, gap=header["annulus"]["gap"],
+                   width=header["annulus"]["width"], path=filePath)
+
+    @classmethod
+    def fromJson(cls, jsonPath, templatePath=None):
+        """ from the patternGen json + tiff pair, template defaults to the
+            tiff with the same name as the json
+        """
+        with open(jsonPath) as jsonFile:
+            content = json.load(jsonFile)
+        if templatePath is None:
+            templatePath = os.path.splitext(jsonPath)[0] + ".tiff"
+        template = cv2.imread(templatePath, 0)
+        if template is None:
+            raise FileNotFoundError("could not read template " + str(templatePath))
+        return cls(content.get("batch", ""), content["spot_info"],
+                   content["shape"], template)
+
+
+def _aligned(numBytes):
+    return -(-numBytes // sectionAlign) * sectionAlign
+
+
+def _isCurrent(compiledPath, sourcePaths):
+    """ True when compiledPath is at least as new as every existing source """
+    compiled = os.path.getmtime(compiledPath)
+    return all(os.path.getmtime(each) <= compiled
+               for each in sourcePaths if os.path.exists(each))
+
+
+def loadCircleDictionary(filePath, templatePath=None):
+    """ any form of a standard: a .cdict, its json, or its template tiff
+
+    .json and .tiff paths use the .cdict next to them when it is newer than
+    both the json and the tiff, otherwise the json + tiff pair is read and
+    converted in memory (an edited json is never shadowed by an old .cdict).
+    """
+    base, extension = os.path.splitext(filePath)
+    if extension.lower() != ".cdict" and templatePath is None and os.path.exists(base + ".cdict"):
+        if _isCurrent(base + ".cdict", [base + ".json", base + ".tiff"]):
+            filePath, extension = base + ".cdict", ".cdict"
+        else:
+            print(base + ".cdict is older than its json / tiff, ignored. rebuild it with"
+                  " python circleDictionary.py " + base + ".json")
+    if extension.lower() == ".cdict":
+        return CircleDictionary.load(filePath)
+    if extension.lower() in (".tif", ".tiff"):
+        return CircleDictionary.fromJson(base + ".json", filePath)
+    return CircleDictionary.fromJson(filePath, templatePath)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="convert a circle dictionary json + tiff to .cdict")
+    parser.add_argument("json", help="standard_image.json style circle dictionary")
+    parser.add_argument("--template", default=None,
+                        help="template tiff, default: json name with .tiff")
+    parser.add_argument("--out", default=None,
+                        help="output .cdict, default: json name with .cdict")
+    args = parser.parse_args(argv)
+    circleDict = CircleDictionary.fromJson(args.json, args.template)
+    outPath = args.out or os.path.splitext(args.json)[0] + ".cdict"
+    circleDict.save(outPath)
+    print(outPath + ": " + str(len(circleDict)) + " spots, pattern "
+          + str(circleDict.shape[1]) + "x" + str(circleDict.shape[0]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,9 +7,18 @@ This is the Development Tools Command Line Interface. It will have controls for:
 
 import cv2
 import numpy as np
-from pypylon import pylon
-import easygui
 import json
+from spotAnalysis import spotMask, spotPixels
+from circleDictionary import CircleDictionary
+from houghSearch import searchHoughParams, printReport, saveReport
+from autoExposure import ExposureController
+from capturePipeline import FrameRing, GrabThread
+from cameraBackend import getBackend, backendFromEnvironment
+from stageTiming import span, exportFromEnvironment
+from imageWriter import defaultWriter, acquisitionMetadata
+from imageSource import ImageSource
+# re-exported, the matching code lives in the GUI free matching module
+from matching import centerWeight, pyramidCandidates, templateMatch8b, TemplateMatcher
 
 imgScaleDown = 2
 videoConfig = {'gain': 24,
@@ -24,6 +33,8 @@ houghParams = {"minDist": 60,
                "param2" : 17,
                "minRadius": 24,
                "maxRadius": 29}
+# search houghSearch.houghGrid for the best parameters instead of houghParams
+autoTuneHough = False
 
 
 arrayCoords = []
@@ -57,21 +68,12 @@ def cvWindow(name, image, keypressBool):
         return pressedKey
     
 def circlePixelID(circleList): # output pixel locations of all circles within the list,
-    circleIDpointer = 0
-    pixelLocations = []
-    for eachCircle in circleList:
-#        print("this circle is being analyzed in circle pixel ID")
-#        print(eachCircle)
-        xCoordCirc = eachCircle[0] # separates the x and y coordinates of the center of the circles and the circle radius 
-        yCoordCirc = eachCircle[1]
-        radiusCirc = eachCircle[2]
-        for exesInCircle in range(( xCoordCirc - radiusCirc ),( xCoordCirc + radiusCirc )):
-            whyRange = np.sqrt(pow(radiusCirc,2) - pow((exesInCircle - xCoordCirc),2)) #calculates the y-coordinates that define the top and bottom bounds of a slice (at x position) of the circle 
-            discreteWhyRange = int(whyRange) 
-            for whysInCircle in range(( yCoordCirc - discreteWhyRange),( yCoordCirc + discreteWhyRange)):
-                pixelLocations.append([exesInCircle,whysInCircle, radiusCirc, circleIDpointer])
-        circleIDpointer = circleIDpointer + 1 
-    return pixelLocations
+    """ returns an (n, 4) array of [x, y, radius, circleID] rows, one per pixel
+        inside each circle. Built with array ops, see spotAnalysis.spotPixels
+    """
+    radii = np.asarray(circleList).reshape(-1, 3)[:, 2].astype(np.int32)
+    xs, ys, circleIDs = spotPixels(circleList)
+    return np.column_stack((xs, ys, radii[circleIDs], circleIDs))
 
 def optionSelect():
     clearPrompt()
@@ -83,6 +85,7 @@ def optionSelect():
         print("Image Analysis: 'A'")
         print("Camera Control: 'B'")
         print("Circle Pattern Generation: 'C'")
+        print("Circle Pattern Generation, auto-tuned Hough: 'D'")
         print("Exit: 'X' or 'x'")
         cmdInput = input("Type in your desired selection and press enter to start: ")
         if cmdInput == 'X'or cmdInput == 'x':
@@ -94,6 +97,10 @@ def optionSelect():
             cameraControl()
         if cmdInput == 'C':
             patternGen()
+        if cmdInput == 'D':
+            expected = input("Number of spots on the standard (blank: let the search decide)? ")
+            patternGen(autoTune=True,
+                       expectedSpots=int(expected) if expected.strip() else None)
 
 def imageAnalysis():
     """ Image analysis downsamples the image by a factor set in the code
@@ -105,9 +112,10 @@ def imageAnalysis():
     filePath = openImgFile()
     if filePath:
         print("Opening " + str(filePath))
-        image = cv2.imread(filePath, -1)
-        for each in range(imgScaleDown-1):
-            image = cv2.pyrDown(image)
+        # the reduced level comes from the pyramid cached next to the file
+        source = ImageSource(filePath)
+        image = np.ascontiguousarray(source.level(min(imgScaleDown - 1,
+                                                      source.numLevels() - 1)))
         print("Bitdepth: " + str(np.amax(image)))
         print("Size: " + str(np.shape(image)))
         print("Lclick to display location")
@@ -118,6 +126,8 @@ def imageAnalysis():
         print("Invalid File Path")
 
 def openImgFile():
+    # the only GUI dependency, imported here so headless tools can use this module
+    import easygui
     filePath = easygui.fileopenbox()
     if filePath == None:
         return []
@@ -129,79 +139,152 @@ def clearPrompt():
     for each in range(3):
         print("")
 
-def buffer2image(buffer):
-    converter = pylon.ImageFormatConverter()
-    converter.OutputPixelFormat = pylon.PixelType_Mono8
-    converter.OutputBitalignment = pylon.OutputBitAlignment_MsbAligned
-    img = converter.Convert(buffer)
-    image = img.GetArray()
+_mono8Converter = []  # (backend, converter)
+def buffer2image(buffer, converter=None):
+    """ converts a grab result to a Mono8 np array. the active backend's
+        converter is built once and reused, pass one in to use another format
+    """
+    if converter is None:
+        backend = getBackend()
+        if not _mono8Converter or _mono8Converter[0][0] is not backend:
+            _mono8Converter[:] = [(backend, backend.makeConverter())]
+        converter = _mono8Converter[0][1]
+    with span("convert"):
+        img = converter.Convert(buffer)
+        image = img.GetArray()
     return image
     
 def cameraControl():
     clearPrompt()
     print("Camera Control selected. Camera will connect")
-    camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+    camera = getBackend().createCamera()
     print("connected Device model: " +
           str(camera.GetDeviceInfo().GetModelName()))
     camera.Open()
     camera = cameraSetVals(camera)
 
-    print("Live stream: 'L'; Single Capture: 'S'")
+    print("Live stream: 'L'; Single Capture: 'S'; Auto exposure first: 'A'")
     optionSelect = input("Select Option: ")
+    if optionSelect == 'A':
+        autoExpose(camera)
+        print("Live stream: 'L'; Single Capture: 'S'")
+        optionSelect = input("Select Option: ")
     if optionSelect == 'L':
         liveStream(camera)
     if optionSelect == 'S':
         singleCapture(camera)
 
-def cameraSetVals(camera):
-    camera.Gain = videoConfig['gain']
-    camera.ExposureTime = videoConfig['expo']
-    camera.DigitalShift = videoConfig['digshift']
-    camera.PixelFormat = videoConfig['pixelform']
-    camera.BinningVertical.SetValue(videoConfig['binval'])
-    camera.BinningHorizontal.SetValue(videoConfig['binval'])
+def cameraSetVals(camera, config=None, keys=None):
+    """ writes config (default videoConfig) to the camera. keys limits the
+        write to some entries, e.g. ("gain", "expo") while grabbing, when
+        binning and pixel format are locked
+    """
+    config = videoConfig if config is None else config
+    keys = config.keys() if keys is None else keys
+    if 'gain' in keys:
+        camera.Gain = config['gain']
+    if 'expo' in keys:
+        camera.ExposureTime = config['expo']
+    if 'digshift' in keys:
+        camera.DigitalShift = config['digshift']
+    if 'pixelform' in keys:
+        camera.PixelFormat = config['pixelform']
+    if 'binval' in keys:
+        camera.BinningVertical.SetValue(config['binval'])
+        camera.BinningHorizontal.SetValue(config['binval'])
     return camera
+
+def autoExpose(camera):
+    """ live auto exposure / gain (autoExposure.ExposureController) on the
+        video settings. the settled values are kept in videoConfig, so the
+        live stream or single capture that follows uses them
+    """
+    print("auto exposure running...")
+    backend = getBackend()
+    controller = ExposureController(dict(videoConfig),
+                                    lambda config: cameraSetVals(camera, config, ('gain', 'expo')))
+    camera.StartGrabbing(backend.latestImageOnly)
+    try:
+        while not controller.settled:
+            buffer = camera.RetrieveResult(int(max(controller.config['expo'] * 2.2 / 1000, 1000)),
+                                           backend.timeoutThrow)
+            controller.step(buffer2image(buffer))
+            buffer.Release()
+    finally:
+        camera.StopGrabbing()
+    videoConfig['expo'] = controller.config['expo']
+    videoConfig['gain'] = controller.config['gain']
+    print("exposure " + str(round(videoConfig['expo'])) + " us, gain "
+          + str(round(videoConfig['gain'], 1)) + " dB after "
+          + str(controller.steps) + " steps")
     
 def liveStream(camera):
+    """ grabbing runs on its own thread into a ring buffer (capturePipeline),
+        so the display and keyboard polling here never slow the camera down
+    """
     clearPrompt()
     print("livestream activating. 'x' exit, 's' save last image")
-    camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+    ring = FrameRing(capacity=8)
+    grabber = GrabThread(camera, ring)
+    grabber.start()
     windowName = "live stream"
     cv2.namedWindow(windowName, cv2.WINDOW_NORMAL)
     cv2.setMouseCallback(windowName, mouseLocationClick)
-    while camera.IsGrabbing():
-        buffer = camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-        if buffer.GrabSucceeded():
-            frame = buffer2image(buffer)
-            cv2.imshow(windowName, frame)
-            keypress = cv2.waitKey(1)
-            if keypress == ord('x'):
-                cv2.destroyAllWindows()
-                camera.StopGrabbing()
-                break
-            elif keypress == ord('s'):
-                cv2.destroyAllWindows()
-                camera.StopGrabbing()
-                saveFName = input("Filename to save as (.tiff will be added)? ")
-                cv2.imwrite(str(saveFName) + ".tiff", frame)
-                print(saveFName + " saved.")
-                break
-        buffer.Release()
+    frame = None
+    lastSeq = -1
+    shown = 0
+    while grabber.is_alive() or ring.nextSeq - 1 > lastSeq:
+        seq, frame = ring.readLatest(lastSeq, frame, timeout=0.1)
+        if seq is not None:
+            lastSeq = seq
+            shown = shown + 1
+            with span("display"):
+                cv2.imshow(windowName, frame)
+        keypress = cv2.waitKey(1)
+        if keypress == ord('x'):
+            break
+        elif keypress == ord('s') and frame is not None:
+            grabber.stop()
+            cv2.destroyAllWindows()
+            saveFName = input("Filename to save as (blank: unique id, .tiff will be added)? ")
+            savePath = defaultWriter().submit(frame, saveFName,
+                                              acquisitionMetadata(videoConfig, "liveStream"))
+            print(savePath + " queued for saving.")
+            break
+    grabber.stop()
+    cv2.destroyAllWindows()
+    stats = grabber.stats()
+    print("grabbed " + str(stats["grabbed"]) + " frames at "
+          + str(round(stats["fps"], 1)) + " fps, displayed " + str(shown)
+          + ", not displayed " + str(stats["grabbed"] - shown)
+          + ", failed grabs " + str(stats["failed"]))
+    if grabber.error is not None:
+        print("grab stopped: " + str(grabber.error))
     camera.Close()
 
 def singleCapture(camera):
     clearPrompt()
-    buffer = camera.GrabOne(int(expo * 1.1))
+    # ExposureTime is in us, the grab timeout in ms
+    with span("capture"):
+        buffer = camera.GrabOne(int(max(videoConfig['expo'] * 1.1 / 1000, 1000)))
     if not buffer:
         raise RuntimeError("Camera failed to capture single image")
     image = buffer2image(buffer)
     cvWindow("single capture result", image, False)
-    saveFName = input("Filename to save as (.tiff will be added)? ")
-    cv2.imwrite(str(saveFName) + ".tiff", image)
-    print(saveFName + " saved.")
+    saveFName = input("Filename to save as (blank: unique id, .tiff will be added)? ")
+    savePath = defaultWriter().submit(image, saveFName,
+                                      acquisitionMetadata(videoConfig, "singleCapture"))
+    print(savePath + " queued for saving.")
     camera.Close()
 
-def patternGen():
+def patternGen(autoTune=None, expectedSpots=None):
+    """ crops the array area of a standard image, finds its spots and saves
+        standard_image.tiff/.json/.cdict. with autoTune (default
+        autoTuneHough) the Hough parameters are searched on a process pool
+        (houghSearch) instead of using houghParams, and the ranked report is
+        saved as hough_report.json
+    """
+    autoTune = autoTuneHough if autoTune is None else autoTune
     filePath = openImgFile()
     print("Opening " + str(filePath))
     image = cv2.imread(filePath, -1)
@@ -221,22 +304,34 @@ def patternGen():
     cvWindow("test subimg", subImg, False)
     
     if automaticPattern:
-        smoothImg = cv2.medianBlur(subImg, 3)
-        circlesD = cv2.HoughCircles(smoothImg,
-                                    cv2.HOUGH_GRADIENT,1,
-                                    minDist = houghParams["minDist"],
-                                    param1 = houghParams["param1"],
-                                    param2 = houghParams["param2"],
-                                    minRadius = houghParams["minRadius"],
-                                    maxRadius = houghParams["maxRadius"])
-        circlesX = np.uint(np.around(circlesD))
-        circleLocs = circlesX[0]
+        if autoTune:
+            print("searching Hough parameters...")
+            circleLocs, report = searchHoughParams(subImg, expectedSpots)
+            printReport(report)
+            saveReport(report, "hough_report.json")
+            print("best parameters: " + str(report[0]["params"]))
+            # a blank or misplaced crop finds nothing, don't save that as the standard
+            if len(circleLocs) == 0 or (expectedSpots and len(circleLocs) < expectedSpots):
+                print("best candidate found " + str(len(circleLocs)) + " spots"
+                      + (" of " + str(expectedSpots) if expectedSpots else "")
+                      + ", standard not saved. check the crop and try again")
+                return
+        else:
+            smoothImg = cv2.medianBlur(subImg, 3)
+            circlesD = cv2.HoughCircles(smoothImg,
+                                        cv2.HOUGH_GRADIENT,1,
+                                        minDist = houghParams["minDist"],
+                                        param1 = houghParams["param1"],
+                                        param2 = houghParams["param2"],
+                                        minRadius = houghParams["minRadius"],
+                                        maxRadius = houghParams["maxRadius"])
+            circlesX = np.uint(np.around(circlesD))
+            circleLocs = circlesX[0]
         
         verImg = cv2.cvtColor(subImg.copy(), cv2.COLOR_GRAY2RGB)
         idealStdImg = np.zeros(subImg.shape, dtype = np.uint8)
-        circlePixels = circlePixelID(circleLocs)
-        for eachPixel in circlePixels:
-            idealStdImg[eachPixel[1], eachPixel[0]] = 100
+        labelImg, _, _ = spotMask(circleLocs, subImg.shape)
+        idealStdImg[labelImg > 0] = 100
         
         for eachCircle in circleLocs:
             cv2.circle(verImg,
@@ -272,9 +367,8 @@ def patternGen():
 
         # Generates the ideal std image from the cropped array image
         idealStdImg = np.zeros(subImg.shape, dtype=np.uint8)
-        circlePixels = circlePixelID(circleLocs)
-        for eachPixel in circlePixels:
-            idealStdImg[eachPixel[1], eachPixel[0]] = 50
+        labelImg, _, _ = spotMask(circleLocs, subImg.shape)
+        idealStdImg[labelImg > 0] = 50
         cvWindow("testIdeal", idealStdImg, False)
     print("pattern generated and saving now...")
     imageOutName = "standard_image.tiff"
@@ -287,72 +381,14 @@ def patternGen():
     out_file = open(jsonFileOutName, "w")
     json.dump(stdSpotDict, out_file)
     out_file.close()
+    # single file form of the same standard, loads without rebuilding masks
+    CircleDictionary(stdSpotDict["batch"], stdSpotDict["spot_info"],
+                     stdSpotDict["shape"], idealStdImg).save("standard_image.cdict")
 
-def templateMatch8b(image, pattern):
-    """ Core template matching algorithm to compare image to pattern
-
-    Calculates the correlation between the pattern and the image at all points
-    in 2d sliding window format weighs the correlations higher in the center of
-    the image where the spots should be.
-
-    Args:
-        image (np array): the image to be processed
-
-        pattern (np array): the pattern to be found in the image (circles)
-
-    Returns:
-        topLeftMatch (list): location of the best fit defined as the top left
-            coordinate within the image
-
-        verImg (np array): copy of the image in color with a rectangle drawn
-            where the pattern was best fit
-
-    """
-    imageCols, imageRows = image.shape[::-1]
-    stdCols, stdRows = pattern.shape[::-1]
-    print("pattern std shape: " + str(pattern.shape[::-1]))
-    # grab dimensions of input image and convert to 8bit for manipulation
-    image8b = cv2.normalize(image.copy(),
-                            np.zeros(shape=(imageRows, imageCols)),
-                            0, 255,
-                            norm_type=cv2.NORM_MINMAX,
-                            dtype=cv2.CV_8U)
-    verImg = cv2.cvtColor(image8b.copy(), cv2.COLOR_GRAY2RGB)
-
-    res = cv2.matchTemplate(image8b, pattern, cv2.TM_CCORR_NORMED)
-    _, _, _, max_loc = cv2.minMaxLoc(res)
-    gausCols, gausRows = res.shape[::-1]
-    print("max location REAL: " + str(max_loc))
-    print("gaus img shape: " + str(res.shape[::-1]))
-
-    x, y = np.meshgrid(range(gausCols), range(gausRows))
-    centerRow = int((imageRows - stdRows)/2) - 200
-    centerCol = int((imageCols - stdCols)/2)
-    print("center row and col" + " " + str(centerRow) + " " + str(centerCol))
-    # draws circle where the gaussian is centered.
-    cv2.circle(verImg, (centerCol, centerRow), 3, (0, 0, 255), 3)
-    sigma = 400  # inverse slope-- smaller = sharper peak, larger = dull peak
-    gausCenterWeight = np.exp(-((x-centerCol)**2 + (y-centerRow)**2) /
-                              (2.0 * sigma**2))
-    _, _, _, testCenter = cv2.minMaxLoc(gausCenterWeight)
-    print("gaussian center: " + str(testCenter))
-    weightedRes = res * gausCenterWeight
-    _, _, _, max_loc = cv2.minMaxLoc(weightedRes)
-    print(max_loc)  # max loc is reported as written as column,row...
-    bottomRightPt = (max_loc[0] + stdCols,
-                     max_loc[1] + stdRows)
-    # cv2.rectangle takes in positions as (column, row)....
-    cv2.rectangle(verImg,
-                  max_loc,
-                  bottomRightPt,
-                  (0, 105, 255),
-                  15)
-    # cvWindow("rectangle drawn", verImg, False)
-    topLeftMatch = max_loc  # col, row
-    return topLeftMatch, verImg
-        
 def main():
+    backendFromEnvironment()
     optionSelect()
+    exportFromEnvironment()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -8,6 +8,7 @@
     5) unique ID assigned to image and saved (based on date/time) as tiff
     6) Outlier Detection
 """
+import datetime
 import os, sys
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import (QApplication, 
@@ -18,7 +19,6 @@ import cv2
 import numpy as np
 import time
 import pyqtgraph as pg
-from pypylon import pylon
 from einsteinEncodedUI import Ui_MainWindow
 import easygui
 from cmdDevTools import (cvWindow,
@@ -28,6 +28,22 @@ from cmdDevTools import (cvWindow,
                          cameraSetVals,
                          singleCapture,
                          templateMatch8b)
+from spotAnalysis import quantifySpots, refineSpotCenters
+from circleDictionary import loadCircleDictionary
+from cameraSession import CameraSession
+from cameraBackend import backendFromEnvironment
+from frameTools import grabToArray, displayView, buildPreviews
+from capturePipeline import FrameRing, GrabThread
+from alignmentTracker import AlignmentTracker, drawOverlay
+from autoExposure import ExposureController
+from frameStacking import stackCapture
+from outlierDetection import flagOutliers, spotSignal, RunningSpotStats
+from resultsStore import ResultsStore
+from imageSource import ImageSource
+from templateBank import matchRotated, spotShifts
+import stageTiming
+from stageTiming import span
+from imageWriter import defaultWriter, acquisitionMetadata, uniqueImageID
 
 # will store these configs in a json file later for modification
 # Configs for video streaming, will be optimizable later
@@ -44,6 +60,106 @@ singleConfig = {'gain': 12,
                 'pixelform':'Mono12p',
                 'binval': 2}
 
+# touchscreen preview size and refresh cap for the live feed
+displaySize = (480, 320)
+maxDisplayFps = 15
+# region of interest of a full 3088x2064 frame, rows then cols
+previewCrop = (120, 1500, 650, 2200)
+fullscreenMs = 3000
+# longest exposure auto exposure may pick while live (us)
+maxVideoExpo = 2e5
+# app data lives next to the app, not in whatever directory it was started from
+dataDir = os.path.dirname(os.path.abspath(__file__))
+# per batch, per spot running statistics of every capture (outlierDetection)
+spotHistoryPath = os.path.join(dataDir, "spot_history.json")
+# every analyzed capture is appended here (resultsStore), opened on the first one
+resultsStorePath = os.path.join(dataDir, "results.db")
+
+
+class PreviewSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(int, object)
+
+
+class PreviewTask(QtCore.QRunnable):
+    """ builds the crop / thumbnail / fullscreen views off the UI thread """
+    def __init__(self, token, image, fullscreenSize):
+        super(PreviewTask, self).__init__()
+        self.token = token
+        self.image = image
+        self.fullscreenSize = fullscreenSize
+        self.signals = PreviewSignals()
+
+    def run(self):
+        previews = buildPreviews(self.image, previewCrop, displaySize,
+                                 self.fullscreenSize)
+        self.signals.done.emit(self.token, previews)
+
+
+class VideoWorker(QtCore.QThread):
+    """ Live feed for the touchscreen
+
+    Grabbing runs on its own GrabThread into a FrameRing at full camera rate.
+    This thread takes only the newest frame, bins it down to the display size
+    before it crosses into the UI thread, and emits it only when the UI has
+    drawn the previous one and the refresh cap allows, so stale frames are
+    skipped instead of queued. With a tracker (alignmentTracker) set, the
+    shown frames are also aligned and get the spot overlay drawn here. With
+    an exposure controller (autoExposure) set, every new frame steps it
+    until it settles.
+    """
+    frameReady = QtCore.pyqtSignal(object)
+    alignmentReady = QtCore.pyqtSignal(object)
+    exposureSettled = QtCore.pyqtSignal(object)
+
+    def __init__(self, camera, parent=None):
+        super(VideoWorker, self).__init__(parent)
+        self.camera = camera
+        self.ring = FrameRing(capacity=4)
+        self.grabber = GrabThread(camera, self.ring)
+        self.running = True
+        self.pending = False  # a preview is waiting to be drawn by the UI
+        self.shown = 0
+        self.tracker = None  # set from the UI thread, AlignmentTracker or None
+        self.exposure = None  # same, ExposureController or None
+
+    def run(self):
+        self.grabber.start()
+        frame = None
+        lastSeq = -1
+        lastEmit = 0.0
+        while self.running and self.grabber.is_alive():
+            seq, frame = self.ring.readLatest(lastSeq, frame, timeout=0.2)
+            if seq is None:
+                continue
+            lastSeq = seq
+            controller = self.exposure
+            if controller is not None and not controller.settled:
+                if controller.step(frame):
+                    self.exposureSettled.emit(controller)
+            now = time.monotonic()
+            if self.pending or now - lastEmit < 1.0 / maxDisplayFps:
+                continue
+            preview = cv2.resize(displayView(frame), displaySize,
+                                 interpolation=cv2.INTER_AREA)
+            tracker = self.tracker
+            if tracker is not None:
+                offset, confidence, rematched = tracker.update(frame)
+                preview = drawOverlay(preview, tracker.spotInfo, offset, frame.shape)
+                self.alignmentReady.emit((offset, confidence, rematched))
+            self.pending = True
+            lastEmit = now
+            self.frameReady.emit(preview)
+        self.grabber.stop()
+
+    def frameShown(self):
+        self.pending = False
+        self.shown = self.shown + 1
+
+    def stop(self):
+        self.running = False
+        self.wait()
+        return self.grabber.stats()
+
 
 class MainWindow(QMainWindow, Ui_MainWindow):
     def __init__(self, parent=None):
@@ -51,6 +167,39 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         
         self.videoOn = False
+        self.videoWorker = None
+        self.previewToken = 0
+        self.previewFlags = (True, True)
+        self.fullscreenLabel = QtWidgets.QLabel()
+        self.fullscreenLabel.setAlignment(QtCore.Qt.AlignCenter)
+        self.fullscreenLabel.setStyleSheet("background-color: black")
+        self.fullscreenLabel.mousePressEvent = lambda event: self.fullscreenLabel.hide()
+        self.fullscreenTimer = QtCore.QTimer(self)
+        self.fullscreenTimer.setSingleShot(True)
+        self.fullscreenTimer.timeout.connect(self.fullscreenLabel.hide)
+        self.circleDict = None
+        self.spotTable = None
+        self.spotCenters = None
+        self.spotFlags = None
+        self.spotHistory = RunningSpotStats.load(spotHistoryPath)
+        self.resultsStore = None
+        self.tracker = None
+        # what the current image is, saved with it (imageWriter.acquisitionMetadata)
+        self.imageSource = None
+        self.imageConfig = None
+        self.matchOffset = None
+        # capture time (unix seconds) and the id saveImage names the file with,
+        # so the results store row and the saved tiff belong together
+        self.captured = None
+        self.imageID = None
+        # stage timings in the status bar while tracing is on (stageTiming)
+        self.timingTimer = QtCore.QTimer(self)
+        self.timingTimer.timeout.connect(self.showTimings)
+        if stageTiming.isEnabled():
+            self.timingTimer.start(1000)
+        # device is opened on first use and kept open until the window closes
+        self.cameraSession = CameraSession({'video': videoConfig,
+                                            'single': singleConfig})
         self.videoToggleButton.clicked.connect(self.videoToggle)
         self.shotButton.clicked.connect(self.singleCapture)
         self.saveButton.clicked.connect(self.saveImage)
@@ -61,6 +210,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         
         self.actionon.triggered.connect(self.autoOn)
         self.actionoff.triggered.connect(self.autoOff)
+        # single capture as a stack of short frames instead of one long exposure
+        self.actionStacked = QtWidgets.QAction("Stacked capture", self, checkable=True)
+        self.menuCamera_Seetings.addAction(self.actionStacked)
+        # template bank match for turned or rescaled cartridges (templateBank)
+        self.actionRotated = QtWidgets.QAction("Rotation tolerant match", self, checkable=True)
+        self.menuCamera_Seetings.addAction(self.actionRotated)
     
         self.plotting_widget.setLayout(QVBoxLayout())
         self.im_widget = pg.ImageView(self)
@@ -76,44 +231,129 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def videoToggle(self):
         if self.videoOn:
-            self.editTextBox("live stream off")
+            stats = self.videoWorker.stop()
+            self.videoWorker = None
+            self.editTextBox("live stream off, " + str(round(stats["fps"], 1)) + " fps")
             self.videoOn = False
         else:
+            self.cameraSession.open().applyProfile('video')
+            self.videoWorker = VideoWorker(self.cameraSession.camera, self)
+            self.videoWorker.frameReady.connect(self.showLiveFrame)
+            self.videoWorker.alignmentReady.connect(self.showAlignment)
+            self.videoWorker.exposureSettled.connect(self.exposureSettled)
+            self.videoWorker.tracker = self.tracker
+            self.videoWorker.start()
             self.editTextBox("live stream on")
             self.videoOn = True
 
+    def showLiveFrame(self, preview):
+        """ runs on the UI thread, preview is already display sized (gray,
+            or RGB with the alignment overlay)
+        """
+        self.im_widget.setImage(preview.swapaxes(0, 1), autoLevels=False,
+                                levels=(0, 255), autoRange=False)
+        if self.videoWorker is not None:
+            self.videoWorker.frameShown()
+
     def singleCapture(self):
-        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-        self.camera.Open()
-        self.camera = cameraSetVals(self.camera)
-        buffer = self.camera.grabOne(int(singleConfig['expo']*1.1))
-        if not buffer:
-            raise RuntimeError("Camera failed to capture single image")
-        self.image = buffer2image(buffer)
-        self.displayImageFullScreen(self.image)
-        self.displayImageInWindow(self.image)
+        if self.videoOn:
+            # the camera can't grab a single frame while streaming
+            self.videoToggle()
+        capturedAt = datetime.datetime.now()
+        if self.actionStacked.isChecked():
+            self.image = self.stackedCapture()
+        else:
+            buffer = self.cameraSession.open().grabOne('single')
+            # full sensor depth (Mono12p -> uint16), only the previews go to 8 bit.
+            # unpacked into the session's reused buffer: the next capture
+            # overwrites this frame in place, saveImage's writer copies it
+            self.image = grabToArray(buffer, self.cameraSession.unpacker)
+            buffer.Release()
+            self.imageSource = "singleCapture"
+            self.imageConfig = self.cameraSession.profiles['single']
+        self.captured = capturedAt.timestamp()
+        self.imageID = uniqueImageID(capturedAt)
+        self.matchOffset = None
+        self.displayImage(self.image)
         self.editTextBox("Captured. Save it!")
+        if self.circleDict is not None:
+            self.analyzeImage()
     
+    def stackedCapture(self):
+        """ the single profile's exposure split over short frames and
+            accumulated in place (frameStacking). with a circle dictionary it
+            stops once the spots reach the SNR target. the result is a float32
+            HDR frame in single exposure units, bright spots don't clip
+        """
+        spotInfo = shape = locate = None
+        if self.circleDict is not None:
+            spotInfo = self.circleDict.spotInfo
+            shape = self.circleDict.shape
+            locate = lambda frame: templateMatch8b(frame, self.template)[0]
+        result = stackCapture(self.cameraSession, 'single', spotInfo=spotInfo,
+                              shape=shape, locate=locate)
+        self.imageSource = "stackedCapture"
+        self.imageConfig = dict(self.cameraSession.profiles['stacked'],
+                                frames=result["frames"])
+        print("stacked " + str(result["frames"]) + " frames, stopped on " + result["stopped"])
+        return result["hdr"]
+
     def saveImage(self):
-        fileName = self.lineEdit.text()
-        fileName = fileName + ".tiff"
-        cv2.imwrite(fileName, self.image)
-        self.editTextBox(fileName + " has been saved")
+        """ queues the image on the background writer (imageWriter) so the
+            next capture never waits on the disk. the name is the text box
+            plus a date/time unique id, e.g. leptin-1_20201012-153012-004211-000.
+            captures keep the id they got when grabbed, the one their results
+            store row refers to
+        """
+        if getattr(self, "image", None) is None:
+            self.editTextBox("Nothing to save yet")
+            return
+        prefix = self.lineEdit.text()
+        imageID = self.imageID if self.imageID is not None else uniqueImageID()
+        fileName = (prefix + "_" if prefix else "") + imageID
+        batch = self.circleDict.batch if self.circleDict is not None else None
+        metadata = acquisitionMetadata(self.imageConfig, self.imageSource,
+                                       batch, self.matchOffset)
+        filePath = defaultWriter().submit(self.image, fileName, metadata, imageID=imageID)
+        self.editTextBox(os.path.basename(filePath) + " is being saved")
+
+    def displayImage(self, imageToShow, inWindow=True, fullscreen=True):
+        """ builds every preview of the image once, in the background, then
+            shows them without blocking the UI (see showPreviews). a newer
+            call supersedes previews still being built for an older image
+        """
+        self.previewToken = self.previewToken + 1
+        self.previewFlags = (inWindow, fullscreen)
+        screen = QApplication.primaryScreen().size()
+        task = PreviewTask(self.previewToken, imageToShow,
+                           (screen.width(), screen.height()))
+        task.signals.done.connect(self.showPreviews)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def showPreviews(self, token, previews):
+        if token != self.previewToken:
+            return
+        inWindow, fullscreen = self.previewFlags
+        if inWindow:
+            self.im_widget.setImage(previews["thumbnail"].transpose())
+        if fullscreen:
+            self.displayImageFullscreen(previews["fullscreen"])
 
     def displayImageInWindow(self, imageToShow):
-        cropImage = self.imageCenterCrop(imageToShow)
-        resizedImg = cv2.resize(cropImage, (480, 320))
-        self.im_widget.setImage(resizedImg.transpose())
-
-    def displayImageFullscreen(self,imageToShow):
-        windowName = "fullscreen image"
-        cv2.namedWindow(windowName, cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty(windowName, cv2.WND_PROP_FULLSCREEN, 
-                              cv2.WINDOW_FULLSCREEN)
-        resizedImg = cv2.resize(imageToShow, (480, 320))
-        cv2.imshow(windowName, imageToShow)
-        cv2.waitKey(3000)
-        cv2.destroyAllWindows()
+        self.displayImage(imageToShow, inWindow=True, fullscreen=False)
+
+    def displayImageFullscreen(self, imageToShow):
+        """ shows an 8 bit, screen sized image fullscreen for fullscreenMs,
+            tap or wait to return. does not block the event loop
+        """
+        imageToShow = np.ascontiguousarray(displayView(imageToShow))
+        qImage = QtGui.QImage(imageToShow.data,
+                              imageToShow.shape[1], imageToShow.shape[0],
+                              imageToShow.strides[0],
+                              QtGui.QImage.Format_Grayscale8).copy()
+        self.fullscreenLabel.setPixmap(QtGui.QPixmap.fromImage(qImage))
+        self.fullscreenLabel.showFullScreen()
+        self.fullscreenTimer.start(fullscreenMs)
 
     def imageCenterCrop(self, image):
         """ Takes a full 3088x2064 basler output image
@@ -122,43 +362,163 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             650, 120 to 2200, 1500. will need to change later.
             final size 700 x 430
         """
-        croppedImage = image[120:1500, 650:2200]
+        croppedImage = image[previewCrop[0]:previewCrop[1], previewCrop[2]:previewCrop[3]]
         return croppedImage
 
     def openImage(self):
         filePath = openImgFile()
         self.editTextBox("opening " + str(filePath))
-        self.image = cv2.imread(filePath, 0)        
-        self.displayImageFullscreen(self.image)
-        self.displayImageInWindow(self.image)
+        # full depth, memory mapped or decoded strip by strip (imageSource)
+        image = ImageSource(filePath).level(0)
+        if image.ndim == 3:
+            image = cv2.cvtColor(np.ascontiguousarray(image[:, :, :3]), cv2.COLOR_RGB2GRAY)
+        self.image = image
+        self.imageSource = filePath
+        self.imageConfig = None
+        self.captured = None
+        self.imageID = None
+        self.matchOffset = None
+        self.displayImage(self.image)
         self.editTextBox("image opened")
+        if self.circleDict is not None:
+            self.analyzeImage()
 
     def circleDictUpload(self):
         """ 
-            currently takes in the template image that needs to be matched.
-            implementing json later...
+            takes in a circle dictionary: a .cdict (template, spots and masks
+            in one memory mapped file), or the template image patternGen made
+            with its spot_info json next to it (same name, .json)
         """
         filePath = openImgFile()
         self.editTextBox("opening " + str(filePath))
-        self.template = cv2.imread(filePath, 0)        
-        self.displayImageFullscreen(self.template)
-        self.editTextBox("circle dictionary uploaded")
+        try:
+            self.circleDict = loadCircleDictionary(filePath)
+        except (OSError, ValueError, KeyError) as err:
+            self.editTextBox("could not load circle dictionary: " + str(err))
+            return
+        self.template = self.circleDict.template
+        self.displayImage(self.template, inWindow=False)
+        self.editTextBox("circle dictionary uploaded, " + str(len(self.circleDict)) + " spots")
 
     def autoOn(self):
-        if self.template.any() and self.image.any():
-            print("yahtzee")
-        else:
-            self.editTextBox("You need to upload image and template")
-        pass
-    
+        """ auto settings on the live feed: exposure and gain are adjusted
+            from the frames' histograms until they settle, then handed to the
+            single capture profile (autoExposure). with a circle dictionary
+            loaded the feed also follows the template match (full match once,
+            then phase correlation per frame, see alignmentTracker) and draws
+            the spots on it
+        """
+        if not self.videoOn:
+            self.videoToggle()
+        videoProfile = dict(videoConfig)
+        self.cameraSession.profiles['video'] = videoProfile
+        self.videoWorker.exposure = ExposureController(
+            videoProfile, lambda config: self.cameraSession.applyProfile('video'),
+            expoLimit=maxVideoExpo)
+        if self.circleDict is not None:
+            self.tracker = AlignmentTracker(self.template, self.circleDict.spotInfo)
+            self.videoWorker.tracker = self.tracker
+        self.editTextBox("auto settings on")
+
     def autoOff(self):
-        pass
+        self.tracker = None
+        if self.videoWorker is not None:
+            self.videoWorker.tracker = None
+            self.videoWorker.exposure = None
+        self.editTextBox("auto settings off")
+
+    def exposureSettled(self, controller):
+        self.cameraSession.profiles['single'] = controller.handOff(singleConfig)
+        single = self.cameraSession.profiles['single']
+        self.editTextBox("exposure set: single capture " + str(round(single['expo'] / 1000))
+                         + " ms, gain " + str(round(single['gain'], 1)) + " dB")
+
+    def showAlignment(self, alignment):
+        offset, confidence, rematched = alignment
+        self.editTextBox("aligned at " + str(offset) + ("  re-matched" if rematched else
+                         "  confidence " + str(round(confidence, 2))))
+
+    def showTimings(self):
+        self.statusbar.showMessage(stageTiming.statusText())
+
+    def closeEvent(self, event):
+        stageTiming.exportFromEnvironment()
+        if self.videoOn:
+            self.videoToggle()
+        self.fullscreenLabel.close()
+        self.cameraSession.close()
+        defaultWriter().flush()
+        if self.spotHistory.changed:
+            self.spotHistory.save()
+        if self.resultsStore is not None:
+            self.resultsStore.close()
+        super(MainWindow, self).closeEvent(event)
 
     def analyzeImage(self):
-        self.editTextBox("Function not yet implemented")
+        """ matches the template to the current image, then quantifies every
+            spot in the circle dictionary at once (see spotAnalysis.quantifySpots)
+            each spot's center is refined around the match first, so drift
+            within the array is followed. with 'Rotation tolerant match' on the
+            template bank match (templateBank) places the spots, turned and
+            scaled with the chip. results are kept in self.spotTable
+            and self.spotCenters, one row per spot, outlier flags in
+            self.spotFlags (outlierDetection)
+        """
+        if getattr(self, "image", None) is None or self.circleDict is None:
+            self.editTextBox("You need to upload image and circle dictionary")
+            return
+        spotInfo = self.circleDict.spotInfo
+        matchShifts = np.zeros((len(spotInfo), 2), dtype=np.int64)
+        matchNote = ""
+        if self.actionRotated.isChecked():
+            # turned / scaled chip: each spot moves from the plain offset.
+            # a weak bank match already fell back to templateMatch8b
+            match = matchRotated(self.image, self.template)
+            topLeftMatch = match["offset"]
+            matchShifts = spotShifts(spotInfo, self.template.shape, match)
+            print("match " + match["method"] + " angle " + str(round(match["angle"], 2))
+                  + " scale " + str(round(match["scale"], 3)) + " confidence "
+                  + str(round(match["confidence"], 2)))
+            if match["method"] == "templateMatch8b":
+                matchNote = "weak rotated match, plain match used. "
+        else:
+            topLeftMatch, _ = templateMatch8b(self.image, self.template)
+        self.matchOffset = topLeftMatch
+        expectedSpots = np.column_stack((spotInfo[:, :2] + matchShifts, spotInfo[:, 2]))
+        self.spotCenters = refineSpotCenters(self.image, topLeftMatch, expectedSpots)
+        self.spotTable = quantifySpots(self.image,
+                                       topLeftMatch,
+                                       spotInfo,
+                                       self.circleDict.shape,
+                                       spotShifts=matchShifts + np.column_stack(
+                                           (self.spotCenters["dx"], self.spotCenters["dy"])))
+        # replicates that disagree within the array, then spots that moved
+        # away from their own history. only captures go into the history
+        self.spotFlags = flagOutliers(self.spotTable, self.circleDict.spotInfo)
+        signal = spotSignal(self.spotTable)
+        _, drifted = self.spotHistory.score(self.circleDict.batch, signal)
+        if self.imageSource in ("singleCapture", "stackedCapture"):
+            self.spotHistory.update(self.circleDict.batch, signal,
+                                    exclude=self.spotFlags["outlier"])
+            if self.resultsStore is None:
+                self.resultsStore = ResultsStore(resultsStorePath)
+            self.resultsStore.addResults([{
+                "spotTable": self.spotTable,
+                "match": topLeftMatch,
+                "file": self.imageID,
+                "captured": self.captured,
+                "batch": self.circleDict.batch,
+                "device": str(self.cameraSession.camera.GetDeviceInfo().GetSerialNumber()),
+                "metadata": acquisitionMetadata(self.imageConfig, self.imageSource,
+                                                id=self.imageID)}])
+        self.editTextBox(matchNote + "spots: " + str(round(np.nanmean(self.spotTable["mean"]), 1))
+                         + " bg: " + str(round(np.nanmean(self.spotTable["bgMedian"]), 1))
+                         + " outliers: " + str(int(self.spotFlags["outlier"].sum()))
+                         + "/" + str(int(drifted.sum())))
     
         
 def main():
+    backendFromEnvironment()
     if not QApplication.instance():
         app = QApplication(sys.argv)
     else:
@@ -0,0 +1,239 @@
+"""
+Stacked capture, the alternative to one long single capture exposure. The
+exposure is split over up to N short frames grabbed one by one; each frame is
+added in place to a preallocated uint32 running sum and float32 running
+variance (Welford), so no frame list is kept. Short frames saturate far less,
+and with a circle dictionary the capture stops as soon as enough spots reach
+the SNR target:
+1) FrameStack: running sum / variance / clipped count of every pixel
+2) SpotSnr: running background subtracted signal of every spot and its SNR
+3) stackCapture: grabs through a CameraSession, returns the HDR frame
+
+    result = stackCapture(session, 'single', spotInfo=circleDict.spotInfo,
+                          shape=circleDict.shape, locate=findOffset)
+    image = result["hdr"]   # float32, in units of the full single exposure
+"""
+
+import numpy as np
+
+from cameraBackend import getBackend
+from frameTools import grabToArray, pixelBits
+from spotAnalysis import spotMask, backgroundPixels
+from stageTiming import span, count
+
+stackingConfig = {"frames": 16,          # most short frames per capture
+                  "minFrames": 4,        # before the SNR check may stop it
+                  "targetSnr": 50.0,     # spot signal / its standard error
+                  "spotFraction": 0.9}   # of spots that must reach targetSnr
+
+
+def stackedProfile(profile, frames):
+    """ copy of profile (videoConfig format) with its exposure split over frames """
+    config = dict(profile)
+    config["expo"] = profile["expo"] / float(frames)
+    return config
+
+
+class FrameStack():
+    """ Running per pixel sum and variance of frames of one shape
+
+    Args:
+        shape (tuple): (rows, cols) of the frames
+
+        bits (int): sensor bits, frames at (1 << bits) - 1 count as clipped
+    """
+    def __init__(self, shape, bits=12):
+        self.shape = tuple(shape)
+        self.fullScale = (1 << bits) - 1
+        self.count = 0
+        self.sum = np.zeros(self.shape, dtype=np.uint32)
+        self.m2 = np.zeros(self.shape, dtype=np.float32)
+        self.clipped = np.zeros(self.shape, dtype=np.uint16)
+        # scratch for the update, so add() allocates nothing frame sized
+        self._before = np.zeros(self.shape, dtype=np.float32)
+        self._after = np.empty(self.shape, dtype=np.float32)
+        self._atFull = np.empty(self.shape, dtype=bool)
+
+    def add(self, frame):
+        """ adds one frame in place: m2 += (x - old mean) * (x - new mean) """
+        if self.count:
+            np.multiply(self.sum, 1.0 / self.count, out=self._before,
+                        dtype=np.float32, casting="unsafe")
+        np.add(self.sum, frame, out=self.sum, casting="unsafe")
+        self.count = self.count + 1
+        np.multiply(self.sum, 1.0 / self.count, out=self._after,
+                    dtype=np.float32, casting="unsafe")
+        np.subtract(frame, self._before, out=self._before)
+        np.subtract(frame, self._after, out=self._after)
+        np.multiply(self._before, self._after, out=self._before)
+        np.add(self.m2, self._before, out=self.m2)
+        np.greater_equal(frame, self.fullScale, out=self._atFull)
+        np.add(self.clipped, self._atFull, out=self.clipped, casting="unsafe")
+
+    def mean(self):
+        return np.multiply(self.sum, 1.0 / max(self.count, 1), dtype=np.float32,
+                           casting="unsafe")
+
+    def variance(self):
+        """ per pixel sample variance of the frames, zero below two frames """
+        if self.count < 2:
+            return np.zeros(self.shape, dtype=np.float32)
+        return self.m2 / np.float32(self.count - 1)
+
+    def hdr(self, scale=1.0):
+        """ mean frame times scale, float32 and unclipped. with scale the
+            number of frames the exposure was split over, pixel values are
+            those of the one long exposure, past the sensor's full scale
+        """
+        return np.multiply(self.sum, scale / max(self.count, 1), dtype=np.float32,
+                           casting="unsafe")
+
+
+class SpotSnr():
+    """ Running background subtracted signal of every spot
+
+    The spot and background annulus pixels are located once (at offset),
+    after that every frame is two bincounts.
+
+    Args:
+        spotInfo (list or np array): [x, y, r] per spot
+
+        shape (tuple): (rows, cols) of the pattern
+
+        offset (tuple): topLeftMatch (col, row) of the pattern in the frames
+
+        frameShape (tuple): (rows, cols) of the frames
+    """
+    def __init__(self, spotInfo, shape, offset, frameShape):
+        _, pixelIdx, pixelLabels = spotMask(spotInfo, shape)
+        spotYs, spotXs = np.divmod(pixelIdx, int(shape[1]))
+        bgXs, bgYs, bgLabels = backgroundPixels(spotInfo, shape)
+        self.numSpots = len(np.asarray(spotInfo).reshape(-1, 3))
+        self.spotIdx, self.spotLabels = self._flat(spotXs, spotYs, pixelLabels,
+                                                   offset, frameShape)
+        self.bgIdx, self.bgLabels = self._flat(bgXs, bgYs, bgLabels, offset, frameShape)
+        minlength = self.numSpots + 1
+        with np.errstate(divide="ignore"):
+            self.spotScale = 1.0 / np.bincount(self.spotLabels, minlength=minlength)
+            self.bgScale = 1.0 / np.bincount(self.bgLabels, minlength=minlength)
+        self.count = 0
+        self.mean = np.zeros(self.numSpots)
+        self.m2 = np.zeros(self.numSpots)
+
+    @staticmethod
+    def _flat(xs, ys, labels, offset, frameShape):
+        xs = xs + int(offset[0])
+        ys = ys + int(offset[1])
+        inFrame = (xs >= 0) & (xs < frameShape[1]) & (ys >= 0) & (ys < frameShape[0])
+        return ys[inFrame] * int(frameShape[1]) + xs[inFrame], labels[inFrame]
+
+    def add(self, frame):
+        pixels = frame.ravel()
+        minlength = self.numSpots + 1
+        with np.errstate(invalid="ignore"):
+            spotMeans = np.bincount(self.spotLabels, weights=pixels[self.spotIdx],
+                                    minlength=minlength) * self.spotScale
+            bgMeans = np.bincount(self.bgLabels, weights=pixels[self.bgIdx],
+                                  minlength=minlength) * self.bgScale
+        signal = (spotMeans - bgMeans)[1:]
+        self.count = self.count + 1
+        delta = signal - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (signal - self.mean)
+
+    def snr(self):
+        """ |mean signal| / its standard error per spot, nan below two frames
+            or for spots outside the frame
+        """
+        if self.count < 2:
+            return np.full(self.numSpots, np.nan)
+        standardError = np.sqrt(self.m2 / (self.count - 1) / self.count)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.abs(self.mean) / standardError
+
+
+def stackCapture(session, profileName, frames=None, minFrames=None, targetSnr=None,
+                 spotFraction=None, spotInfo=None, shape=None, offset=None,
+                 locate=None, timeoutMs=None):
+    """ one stacked capture in place of a single long exposure
+
+    The profile's exposure is split over frames short exposures (gain is
+    kept). Grabbing stops after frames frames, or earlier once spotFraction
+    of the spots reach targetSnr (when spotInfo and shape are given).
+
+    Args:
+        session (CameraSession): open or openable session holding profileName
+
+        profileName (str): the long exposure profile, e.g. 'single'
+
+        frames, minFrames, targetSnr, spotFraction: see stackingConfig
+
+        spotInfo (list or np array): [x, y, r] per spot, enables early stopping
+
+        shape (tuple): (rows, cols) of the pattern
+
+        offset (tuple): topLeftMatch (col, row) of the pattern, or None to
+            call locate(firstFrame) for it
+
+        locate (callable): locate(frame) -> offset, e.g. a template match
+
+    Returns:
+        result (dict): hdr (float32, long exposure units), variance (per
+            pixel, of a short frame), clipped (frames each pixel was at full
+            scale), frames (grabbed), snr (per spot or None), offset,
+            frameExpo (us) and stopped ('snr' or 'frames')
+    """
+    frames = stackingConfig["frames"] if frames is None else frames
+    minFrames = stackingConfig["minFrames"] if minFrames is None else minFrames
+    targetSnr = stackingConfig["targetSnr"] if targetSnr is None else targetSnr
+    spotFraction = stackingConfig["spotFraction"] if spotFraction is None else spotFraction
+    profile = session.profiles[profileName]
+    session.profiles["stacked"] = stackedProfile(profile, frames)
+    session.open().applyProfile("stacked")
+    camera = session.camera
+    backend = getBackend() if session.backend is None else session.backend
+    frameExpo = session.profiles["stacked"]["expo"]
+    if timeoutMs is None:
+        # ExposureTime is in us, the grab timeout in ms
+        timeoutMs = int(max(frameExpo * 2.2 / 1000, 1000))
+    unpacker = session.unpacker
+    stack = None
+    spots = None
+    frame = None
+    stopped = "frames"
+    if camera.IsGrabbing():
+        camera.StopGrabbing()
+    with span("capture"):
+        camera.StartGrabbing(backend.oneByOne)
+        try:
+            while stack is None or stack.count < frames:
+                grabResult = camera.RetrieveResult(timeoutMs, backend.timeoutThrow)
+                try:
+                    frame = grabToArray(grabResult, unpacker, out=frame)
+                finally:
+                    grabResult.Release()
+                if stack is None:
+                    stack = FrameStack(frame.shape, pixelBits.get(profile.get("pixelform"), 12))
+                    if spotInfo is not None and shape is not None:
+                        if offset is None and locate is not None:
+                            offset = tuple(int(each) for each in locate(frame))
+                        if offset is not None:
+                            spots = SpotSnr(spotInfo, shape, offset, frame.shape)
+                stack.add(frame)
+                count("stack/frames")
+                if spots is not None:
+                    spots.add(frame)
+                    if stack.count >= minFrames and \
+                            np.mean(spots.snr() >= targetSnr) >= spotFraction:
+                        stopped = "snr"
+                        break
+        finally:
+            camera.StopGrabbing()
+    return {"hdr": stack.hdr(frames),
+            "variance": stack.variance(),
+            "clipped": stack.clipped,
+            "frames": stack.count,
+            "snr": spots.snr() if spots is not None else None,
+            "offset": offset,
+            "frameExpo": frameExpo,
+            "stopped": stopped}
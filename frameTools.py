@@ -0,0 +1,164 @@
+"""
+Full bit depth frame path. Frames stay at sensor depth (Mono12p -> uint16,
+0-4095) from the grab through quantification; only the display and matching
+views are brought down to 8 bit, and only when they are needed:
+1) FrameUnpacker: vectorized Mono12p unpacking into a reused uint16 buffer
+2) grabToArray: full depth array of a grab result, one copy at most
+3) displayView: 8 bit view of a full depth frame for imshow / the touchscreen
+4) buildPreviews: every display resolution view of a frame, built once
+"""
+
+import cv2
+import numpy as np
+
+from cameraBackend import pylon
+from stageTiming import timed
+
+# bits actually used in each format's container
+pixelBits = {"Mono8": 8, "Mono10": 10, "Mono12": 12, "Mono12p": 12, "Mono16": 16}
+packedFormats = ("Mono12p",)
+
+
+def grabPixelFormat(grabResult):
+    """ pixel format name of a grab result, pylon enums mapped to names """
+    pixelType = grabResult.GetPixelType()
+    if isinstance(pixelType, str):
+        return pixelType
+    for name in pixelBits:
+        if pylon is not None and getattr(pylon, "PixelType_" + name, None) == pixelType:
+            return name
+    raise ValueError("unsupported pixel type " + str(pixelType))
+
+
+class FrameUnpacker():
+    """ Mono12p -> uint16 unpacker that reuses its buffers
+
+    Mono12p packs two 12 bit pixels into 3 bytes, lsb first:
+        byte0 = p0[7:0], byte1 = p1[3:0] << 4 | p0[11:8], byte2 = p1[11:4]
+    All pixels are unpacked with a handful of in place array ops on views of
+    the raw payload, writing into out (or an internal buffer). Nothing is
+    allocated once the buffers exist for a frame size.
+    """
+    def __init__(self):
+        self.frame = None
+        self.scratch = None
+
+    def unpack(self, raw, shape, out=None):
+        """ Args:
+                raw (bytes, memoryview or np array): packed Mono12p payload
+
+                shape (tuple): (rows, cols) of the frame
+
+                out (np array): uint16 destination, default: internal buffer
+                    (overwritten by the next call)
+
+            Returns:
+                frame (np array): uint16 frame, 0-4095
+        """
+        rows, cols = shape
+        numPixels = rows * cols
+        if out is None:
+            if self.frame is None or self.frame.shape != (rows, cols):
+                self.frame = np.empty((rows, cols), dtype=np.uint16)
+            out = self.frame
+        if self.scratch is None or len(self.scratch) != (numPixels + 1) // 2:
+            self.scratch = np.empty((numPixels + 1) // 2, dtype=np.uint8)
+        packed = np.frombuffer(raw, dtype=np.uint8,
+                               count=(numPixels * 3 + 1) // 2)
+        if numPixels % 2:
+            # odd pixel count: last group only holds two bytes
+            lastPixel = packed[-2] | ((packed[-1] & 0x0F).astype(np.uint16) << 8)
+            packed = packed[:-2]
+        packed = packed.reshape(-1, 3)
+        flat = out.reshape(-1)
+        even = flat[0:numPixels - numPixels % 2:2]
+        odd = flat[1::2]
+        scratch = self.scratch[:len(packed)]
+        np.copyto(even, packed[:, 1])
+        even &= 0x0F
+        even <<= 8
+        np.bitwise_or(even, packed[:, 0], out=even)
+        np.copyto(odd, packed[:, 2])
+        odd <<= 4
+        np.right_shift(packed[:, 1], 4, out=scratch)
+        np.bitwise_or(odd, scratch, out=odd)
+        if numPixels % 2:
+            flat[-1] = lastPixel
+        return out
+
+
+@timed("convert")
+def grabToArray(grabResult, unpacker=None, out=None):
+    """ Full bit depth array of a grab result
+
+    Packed formats are unpacked straight from the raw payload, into out or
+    the unpacker's buffer, which the next call with that unpacker
+    overwrites: pass out, or copy, to keep a frame past the next grab.
+    Unpacked formats are copied once, since the grab buffer goes back to the
+    driver on Release: into out through a zero copy view (pypylon
+    GetArrayZeroCopy, only valid until the view is closed), or without out
+    into a new array from GetArray().
+
+    Returns:
+        frame (np array): uint8 (Mono8) or uint16 (everything deeper)
+    """
+    pixelFormat = grabPixelFormat(grabResult)
+    if pixelFormat in packedFormats:
+        unpacker = FrameUnpacker() if unpacker is None else unpacker
+        shape = (grabResult.Height, grabResult.Width)
+        return unpacker.unpack(grabResult.GetBuffer(), shape, out)
+    if out is None:
+        return grabResult.GetArray()
+    if hasattr(grabResult, "GetArrayZeroCopy"):
+        with grabResult.GetArrayZeroCopy() as array:
+            np.copyto(out, array)
+        return out
+    np.copyto(out, grabResult.GetArray())
+    return out
+
+
+def displayView(frame, bits=None, out=None):
+    """ 8 bit view for display. uint8 frames are returned as is (no copy),
+        deeper frames are shifted down by (bits - 8), 12 bits by default
+        for uint16 since that is what the sensor delivers. float frames
+        (stacked HDR captures) are scaled the same way and clipped
+    """
+    if frame.dtype == np.uint8:
+        return frame
+    if bits is None:
+        bits = 12 if frame.dtype in (np.uint16, np.float32, np.float64) else 16
+    if out is None:
+        out = np.empty(frame.shape, dtype=np.uint8)
+    if frame.dtype.kind == "f":
+        np.clip(frame * (1.0 / (1 << (bits - 8))), 0, 255, out=out, casting="unsafe")
+        return out
+    np.right_shift(frame, bits - 8, out=out, casting="unsafe")
+    return out
+
+
+def buildPreviews(frame, cropBox, thumbSize, fullscreenSize):
+    """ Every display view of a frame from one 8 bit conversion
+
+    Args:
+        frame (np array): image at any bit depth
+
+        cropBox (tuple): (rowStart, rowEnd, colStart, colEnd) region of interest
+
+        thumbSize (tuple): (cols, rows) of the in-window thumbnail, e.g. 480x320
+
+        fullscreenSize (tuple): (cols, rows) of the screen, the whole frame is
+            fit inside it keeping its aspect ratio
+
+    Returns:
+        previews (dict): 'crop' (view, no copy), 'thumbnail' and 'fullscreen'
+    """
+    view8b = displayView(frame)
+    rowStart, rowEnd, colStart, colEnd = cropBox
+    crop = view8b[rowStart:rowEnd, colStart:colEnd]
+    if crop.size == 0:
+        crop = view8b
+    thumbnail = cv2.resize(crop, tuple(thumbSize), interpolation=cv2.INTER_AREA)
+    fit = min(fullscreenSize[0] / view8b.shape[1], fullscreenSize[1] / view8b.shape[0])
+    fitSize = (max(int(view8b.shape[1] * fit), 1), max(int(view8b.shape[0] * fit), 1))
+    fullscreen = cv2.resize(view8b, fitSize, interpolation=cv2.INTER_AREA)
+    return {"crop": crop, "thumbnail": thumbnail, "fullscreen": fullscreen}
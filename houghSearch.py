@@ -0,0 +1,192 @@
+"""
+Automatic Hough parameter search for patternGen. Instead of hand tuning
+houghParams for every new batch, a grid of HoughCircles settings is run on a
+process pool and every candidate detection is scored on:
+1) spot count: closeness to the expected number of spots (or, without one,
+   to the count most candidates agree on)
+2) lattice regularity: spread of nearest neighbour distances, overlaps
+3) radius consistency: spread of the detected radii
+
+the best candidate's spot_info comes back with the ranked report.
+
+usage:
+    python houghSearch.py array_crop.tiff --expected 24 --report hough_report.json
+"""
+
+import argparse
+import itertools
+import json
+import sys
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+# searched values, the current houghParams are in every range
+houghGrid = {"minDist": [40, 50, 60, 80],
+             "param1": [8, 10, 12, 16, 20],
+             "param2": [12, 14, 17, 20, 24],
+             "radius": [(20, 26), (22, 28), (24, 29), (26, 32), (28, 36)]}
+scoreWeights = {"count": 0.5,
+                "lattice": 0.3,
+                "radius": 0.2}
+
+# per worker process state, filled in by initWorker
+_workerState = {}
+
+
+def houghCandidates(grid=None):
+    """ every combination in grid as a houghParams style dict """
+    grid = houghGrid if grid is None else grid
+    candidates = []
+    for minDist, param1, param2, (minRadius, maxRadius) in itertools.product(
+            grid["minDist"], grid["param1"], grid["param2"], grid["radius"]):
+        candidates.append({"minDist": minDist,
+                           "param1": param1,
+                           "param2": param2,
+                           "minRadius": minRadius,
+                           "maxRadius": maxRadius})
+    return candidates
+
+
+def detectCircles(smoothImg, params):
+    """ HoughCircles as patternGen runs it, on an already median blurred image
+
+    Returns:
+        circles (np array): (n, 3) int32 [x, y, r] per spot, spot_info style
+    """
+    circles = cv2.HoughCircles(smoothImg,
+                               cv2.HOUGH_GRADIENT, 1,
+                               minDist=params["minDist"],
+                               param1=params["param1"],
+                               param2=params["param2"],
+                               minRadius=params["minRadius"],
+                               maxRadius=params["maxRadius"])
+    if circles is None:
+        return np.zeros((0, 3), dtype=np.int32)
+    return np.around(circles[0]).astype(np.int32)
+
+
+def initWorker(smoothImg):
+    # one process per core already, keep opencv from oversubscribing
+    cv2.setNumThreads(1)
+    _workerState["smoothImg"] = smoothImg
+
+
+def detectInWorker(params):
+    return params, detectCircles(_workerState["smoothImg"], params)
+
+
+def scoreCircles(circles, expectedSpots):
+    """ scores one detection, every term in [0, 1], 1 is best
+
+    Args:
+        circles (np array): (n, 3) [x, y, r]
+
+        expectedSpots (float): number of spots there should be
+
+    Returns:
+        scores (dict): count, lattice, radius and the weighted total
+    """
+    numSpots = len(circles)
+    if numSpots < 2 or expectedSpots <= 0:
+        return {"count": 0.0, "lattice": 0.0, "radius": 0.0, "total": 0.0}
+    countScore = float(np.exp(-3.0 * abs(numSpots - expectedSpots) / expectedSpots))
+    centers = circles[:, :2].astype(np.float64)
+    radii = circles[:, 2].astype(np.float64)
+    distances = np.sqrt(((centers[:, np.newaxis, :] - centers[np.newaxis, :, :])**2).sum(axis=2))
+    np.fill_diagonal(distances, np.inf)
+    nearest = distances.min(axis=1)
+    nearestIdx = distances.argmin(axis=1)
+    # a regular lattice has one nearest neighbour distance, and no overlaps
+    spacingSpread = nearest.std() / nearest.mean()
+    overlapping = np.mean(nearest < radii + radii[nearestIdx])
+    latticeScore = float((1.0 - overlapping) / (1.0 + 5.0 * spacingSpread))
+    radiusScore = float(1.0 / (1.0 + 10.0 * radii.std() / radii.mean()))
+    total = (scoreWeights["count"] * countScore +
+             scoreWeights["lattice"] * latticeScore +
+             scoreWeights["radius"] * radiusScore)
+    return {"count": countScore, "lattice": latticeScore,
+            "radius": radiusScore, "total": float(total)}
+
+
+def searchHoughParams(subImg, expectedSpots=None, grid=None, workers=None):
+    """ runs every grid candidate on a process pool and ranks them
+
+    Args:
+        subImg (np array): 8 bit crop of the array area, as in patternGen
+
+        expectedSpots (int): spots on the standard. None uses the median
+            count of the candidates that found any
+
+        grid (dict): value lists like houghGrid
+
+        workers (int): processes, defaults to all cores
+
+    Returns:
+        spotInfo (np array): (n, 3) [x, y, r] of the best candidate
+
+        report (list): one dict per candidate, best first: params, spots,
+            and the count / lattice / radius / total scores
+    """
+    if subImg.dtype != np.uint8:
+        subImg = cv2.normalize(subImg, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    smoothImg = cv2.medianBlur(subImg, 3)
+    candidates = houghCandidates(grid)
+    with Pool(processes=workers, initializer=initWorker,
+              initargs=(smoothImg,)) as pool:
+        detections = pool.map(detectInWorker, candidates, chunksize=8)
+    if expectedSpots is None:
+        counts = [len(circles) for _, circles in detections if len(circles) >= 2]
+        expectedSpots = float(np.median(counts)) if counts else 0.0
+    report = []
+    for params, circles in detections:
+        scores = scoreCircles(circles, expectedSpots)
+        report.append({"params": params,
+                       "spots": len(circles),
+                       "scores": scores,
+                       "spotInfo": circles})
+    report.sort(key=lambda entry: entry["scores"]["total"], reverse=True)
+    return report[0]["spotInfo"], report
+
+
+def printReport(report, top=10):
+    print("rank  spots  total  count  lattice  radius  params")
+    for rank, entry in enumerate(report[:top]):
+        scores = entry["scores"]
+        print("%4d  %5d  %5.3f  %5.3f  %7.3f  %6.3f  %s" % (
+            rank + 1, entry["spots"], scores["total"], scores["count"],
+            scores["lattice"], scores["radius"], json.dumps(entry["params"])))
+
+
+def saveReport(report, filePath):
+    """ the ranked report as json, spot_info included for every candidate """
+    with open(filePath, "w") as outFile:
+        json.dump([dict(entry, spotInfo=entry["spotInfo"].tolist()) for entry in report],
+                  outFile, indent=1)
+    return filePath
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hough parameter search for a standard")
+    parser.add_argument("image", help="tiff cropped to the array area")
+    parser.add_argument("--expected", type=int, default=None,
+                        help="number of spots on the standard")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes, default: all cores")
+    parser.add_argument("--report", default=None, help="write the ranked report json here")
+    args = parser.parse_args(argv)
+    subImg = cv2.imread(args.image, 0)
+    if subImg is None:
+        print("could not read " + args.image)
+        return 1
+    spotInfo, report = searchHoughParams(subImg, args.expected, workers=args.workers)
+    printReport(report)
+    if args.report:
+        saveReport(report, args.report)
+    print("best: " + str(len(spotInfo)) + " spots with " + json.dumps(report[0]["params"]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""
+Region and resolution level access to large tiffs, without reading the whole
+file. Stitched mosaics and full resolution 16 bit stacks are served one
+region at a time:
+1) TiffLayout: size, sample type, compression and the strip or tile table
+   from the first IFD. strips are handled as full width tiles
+2) ImageSource.region: only the strips / tiles overlapping the region are
+   decoded (none, deflate, with or without predictor). uncompressed
+   contiguous images are memory mapped, a region is then a view
+3) a resolution pyramid (2x2 mean per level) built once, band by band, and
+   cached next to the file (name.tiff.pyr, memory mapped on later opens)
+
+formats the layout reader doesn't decode (LZW, JPEG, non tiff files) are
+read whole with cv2 once and served from memory.
+
+    source = ImageSource("mosaic.tiff")
+    crop = source.region(1000, 2000, 4000, 6000)           # full resolution
+    overview = source.level(source.fitLevel((480, 320)))    # display sized
+"""
+
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from stageTiming import span, count
+
+pyramidMagic = b"D4PYRMD\n"
+pyramidVersion = 1
+sectionAlign = 64
+# levels stop once the smaller side would be under this
+minLevelSize = 256
+# rows per band while building a level, even so 2x2 blocks never straddle
+bandRows = 512
+# decoded strips / tiles kept per source
+chunkCacheSize = 32
+
+# tiff field type -> struct format
+_fieldFormats = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 11: "f", 12: "d", 16: "Q"}
+_sampleKinds = {1: "u", 2: "i", 3: "f"}
+_deflate = (8, 32946)
+
+
+class TiffLayout():
+    """ The first IFD of a tiff: what an ImageSource needs to find pixels
+
+    Raises ValueError for files that aren't tiffs (or are BigTIFF).
+    """
+    def __init__(self, filePath):
+        with open(filePath, "rb") as inFile:
+            header = inFile.read(8)
+            if header[:4] not in (b"II*\0", b"MM\0*"):
+                raise ValueError(str(filePath) + " is not a tiff")
+            self.endian = "<" if header[:2] == b"II" else ">"
+            ifdOffset = struct.unpack(self.endian + "I", header[4:8])[0]
+            tags = self._readTags(inFile, ifdOffset)
+        self.cols = tags[256][0]
+        self.rows = tags[257][0]
+        self.samples = tags.get(277, [1])[0]
+        bits = tags.get(258, [1])[0]
+        kind = _sampleKinds.get(tags.get(339, [1])[0], "u")
+        if bits not in (8, 16, 32, 64) or (kind == "f" and bits < 32):
+            raise ValueError("unsupported sample size " + str(bits) + " bits")
+        self.dtype = np.dtype(self.endian + kind + str(bits // 8))
+        self.compression = tags.get(259, [1])[0]
+        self.predictor = tags.get(317, [1])[0]
+        self.planar = tags.get(284, [1])[0]
+        if 322 in tags:
+            self.chunkCols = tags[322][0]
+            self.chunkRows = tags[323][0]
+            self.offsets = tags[324]
+            self.byteCounts = tags[325]
+            self.tiled = True
+        else:
+            self.chunkCols = self.cols
+            self.chunkRows = min(tags.get(278, [self.rows])[0], self.rows)
+            self.offsets = tags[273]
+            self.byteCounts = tags[279]
+            self.tiled = False
+        self.chunksAcross = -(-self.cols // self.chunkCols)
+
+    def _readTags(self, inFile, ifdOffset):
+        inFile.seek(ifdOffset)
+        numEntries = struct.unpack(self.endian + "H", inFile.read(2))[0]
+        entries = [struct.unpack(self.endian + "HHI4s", inFile.read(12))
+                   for each in range(numEntries)]
+        tags = {}
+        for tag, fieldType, numValues, raw in entries:
+            fieldFormat = _fieldFormats.get(fieldType)
+            if fieldFormat is None:
+                continue
+            size = struct.calcsize(fieldFormat) * numValues
+            if size <= 4:
+                data = raw[:size]
+            else:
+                inFile.seek(struct.unpack(self.endian + "I", raw)[0])
+                data = inFile.read(size)
+            tags[tag] = list(struct.unpack(self.endian + fieldFormat * numValues, data))
+        return tags
+
+    @property
+    def shape(self):
+        if self.samples == 1:
+            return (self.rows, self.cols)
+        return (self.rows, self.cols, self.samples)
+
+    def decodable(self):
+        return (self.planar == 1 or self.samples == 1) and \
+            self.compression in (1,) + _deflate and self.predictor in (1, 2)
+
+    def contiguous(self):
+        """ uncompressed strips back to back: the image is one memory map """
+        if self.compression != 1 or self.tiled or not self.decodable():
+            return False
+        expected = self.rows * self.cols * self.samples * self.dtype.itemsize
+        ends = np.asarray(self.offsets[:-1]) + np.asarray(self.byteCounts[:-1])
+        return np.array_equal(ends, self.offsets[1:]) and sum(self.byteCounts) >= expected
+
+
+class ImageSource():
+    """ Regions of an image at full or reduced resolution
+
+    Args:
+        filePath (str): tiff (or any image cv2 reads, which is read whole)
+
+        cache (bool): keep the pyramid in filePath + ".pyr", reused while
+            the image file is unchanged
+    """
+    def __init__(self, filePath, cache=True):
+        self.filePath = filePath
+        self.cachePath = filePath + ".pyr" if cache else None
+        self.layout = None
+        self.mapped = None
+        self.whole = None
+        self.chunks = OrderedDict()
+        self.pyramid = None
+        try:
+            self.layout = TiffLayout(filePath)
+        except (ValueError, KeyError, struct.error):
+            pass
+        if self.layout is not None and self.layout.contiguous():
+            self.mapped = np.memmap(filePath, dtype=self.layout.dtype, mode="r",
+                                    offset=self.layout.offsets[0],
+                                    shape=self.layout.shape)
+        elif self.layout is None or not self.layout.decodable():
+            with span("load"):
+                self.whole = cv2.imread(filePath, -1)
+            if self.whole is None:
+                raise ValueError("could not read image " + str(filePath))
+            if self.whole.ndim == 3:
+                # cv2 reads color as BGR, tiffs store RGB
+                self.whole = cv2.cvtColor(self.whole, cv2.COLOR_BGR2RGB)
+        self.shape = self.whole.shape if self.whole is not None else self.layout.shape
+        self.dtype = self.whole.dtype if self.whole is not None else self.layout.dtype.newbyteorder("=")
+
+    def _chunk(self, index):
+        """ one decoded strip / tile as (chunkRows, chunkCols[, samples]) """
+        chunk = self.chunks.get(index)
+        if chunk is not None:
+            self.chunks.move_to_end(index)
+            return chunk
+        layout = self.layout
+        with open(self.filePath, "rb") as inFile:
+            inFile.seek(layout.offsets[index])
+            data = inFile.read(layout.byteCounts[index])
+        if layout.compression in _deflate:
+            data = zlib.decompress(data)
+        rows = len(data) // (layout.chunkCols * layout.samples * layout.dtype.itemsize)
+        chunk = np.frombuffer(data, dtype=layout.dtype,
+                              count=rows * layout.chunkCols * layout.samples)
+        chunk = chunk.reshape(rows, layout.chunkCols, layout.samples)
+        if layout.predictor == 2:
+            chunk = np.cumsum(chunk, axis=1, dtype=layout.dtype)
+        chunk = chunk.astype(self.dtype, copy=False)
+        if layout.samples == 1:
+            chunk = chunk[:, :, 0]
+        count("load/chunks")
+        self.chunks[index] = chunk
+        if len(self.chunks) > chunkCacheSize:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def _fullRegion(self, rowStart, rowEnd, colStart, colEnd):
+        if self.whole is not None:
+            return self.whole[rowStart:rowEnd, colStart:colEnd]
+        if self.mapped is not None:
+            return self.mapped[rowStart:rowEnd, colStart:colEnd]
+        layout = self.layout
+        out = np.empty((rowEnd - rowStart, colEnd - colStart) + self.shape[2:], dtype=self.dtype)
+        for chunkRow in range(rowStart // layout.chunkRows, -(-rowEnd // layout.chunkRows)):
+            for chunkCol in range(colStart // layout.chunkCols, -(-colEnd // layout.chunkCols)):
+                chunk = self._chunk(chunkRow * layout.chunksAcross + chunkCol)
+                top = chunkRow * layout.chunkRows
+                left = chunkCol * layout.chunkCols
+                rowFrom, rowTo = max(rowStart, top), min(rowEnd, top + len(chunk))
+                colFrom, colTo = max(colStart, left), min(colEnd, left + layout.chunkCols)
+                out[rowFrom - rowStart:rowTo - rowStart, colFrom - colStart:colTo - colStart] = \
+                    chunk[rowFrom - top:rowTo - top, colFrom - left:colTo - left]
+        return out
+
+    def region(self, rowStart=0, rowEnd=None, colStart=0, colEnd=None, level=0):
+        """ pixels of a region, bounds in the coordinates of that level
+
+        Returns:
+            region (np array): may be a read only view of a memory map, copy
+                it before writing to it
+        """
+        rows, cols = self.levelShape(level)[:2]
+        rowEnd = rows if rowEnd is None else min(rowEnd, rows)
+        colEnd = cols if colEnd is None else min(colEnd, cols)
+        rowStart, colStart = max(rowStart, 0), max(colStart, 0)
+        if level == 0:
+            with span("load"):
+                return self._fullRegion(rowStart, rowEnd, colStart, colEnd)
+        return self.levels()[level][rowStart:rowEnd, colStart:colEnd]
+
+    def level(self, level):
+        """ one whole resolution level, level 0 is the full image """
+        return self.region(level=level)
+
+    def levelShape(self, level):
+        shape = self.shape
+        for each in range(level):
+            shape = (shape[0] // 2, shape[1] // 2) + shape[2:]
+        return shape
+
+    def numLevels(self):
+        levels = 1
+        shape = self.shape
+        while min(shape[0], shape[1]) // 2 >= minLevelSize:
+            shape = (shape[0] // 2, shape[1] // 2)
+            levels = levels + 1
+        return levels
+
+    def fitLevel(self, size):
+        """ the smallest level still at least size (cols, rows), for display """
+        best = 0
+        for level in range(1, self.numLevels()):
+            rows, cols = self.levelShape(level)[:2]
+            if cols < size[0] or rows < size[1]:
+                break
+            best = level
+        return best
+
+    def levels(self):
+        """ every level past 0, from the cache file or built (and cached) now """
+        if self.pyramid is None:
+            self.pyramid = self._loadPyramid()
+            if self.pyramid is None:
+                with span("pyramid"):
+                    self.pyramid = self._buildPyramid()
+        return self.pyramid
+
+    def _sourceStamp(self):
+        stat = os.stat(self.filePath)
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def _loadPyramid(self):
+        if self.cachePath is None or not os.path.exists(self.cachePath):
+            return None
+        with open(self.cachePath, "rb") as inFile:
+            if inFile.read(len(pyramidMagic)) != pyramidMagic:
+                return None
+            version, headerLength = struct.unpack("<II", inFile.read(8))
+            header = json.loads(inFile.read(headerLength).decode("utf-8"))
+        if version > pyramidVersion or header["source"] != self._sourceStamp():
+            return None
+        dataStart = _aligned(len(pyramidMagic) + 8 + headerLength)
+        pyramid = [None]
+        for info in header["levels"]:
+            pyramid.append(np.memmap(self.cachePath, mode="r",
+                                     dtype=np.lib.format.descr_to_dtype(info["dtype"]),
+                                     offset=dataStart + info["offset"],
+                                     shape=tuple(info["shape"])))
+        return pyramid
+
+    def _buildPyramid(self):
+        """ each level from the one above in bands of bandRows rows, into
+            memory maps of a temporary file that replaces the cache only when
+            complete, so an interrupted build never leaves a cache that
+            _loadPyramid accepts (in memory if it can't be written)
+        """
+        dtype = self.dtype.newbyteorder("<")
+        shapes = [self.levelShape(level) for level in range(1, self.numLevels())]
+        header = {"source": self._sourceStamp(), "levels": []}
+        offset = 0
+        for shape in shapes:
+            header["levels"].append({"dtype": np.lib.format.dtype_to_descr(dtype),
+                                     "shape": list(shape), "offset": offset})
+            offset = offset + _aligned(int(np.prod(shape)) * dtype.itemsize)
+        headerBytes = json.dumps(header).encode("utf-8")
+        dataStart = _aligned(len(pyramidMagic) + 8 + len(headerBytes))
+        buildPath = None
+        pyramid = [None]
+        try:
+            if self.cachePath is None:
+                raise OSError("no cache")
+            buildPath = self.cachePath + "." + str(os.getpid()) + ".tmp"
+            with open(buildPath, "wb") as outFile:
+                outFile.write(pyramidMagic)
+                outFile.write(struct.pack("<II", pyramidVersion, len(headerBytes)))
+                outFile.write(headerBytes)
+                outFile.truncate(dataStart + offset)
+            for shape, info in zip(shapes, header["levels"]):
+                pyramid.append(np.memmap(buildPath, mode="r+", dtype=dtype,
+                                         offset=dataStart + info["offset"], shape=shape))
+        except OSError:
+            if buildPath is not None and os.path.exists(buildPath):
+                os.remove(buildPath)
+            buildPath = None
+            pyramid = [None] + [np.empty(shape, dtype=dtype) for shape in shapes]
+        try:
+            for level in range(1, len(pyramid)):
+                target = pyramid[level]
+                for rowStart in range(0, len(target), bandRows // 2):
+                    rowEnd = min(rowStart + bandRows // 2, len(target))
+                    if level == 1:
+                        band = self._fullRegion(2 * rowStart, 2 * rowEnd,
+                                                0, 2 * target.shape[1])
+                    else:
+                        band = pyramid[level - 1][2 * rowStart:2 * rowEnd, :2 * target.shape[1]]
+                    target[rowStart:rowEnd] = _halve(band)
+            if buildPath is None:
+                return pyramid
+            for target in pyramid[1:]:
+                target.flush()
+            # unmapped before the rename, windows won't replace a mapped file
+            pyramid = target = band = None
+            os.replace(buildPath, self.cachePath)
+            buildPath = None
+        finally:
+            if buildPath is not None and os.path.exists(buildPath):
+                pyramid = target = band = None
+                os.remove(buildPath)
+        return [None] + [np.memmap(self.cachePath, mode="r", dtype=dtype,
+                                   offset=dataStart + info["offset"], shape=shape)
+                         for shape, info in zip(shapes, header["levels"])]
+
+    def close(self):
+        self.mapped = None
+        self.pyramid = None
+        self.chunks.clear()
+
+
+def _halve(band):
+    """ 2x2 block mean, band rows and cols already even """
+    size = (band.shape[1] // 2, band.shape[0] // 2)
+    return cv2.resize(np.ascontiguousarray(band), size, interpolation=cv2.INTER_AREA)
+
+
+def _aligned(numBytes):
+    return -(-numBytes // sectionAlign) * sectionAlign
+
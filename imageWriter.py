@@ -0,0 +1,305 @@
+"""
+Asynchronous TIFF saving. Captures are handed to a background writer thread
+so the touchscreen and the next capture never wait on the disk:
+1) uniqueImageID: date/time based unique id for every saved image
+2) writeTiff: baseline tiff writer (8/16 bit or float32 gray, 8 bit RGB) with the
+   acquisition metadata as json in ImageDescription, optionally lossless
+   deflate compressed (zlib, horizontal predictor)
+3) AsyncTiffWriter: bounded memory write queue in front of writeTiff
+4) readTiffMetadata: reads the json metadata back out of a saved tiff
+5) acquisitionMetadata: the fields every capture is saved with
+
+    writer = defaultWriter()
+    imageID = uniqueImageID()
+    path = writer.submit(image, "leptin-1_" + imageID,
+                         acquisitionMetadata(singleConfig, "singleCapture",
+                                             "leptin-1", (509, 88)), imageID=imageID)
+"""
+
+import atexit
+import datetime
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+from stageTiming import span, count
+
+# tiff field types
+_SHORT = 3
+_LONG = 4
+_ASCII = 2
+
+stripTargetBytes = 256 * 1024
+_idCounter = itertools.count()
+
+
+def uniqueImageID(when=None):
+    """ yyyymmdd-hhmmss-microseconds-counter, unique within a process and
+        ordered by capture time
+    """
+    when = datetime.datetime.now() if when is None else when
+    return when.strftime("%Y%m%d-%H%M%S-%f") + "-" + str(next(_idCounter) % 1000).zfill(3)
+
+
+def acquisitionMetadata(config=None, source=None, batch=None, matchOffset=None, **extra):
+    """ metadata saved with a capture: camera config (singleConfig /
+        videoConfig), where it came from, circle dictionary batch name and
+        the template match offset (col, row), plus any extra fields
+    """
+    metadata = {"config": dict(config) if config else None,
+                "source": source,
+                "batch": batch,
+                "matchOffset": [int(each) for each in matchOffset] if matchOffset is not None else None}
+    metadata.update(extra)
+    return metadata
+
+
+def _packValues(fieldType, values):
+    if fieldType == _ASCII:
+        data = values.encode("ascii", "replace") + b"\0"
+        return data, len(data)
+    fmt = "<" + ("H" if fieldType == _SHORT else "I") * len(values)
+    return struct.pack(fmt, *values), len(values)
+
+
+def writeTiff(filePath, image, metadata=None, compression=None, software="D4Scope"):
+    """ Writes a single page tiff with metadata in ImageDescription
+
+    Args:
+        filePath (str): output path
+
+        image (np array): 2d uint8/uint16/float32, or (rows, cols, 3) uint8 RGB
+
+        metadata (dict): json serializable, stored as ImageDescription
+
+        compression (str): None or 'deflate' (lossless, zlib + predictor)
+
+    Returns:
+        filePath (str)
+    """
+    image = np.ascontiguousarray(image)
+    if image.dtype not in (np.uint8, np.uint16, np.float32):
+        raise ValueError("only uint8, uint16 and float32 images can be saved, got "
+                         + str(image.dtype))
+    if image.ndim == 3 and image.shape[2] == 3 and image.dtype == np.uint8:
+        samples = 3
+        photometric = 2
+    elif image.ndim == 2:
+        samples = 1
+        photometric = 1
+    else:
+        raise ValueError("image must be 2d gray or rows x cols x 3 RGB")
+    rows, cols = image.shape[:2]
+    bits = image.dtype.itemsize * 8
+    rowBytes = cols * samples * image.dtype.itemsize
+    rowsPerStrip = max(1, min(rows, stripTargetBytes // max(rowBytes, 1)))
+
+    if compression not in (None, "deflate"):
+        raise ValueError("compression must be None or 'deflate'")
+    # little endian on disk, the predictor works on native samples first.
+    # the integer difference predictor doesn't apply to float samples
+    pixels = image.astype(image.dtype.newbyteorder("<"), copy=False)
+    predictor = compression == "deflate" and image.dtype.kind == "u"
+    if predictor:
+        pixels = np.diff(pixels, axis=1, prepend=np.zeros_like(pixels[:, :1]))
+    strips = []
+    for rowStart in range(0, rows, rowsPerStrip):
+        strip = pixels[rowStart:rowStart + rowsPerStrip].tobytes()
+        if compression == "deflate":
+            strip = zlib.compress(strip, 6)
+        strips.append(strip)
+
+    description = json.dumps(metadata if metadata is not None else {})
+    stamp = time.strftime("%Y:%m:%d %H:%M:%S")
+    dataStart = 8
+    stripOffsets = []
+    offset = dataStart
+    for strip in strips:
+        stripOffsets.append(offset)
+        offset = offset + len(strip) + (len(strip) % 2)  # word aligned
+    ifdOffset = offset
+    tags = [(256, _LONG, [cols]),
+            (257, _LONG, [rows]),
+            (258, _SHORT, [bits] * samples),
+            (259, _SHORT, [8 if compression == "deflate" else 1]),
+            (262, _SHORT, [photometric]),
+            (270, _ASCII, description),
+            (273, _LONG, stripOffsets),
+            (277, _SHORT, [samples]),
+            (278, _LONG, [rowsPerStrip]),
+            (279, _LONG, [len(strip) for strip in strips]),
+            (284, _SHORT, [1]),
+            (305, _ASCII, software),
+            (306, _ASCII, stamp)]
+    if predictor:
+        tags.append((317, _SHORT, [2]))
+    if image.dtype.kind == "f":
+        tags.append((339, _SHORT, [3] * samples))
+    extraStart = ifdOffset + 2 + 12 * len(tags) + 4
+    entries = []
+    extras = []
+    extraOffset = extraStart
+    for tag, fieldType, values in tags:
+        data, numValues = _packValues(fieldType, values)
+        if len(data) <= 4:
+            entries.append(struct.pack("<HHI", tag, fieldType, numValues) + data.ljust(4, b"\0"))
+        else:
+            entries.append(struct.pack("<HHII", tag, fieldType, numValues, extraOffset))
+            padded = data + b"\0" * (len(data) % 2)
+            extras.append(padded)
+            extraOffset = extraOffset + len(padded)
+    with open(filePath, "wb") as outFile:
+        outFile.write(b"II*\0" + struct.pack("<I", ifdOffset))
+        for strip in strips:
+            outFile.write(strip)
+            if len(strip) % 2:
+                outFile.write(b"\0")
+        outFile.write(struct.pack("<H", len(entries)))
+        outFile.write(b"".join(entries))
+        outFile.write(struct.pack("<I", 0))
+        outFile.write(b"".join(extras))
+    return filePath
+
+
+def readTiffMetadata(filePath):
+    """ json metadata from a tiff's ImageDescription, None if there is none """
+    with open(filePath, "rb") as inFile:
+        header = inFile.read(8)
+        endian = "<" if header[:2] == b"II" else ">"
+        ifdOffset = struct.unpack(endian + "I", header[4:8])[0]
+        inFile.seek(ifdOffset)
+        numEntries = struct.unpack(endian + "H", inFile.read(2))[0]
+        for each in range(numEntries):
+            tag, fieldType, numValues, valueOffset = struct.unpack(endian + "HHII",
+                                                                   inFile.read(12))
+            if tag == 270:
+                if numValues <= 4:
+                    inFile.seek(-4, os.SEEK_CUR)
+                else:
+                    inFile.seek(valueOffset)
+                text = inFile.read(numValues).rstrip(b"\0").decode("ascii", "replace")
+                try:
+                    return json.loads(text)
+                except ValueError:
+                    return None
+    return None
+
+
+class AsyncTiffWriter():
+    """ Background tiff writer with a memory bound
+
+    submit() copies the image (the caller can reuse its buffer), queues it and
+    returns the path it will be written to right away. Only when more than
+    maxQueuedBytes are waiting does submit() block, so a burst of captures is
+    absorbed in memory instead of waiting on the disk.
+
+    Args:
+        maxQueuedBytes (int): memory bound of the queue
+
+        compression (str): None or 'deflate', see writeTiff
+
+        directory (str): where relative file names are written
+    """
+    def __init__(self, maxQueuedBytes=512 * 1024**2, compression=None, directory="."):
+        self.maxQueuedBytes = maxQueuedBytes
+        self.compression = compression
+        self.directory = directory
+        self.queue = deque()
+        self.queuedBytes = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.written = 0
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, fileName=None, metadata=None, compression=None, imageID=None):
+        """ queues image for writing
+
+        Args:
+            image (np array): frame to save, copied
+
+            fileName (str): name with or without .tiff, default uniqueImageID()
+
+            metadata (dict): stored in the tiff, the id and save time are added
+
+            compression (str): overrides the writer's compression
+
+            imageID (str): the metadata id, default a new uniqueImageID().
+                pass the id the file name was built from so the two match
+
+        Returns:
+            filePath (str): where the file will be
+        """
+        imageID = uniqueImageID() if imageID is None else imageID
+        fileName = imageID if not fileName else fileName
+        if not fileName.lower().endswith((".tif", ".tiff")):
+            fileName = fileName + ".tiff"
+        filePath = os.path.join(self.directory, fileName)
+        metadata = dict(metadata or {})
+        metadata.setdefault("id", imageID)
+        metadata.setdefault("saved", datetime.datetime.now().isoformat())
+        compression = self.compression if compression is None else compression
+        image = np.array(image, copy=True)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("writer is closed")
+            self.condition.wait_for(lambda: self.queuedBytes == 0 or
+                                    self.queuedBytes + image.nbytes <= self.maxQueuedBytes)
+            self.queue.append((filePath, image, metadata, compression))
+            self.queuedBytes = self.queuedBytes + image.nbytes
+            self.condition.notify_all()
+        count("save/queued")
+        return filePath
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or self.closed)
+                if not self.queue:
+                    return
+                filePath, image, metadata, compression = self.queue[0]
+            try:
+                with span("save"):
+                    writeTiff(filePath, image, metadata, compression)
+                self.written = self.written + 1
+            except Exception as err:
+                self.errors.append((filePath, err))
+                print("failed to save " + filePath + ": " + str(err))
+            with self.condition:
+                self.queue.popleft()
+                self.queuedBytes = self.queuedBytes - image.nbytes
+                self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue)
+
+    def flush(self, timeout=None):
+        """ waits until everything queued so far is on disk """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue, timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+_defaultWriter = []
+
+
+def defaultWriter():
+    """ shared writer for the UI and the command line tools, flushed at exit """
+    if not _defaultWriter:
+        _defaultWriter.append(AsyncTiffWriter())
+        atexit.register(_defaultWriter[0].close)
+    return _defaultWriter[0]
@@ -0,0 +1,261 @@
+"""
+Template matching shared by the UI, the command line tools and the headless
+batch / multi camera analysis. No GUI imports, so it loads on a server
+without easygui or a display:
+1) centerWeight: gaussian prior around where the array should sit
+2) templateMatch8b: one-off match of a pattern in an image, optionally coarse
+   to fine through pyramidCandidates
+3) TemplateMatcher: the same match with geometry, buffers and the pattern
+   spectrum built once, for matching many frames of one shape
+"""
+
+import cv2
+import numpy as np
+
+from stageTiming import span, timed
+
+
+def centerWeight(colCoords, rowCoords, centerCol, centerRow, sigma=400):
+    """ gaussian prior weighting match locations near the expected center.
+        colCoords/rowCoords are 1d arrays of the full resolution positions,
+        the weight is built by broadcasting (no meshgrid)
+    """
+    colTerm = np.exp(-(np.asarray(colCoords, dtype=np.float64) - centerCol)**2 /
+                     (2.0 * sigma**2))
+    rowTerm = np.exp(-(np.asarray(rowCoords, dtype=np.float64) - centerRow)**2 /
+                     (2.0 * sigma**2))
+    return rowTerm[:, np.newaxis] * colTerm[np.newaxis, :]
+
+
+def pyramidCandidates(imagePyr, patternPyr, centerCol, centerRow,
+                      numCandidates=2):
+    """ Coarse search for templateMatch8b's pyramid mode
+
+    Matches the coarsest pyrDown level of the image and pattern, weighs by
+    the same center prior and returns the top peaks, non-max suppressed by
+    half a pattern, as (col, row) locations at the coarsest level.
+    """
+    scale = 2**(len(imagePyr) - 1)
+    res = cv2.matchTemplate(imagePyr[-1], patternPyr[-1], cv2.TM_CCORR_NORMED)
+    resRows, resCols = res.shape
+    weightedRes = res * centerWeight(np.arange(resCols) * scale,
+                                     np.arange(resRows) * scale,
+                                     centerCol, centerRow)
+    suppressRows, suppressCols = [max(each // 2, 1) for each in patternPyr[-1].shape]
+    candidates = []
+    for each in range(numCandidates):
+        _, peakVal, _, peakLoc = cv2.minMaxLoc(weightedRes)
+        if peakVal <= 0:
+            break
+        candidates.append(peakLoc)
+        weightedRes[max(peakLoc[1] - suppressRows, 0):peakLoc[1] + suppressRows + 1,
+                    max(peakLoc[0] - suppressCols, 0):peakLoc[0] + suppressCols + 1] = 0
+    return candidates
+
+
+@timed("match")
+def templateMatch8b(image, pattern, pyramidLevels=0):
+    """ Core template matching algorithm to compare image to pattern
+
+    Calculates the correlation between the pattern and the image at all points
+    in 2d sliding window format weighs the correlations higher in the center of
+    the image where the spots should be.
+
+    With pyramidLevels > 0 the full search runs on pyrDown'd copies of the
+    image and pattern instead, and only small windows around the best coarse
+    peaks are matched at full resolution. Same weighting, same answer as the
+    exhaustive search unless the true peak is not among the coarse candidates.
+
+    Args:
+        image (np array): the image to be processed
+
+        pattern (np array): the pattern to be found in the image (circles)
+
+        pyramidLevels (int): 0 = exhaustive full resolution search,
+            n = coarse search after n pyrDowns then full resolution refinement
+
+    Returns:
+        topLeftMatch (list): location of the best fit defined as the top left
+            coordinate within the image
+
+        verImg (np array): copy of the image in color with a rectangle drawn
+            where the pattern was best fit
+
+    """
+    imageCols, imageRows = image.shape[::-1]
+    stdCols, stdRows = pattern.shape[::-1]
+    print("pattern std shape: " + str(pattern.shape[::-1]))
+    # grab dimensions of input image and convert to 8bit for manipulation
+    with span("match/normalize"):
+        image8b = cv2.normalize(image,
+                                None,
+                                0, 255,
+                                norm_type=cv2.NORM_MINMAX,
+                                dtype=cv2.CV_8U)
+    verImg = cv2.cvtColor(image8b, cv2.COLOR_GRAY2RGB)
+
+    centerRow = int((imageRows - stdRows)/2) - 200
+    centerCol = int((imageCols - stdCols)/2)
+    print("center row and col" + " " + str(centerRow) + " " + str(centerCol))
+    # draws circle where the gaussian is centered.
+    cv2.circle(verImg, (centerCol, centerRow), 3, (0, 0, 255), 3)
+    max_loc = None
+    if pyramidLevels > 0:
+        imagePyr = [image8b]
+        patternPyr = [pattern]
+        for each in range(pyramidLevels):
+            imagePyr.append(cv2.pyrDown(imagePyr[-1]))
+            patternPyr.append(cv2.pyrDown(patternPyr[-1]))
+        scale = 2**pyramidLevels
+        margin = 4 * scale  # coarse peaks wander a few coarse pixels
+        maxCol = imageCols - stdCols
+        maxRow = imageRows - stdRows
+        bestVal = -1.0
+        for coarseLoc in pyramidCandidates(imagePyr, patternPyr,
+                                           centerCol, centerRow):
+            colStart = min(max(coarseLoc[0] * scale - margin, 0), maxCol)
+            rowStart = min(max(coarseLoc[1] * scale - margin, 0), maxRow)
+            colEnd = min(coarseLoc[0] * scale + margin, maxCol)
+            rowEnd = min(coarseLoc[1] * scale + margin, maxRow)
+            window = image8b[rowStart:rowEnd + stdRows, colStart:colEnd + stdCols]
+            res = cv2.matchTemplate(window, pattern, cv2.TM_CCORR_NORMED)
+            resRows, resCols = res.shape
+            weightedRes = res * centerWeight(np.arange(resCols) + colStart,
+                                             np.arange(resRows) + rowStart,
+                                             centerCol, centerRow)
+            _, peakVal, _, peakLoc = cv2.minMaxLoc(weightedRes)
+            if peakVal > bestVal:
+                bestVal = peakVal
+                max_loc = (peakLoc[0] + colStart, peakLoc[1] + rowStart)
+        if max_loc is None:
+            # no coarse peak (e.g. a blank frame), search exhaustively instead
+            print("no coarse candidates, full resolution search")
+    if max_loc is None:
+        with span("match/correlate"):
+            res = cv2.matchTemplate(image8b, pattern, cv2.TM_CCORR_NORMED)
+        _, _, _, max_loc = cv2.minMaxLoc(res)
+        gausCols, gausRows = res.shape[::-1]
+        print("max location REAL: " + str(max_loc))
+        print("gaus img shape: " + str(res.shape[::-1]))
+
+        gausCenterWeight = centerWeight(np.arange(gausCols), np.arange(gausRows),
+                                        centerCol, centerRow)
+        weightedRes = res * gausCenterWeight
+        _, _, _, max_loc = cv2.minMaxLoc(weightedRes)
+    print(max_loc)  # max loc is reported as written as column,row...
+    bottomRightPt = (max_loc[0] + stdCols,
+                     max_loc[1] + stdRows)
+    # cv2.rectangle takes in positions as (column, row)....
+    cv2.rectangle(verImg,
+                  max_loc,
+                  bottomRightPt,
+                  (0, 105, 255),
+                  15)
+    # cvWindow("rectangle drawn", verImg, False)
+    topLeftMatch = max_loc  # col, row
+    return topLeftMatch, verImg
+
+
+class TemplateMatcher():
+    """ templateMatch8b for a fixed pattern and image shape, built once
+
+    Everything that only depends on geometry is computed in the constructor:
+    the center prior, the 8 bit / response / weighted buffers and, with
+    useFFT, the spectrum of the zero padded pattern. match(frame) then writes
+    into those buffers only, so matching every frame of a session does not
+    allocate. Picks the same location as templateMatch8b (exhaustive mode).
+
+    Args:
+        pattern (np array): 8 bit pattern to be found (circles)
+
+        imageShape (tuple): (rows, cols) of the frames that will be matched
+
+        useFFT (bool): correlate against the precomputed pattern spectrum
+            instead of calling cv2.matchTemplate
+    """
+    def __init__(self, pattern, imageShape, useFFT=False):
+        self.pattern = np.ascontiguousarray(pattern, dtype=np.uint8)
+        self.imageRows, self.imageCols = int(imageShape[0]), int(imageShape[1])
+        self.stdRows, self.stdCols = self.pattern.shape
+        self.resRows = self.imageRows - self.stdRows + 1
+        self.resCols = self.imageCols - self.stdCols + 1
+        if self.resRows < 1 or self.resCols < 1:
+            raise ValueError("pattern is larger than the image")
+        self.centerRow = int((self.imageRows - self.stdRows)/2) - 200
+        self.centerCol = int((self.imageCols - self.stdCols)/2)
+        self.prior = centerWeight(np.arange(self.resCols),
+                                  np.arange(self.resRows),
+                                  self.centerCol, self.centerRow)
+        self.image8b = np.zeros((self.imageRows, self.imageCols), dtype=np.uint8)
+        self.res = np.zeros((self.resRows, self.resCols), dtype=np.float32)
+        self.weightedRes = np.zeros((self.resRows, self.resCols), dtype=np.float64)
+        self.useFFT = useFFT
+        if useFFT:
+            dftRows = cv2.getOptimalDFTSize(self.imageRows)
+            dftCols = cv2.getOptimalDFTSize(self.imageCols)
+            paddedPattern = np.zeros((dftRows, dftCols), dtype=np.float32)
+            paddedPattern[:self.stdRows, :self.stdCols] = self.pattern
+            self.patternSpectrum = cv2.dft(paddedPattern)
+            self.patternNorm = float(np.sqrt(np.sum(self.pattern.astype(np.float64)**2)))
+            self.paddedImage = np.zeros((dftRows, dftCols), dtype=np.float32)
+            self.imageSpectrum = np.zeros((dftRows, dftCols), dtype=np.float32)
+            self.productSpectrum = np.zeros((dftRows, dftCols), dtype=np.float32)
+            self.correlation = np.zeros((dftRows, dftCols), dtype=np.float32)
+            self.integralSum = np.zeros((self.imageRows + 1, self.imageCols + 1), dtype=np.float64)
+            self.integralSqSum = np.zeros((self.imageRows + 1, self.imageCols + 1), dtype=np.float64)
+            self.windowSqSum = np.zeros((self.resRows, self.resCols), dtype=np.float64)
+
+    @timed("match")
+    def match(self, frame):
+        """ Matches one frame, any bit depth, of the shape given at construction
+
+        Returns:
+            topLeftMatch (tuple): (col, row) of the best fit, as templateMatch8b
+        """
+        with span("match/normalize"):
+            cv2.normalize(frame, self.image8b, 0, 255,
+                          norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        with span("match/correlate"):
+            if self.useFFT:
+                self._fftCorrelate()
+            else:
+                cv2.matchTemplate(self.image8b, self.pattern, cv2.TM_CCORR_NORMED,
+                                  self.res)
+        np.multiply(self.res, self.prior, out=self.weightedRes)
+        _, _, _, topLeftMatch = cv2.minMaxLoc(self.weightedRes)
+        return topLeftMatch
+
+    def _fftCorrelate(self):
+        """ TM_CCORR_NORMED through the cached pattern spectrum, into self.res """
+        self.paddedImage[:self.imageRows, :self.imageCols] = self.image8b
+        cv2.dft(self.paddedImage, self.imageSpectrum)
+        cv2.mulSpectrums(self.imageSpectrum, self.patternSpectrum, 0,
+                         self.productSpectrum, conjB=True)
+        cv2.idft(self.productSpectrum, self.correlation,
+                 cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+        # sum of squares under the pattern at every top left position
+        cv2.integral2(self.image8b, self.integralSum, self.integralSqSum,
+                      cv2.CV_64F, cv2.CV_64F)
+        sqSum = self.integralSqSum
+        rows, cols = self.stdRows, self.stdCols
+        np.subtract(sqSum[rows:, cols:], sqSum[:-rows, cols:], out=self.windowSqSum)
+        np.subtract(self.windowSqSum, sqSum[rows:, :-cols], out=self.windowSqSum)
+        np.add(self.windowSqSum, sqSum[:-rows, :-cols], out=self.windowSqSum)
+        np.maximum(self.windowSqSum, 1e-12, out=self.windowSqSum)
+        np.sqrt(self.windowSqSum, out=self.windowSqSum)
+        self.windowSqSum *= self.patternNorm
+        np.divide(self.correlation[:self.resRows, :self.resCols], self.windowSqSum,
+                  out=self.res, casting="unsafe")
+
+    def verificationImage(self, topLeftMatch):
+        """ color copy of the last matched frame with the fit drawn on it,
+            same drawing as templateMatch8b. allocates, only call for display
+        """
+        verImg = cv2.cvtColor(self.image8b, cv2.COLOR_GRAY2RGB)
+        cv2.circle(verImg, (self.centerCol, self.centerRow), 3, (0, 0, 255), 3)
+        cv2.rectangle(verImg,
+                      tuple(topLeftMatch),
+                      (topLeftMatch[0] + self.stdCols, topLeftMatch[1] + self.stdRows),
+                      (0, 105, 255),
+                      15)
+        return verImg
@@ -0,0 +1,298 @@
+"""
+Concurrent acquisition from every attached camera. Each camera gets its own
+acquisition process; frames are written straight into shared memory slots
+and only the slot number crosses process boundaries, so analysis workers read
+the pixels in place instead of unpickling arrays:
+1) SharedFrameRing: fixed slots of one frame size in a SharedMemory block,
+   created and unlinked by the parent
+2) acquisitionWorker: one process per camera serial, grabs into free slots
+   and drops frames (counted) when analysis is behind
+3) runMultiCamera: enumerates devices, starts the processes and a pool of
+   analysis workers, and writes results tagged with the device serial
+
+usage:
+    python multiCamera.py --dict standard_image.cdict --out results.csv --frames 100
+    D4SCOPE_SIM="test.tiff" D4SCOPE_SIM_DEVICES=3 python multiCamera.py --dict standard_image.cdict --out r.csv
+"""
+
+import argparse
+import multiprocessing
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import batchAnalysis
+from batchAnalysis import ResultWriter, loadCircleDict
+from cameraBackend import backendFromEnvironment
+from cameraSession import CameraSession
+from frameTools import FrameUnpacker, grabToArray
+
+# acquisition profile, videoConfig format
+acquisitionConfig = {'gain': 24,
+                     'expo': 1e5,
+                     'digshift': 4,
+                     'pixelform': 'Mono8',
+                     'binval': 2}
+
+# per analysis worker: attached rings by shared memory name
+_attachedRings = {}
+
+
+class SharedFrameRing():
+    """ numSlots frames of one shape / dtype in a SharedMemory block
+
+    Args:
+        shape (tuple): frame (rows, cols)
+
+        dtype (np dtype): frame dtype
+
+        numSlots (int): frames in flight per camera
+
+        name (str): attach to this existing block instead of creating one
+    """
+    def __init__(self, shape, dtype, numSlots, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.numSlots = numSlots
+        self.frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True,
+                                                     size=self.frameBytes * numSlots)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            _untrack(self.memory)
+        self.frames = np.ndarray((numSlots,) + self.shape, dtype=self.dtype,
+                                 buffer=self.memory.buf)
+
+    def spec(self):
+        """ everything another process needs to attach, picklable """
+        return (self.memory.name, self.shape, self.dtype.str, self.numSlots)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype, numSlots = spec
+        return cls(shape, dtype, numSlots, name=name)
+
+    def slot(self, index):
+        return self.frames[index]
+
+    def close(self):
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def _untrack(memory):
+    # attaching registers the block with the resource tracker as if this
+    # process owned it (before python 3.13), the parent does the unlinking
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(memory._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
+
+
+def acquisitionWorker(serial, profile, slotQueue, readyQueue, stopEvent,
+                      maxFrames=None, timeoutMs=5000):
+    """ runs in its own process, one per camera
+
+    Tells the parent the frame shape, gets the ring spec back as the first
+    slotQueue item, then grabs into whichever slots are free. Messages on
+    readyQueue: ("shape", serial, shape, dtype), ("frame", serial, slot,
+    blockID, timeStamp), ("done", serial, stats) and ("error", serial, text).
+    """
+    backend = backendFromEnvironment()
+    session = CameraSession({'acquisition': profile}, backend=backend, serial=serial)
+    grabbed = 0
+    dropped = 0
+    ring = None
+    started = time.monotonic()
+    try:
+        session.open().applyProfile('acquisition')
+        camera = session.camera
+        unpacker = FrameUnpacker()
+        camera.StartGrabbing(backend.latestImageOnly)
+        while not stopEvent.is_set() and (maxFrames is None or grabbed < maxFrames):
+            grabResult = camera.RetrieveResult(timeoutMs, backend.timeoutThrow)
+            try:
+                if ring is None:
+                    first = grabToArray(grabResult, unpacker)
+                    readyQueue.put(("shape", serial, first.shape, first.dtype.str))
+                    ring = SharedFrameRing.attach(slotQueue.get())
+                try:
+                    slot = slotQueue.get_nowait()
+                except queue.Empty:
+                    # analysis is behind, newest frames win
+                    dropped = dropped + 1
+                    continue
+                grabToArray(grabResult, unpacker, out=ring.slot(slot))
+                grabbed = grabbed + 1
+                readyQueue.put(("frame", serial, slot, grabResult.BlockID,
+                                grabResult.TimeStamp))
+            finally:
+                grabResult.Release()
+    except Exception as err:
+        readyQueue.put(("error", serial, repr(err)))
+    finally:
+        elapsed = time.monotonic() - started
+        session.close()
+        if ring is not None:
+            ring.close()
+        readyQueue.put(("done", serial, {"grabbed": grabbed,
+                                         "dropped": dropped,
+                                         "fps": grabbed / elapsed if elapsed > 0 else 0.0}))
+
+
+def analyzeSlot(serial, spec, slot, blockID, captured=None):
+    """ analysis worker task: quantifies a frame in place in shared memory """
+    ring = _attachedRings.get(spec[0])
+    if ring is None:
+        ring = _attachedRings[spec[0]] = SharedFrameRing.attach(spec)
+    try:
+        result = batchAnalysis.analyzeImage(ring.slot(slot))
+    except Exception as err:
+        result = {"error": repr(err)}
+    result.update({"file": serial + "/" + str(blockID), "device": serial,
+                   "frame": blockID, "slot": slot, "captured": captured})
+    return result
+
+
+def runMultiCamera(dictPath, outPath, serials=None, profile=None, maxFrames=None,
+                   duration=None, workers=None, numSlots=4, templatePath=None,
+                   useFFT=True, refine=False):
+    """ acquires from every camera at once and analyzes every frame
+
+    Args:
+        dictPath (str): circle dictionary (.cdict or json)
+
+        outPath (str): .csv, .json or .db results, tagged with device and frame
+
+        serials (list): cameras to use, default every enumerated device
+
+        profile (dict): camera settings, default acquisitionConfig
+
+        maxFrames (int): stop each camera after this many grabbed frames
+
+        duration (float): stop everything after this many seconds
+
+        workers (int): analysis processes, default all cores minus one per camera
+
+        numSlots (int): shared memory frames per camera
+
+    Returns:
+        stats (dict): per serial grabbed / dropped / analyzed / fps
+    """
+    backend = backendFromEnvironment()
+    serials = backend.enumerateDevices() if serials is None else list(serials)
+    if not serials:
+        raise RuntimeError("no cameras found")
+    profile = acquisitionConfig if profile is None else profile
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count() - len(serials))
+    circleDict, _ = loadCircleDict(dictPath, templatePath)
+    writer = ResultWriter(outPath, circleDict.batch, tagFields=("device", "frame"))
+    readyQueue = multiprocessing.Queue()
+    slotQueues = {serial: multiprocessing.Queue() for serial in serials}
+    stopEvent = multiprocessing.Event()
+    finished = queue.Queue()
+    rings = {}
+    stats = {serial: {"analyzed": 0, "failed": 0} for serial in serials}
+    processes = [multiprocessing.Process(target=acquisitionWorker,
+                                         args=(serial, profile, slotQueues[serial],
+                                               readyQueue, stopEvent, maxFrames),
+                                         daemon=True)
+                 for serial in serials]
+    print("acquiring from " + ", ".join(serials) + " with "
+          + str(workers) + " analysis workers")
+    started = time.monotonic()
+    pending = 0
+    running = len(serials)
+    try:
+        with multiprocessing.Pool(processes=workers,
+                                  initializer=batchAnalysis.initWorker,
+                                  initargs=(dictPath, templatePath, useFFT, refine)) as pool:
+            for each in processes:
+                each.start()
+            while running or pending:
+                if duration is not None and time.monotonic() - started > duration:
+                    stopEvent.set()
+                # finished analyses hand their slot back to the camera
+                while True:
+                    try:
+                        result = finished.get_nowait()
+                    except queue.Empty:
+                        break
+                    pending = pending - 1
+                    slotQueues[result["device"]].put(result.pop("slot"))
+                    writer.write(result)
+                    key = "failed" if "error" in result else "analyzed"
+                    stats[result["device"]][key] += 1
+                try:
+                    message = readyQueue.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                kind, serial = message[0], message[1]
+                if kind == "shape":
+                    rings[serial] = SharedFrameRing(message[2], message[3], numSlots)
+                    slotQueues[serial].put(rings[serial].spec())
+                    for slot in range(numSlots):
+                        slotQueues[serial].put(slot)
+                elif kind == "frame":
+                    pending = pending + 1
+                    pool.apply_async(analyzeSlot,
+                                     (serial, rings[serial].spec(), message[2], message[3],
+                                      time.time()),
+                                     callback=finished.put,
+                                     error_callback=lambda err, serial=serial, slot=message[2]:
+                                     finished.put({"device": serial, "file": serial,
+                                                   "slot": slot, "error": repr(err)}))
+                elif kind == "error":
+                    print(serial + " stopped: " + message[2])
+                elif kind == "done":
+                    running = running - 1
+                    stats[serial].update(message[2])
+    finally:
+        stopEvent.set()
+        for each in processes:
+            each.join(timeout=10)
+        writer.close()
+        for ring in rings.values():
+            ring.close()
+    elapsed = time.monotonic() - started
+    total = sum(each["analyzed"] for each in stats.values())
+    for serial in serials:
+        print(serial + ": " + str(stats[serial]))
+    print("analyzed " + str(total) + " frames in " + str(round(elapsed, 1))
+          + " s, " + str(round(total / elapsed, 1)) + " frames/s")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="D4Scope multi-camera acquisition and analysis")
+    parser.add_argument("--dict", required=True, dest="dictPath",
+                        help="circle dictionary .cdict or json")
+    parser.add_argument("--out", required=True, help="results .csv, .json or .db")
+    parser.add_argument("--serials", nargs="+", default=None,
+                        help="camera serial numbers, default: every camera found")
+    parser.add_argument("--frames", type=int, default=None, help="frames per camera")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run")
+    parser.add_argument("--workers", type=int, default=None, help="analysis processes")
+    parser.add_argument("--refine", action="store_true",
+                        help="refine every spot center around the match before quantifying")
+    args = parser.parse_args(argv)
+    if args.frames is None and args.duration is None:
+        parser.error("give --frames and/or --duration")
+    runMultiCamera(args.dictPath, args.out, serials=args.serials,
+                   maxFrames=args.frames, duration=args.duration,
+                   workers=args.workers, refine=args.refine)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
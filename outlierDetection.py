@@ -0,0 +1,235 @@
+"""
+Outlier detection for replicate spots (einsteinUI item 6). Two parts:
+1) within an image: every spot is compared to the other replicates of the
+   same image with robust statistics, all images of a spot table at once
+   - robust z: 0.6745 * (x - median) / MAD over the whole array
+   - Hampel: |x - median| > threshold * 1.4826 * MAD over the spot's nearest
+     neighbours on the array, so smooth gradients across the chip aren't
+     flagged. the MAD of a small window is biased low and noisy, so it is
+     corrected for the window size (Croux and Rousseeuw) and the threshold
+     sits above the usual 3
+2) across images: RunningSpotStats keeps a streaming mean / variance per
+   batch and spot position (Welford), so a new capture is scored against
+   every earlier capture in constant time, without the history
+
+    flags = flagOutliers(spotTable, circleDict.spotInfo)
+    history = RunningSpotStats.load("spot_history.json")
+    scores = history.score(circleDict.batch, spotSignal(spotTable))
+    history.update(circleDict.batch, spotSignal(spotTable), exclude=flags["outlier"])
+"""
+
+import json
+import os
+
+import numpy as np
+
+outlierConfig = {"zThreshold": 3.5,       # robust z, Iglewicz and Hoaglin
+                 "hampelThreshold": 4.0,  # scaled MADs from the local median
+                 "neighbours": 16,        # replicates in each Hampel window
+                 "historyThreshold": 4.0,  # z against earlier captures
+                 "minHistory": 5}         # captures before history is scored
+
+outlierDtype = np.dtype([("image", np.int32),
+                         ("spot", np.int32),
+                         ("value", np.float64),
+                         ("zScore", np.float64),
+                         ("hampelScore", np.float64),
+                         ("outlier", np.bool_)])
+
+# MAD of normal data times this is its standard deviation
+madScale = 1.4826
+# finite sample correction of madScale for windows of n <= 9 values,
+# n / (n - 0.8) above (Croux and Rousseeuw 1992)
+_madSmallSample = {2: 1.196, 3: 1.495, 4: 1.363, 5: 1.206, 6: 1.200, 7: 1.140,
+                   8: 1.129, 9: 1.107}
+
+# nearest neighbour windows, keyed by (spot_info bytes, neighbours)
+_neighbourCache = {}
+
+
+def spotSignal(spotTable):
+    """ background subtracted spot intensity, mean - bgMedian """
+    return spotTable["mean"] - spotTable["bgMedian"]
+
+
+def neighbourWindows(spotInfo, neighbours=None):
+    """ indices of each spot and its nearest replicates on the array
+
+    Returns:
+        windows (np array): (spots, neighbours + 1) int, column 0 is the spot
+    """
+    neighbours = outlierConfig["neighbours"] if neighbours is None else neighbours
+    spots = np.asarray(spotInfo, dtype=np.float64).reshape(-1, 3)
+    key = (spots.tobytes(), neighbours)
+    cached = _neighbourCache.get(key)
+    if cached is not None:
+        return cached
+    size = min(neighbours + 1, len(spots))
+    distSq = ((spots[:, np.newaxis, :2] - spots[np.newaxis, :, :2])**2).sum(axis=2)
+    # the spot itself is at distance 0, so it sorts first
+    windows = np.argsort(distSq, axis=1, kind="stable")[:, :size]
+    windows.setflags(write=False)
+    _neighbourCache[key] = windows
+    return windows
+
+
+def madCorrection(size):
+    """ unbiasing factor for the scaled MAD of size values """
+    if size < 2:
+        return 1.0
+    return _madSmallSample.get(size, size / (size - 0.8))
+
+
+def _medianMad(values, axis):
+    """ nan ignoring median and MAD along axis, dimensions kept """
+    median = np.nanmedian(values, axis=axis, keepdims=True)
+    mad = np.nanmedian(np.abs(values - median), axis=axis, keepdims=True)
+    return median, mad
+
+
+def flagOutliers(spotTable, spotInfo=None, values=None, zThreshold=None,
+                 hampelThreshold=None, neighbours=None):
+    """ Flags replicate spots that disagree with the rest of their image
+
+    One vectorized pass over every image in the table: the values are laid
+    out as (images, spots), medians and MADs are taken along the spot axis
+    and, for the Hampel test, along each spot's neighbour window.
+
+    Args:
+        spotTable (np structured array): quantifySpots output, one or more
+            images of the same circle dictionary
+
+        spotInfo (list or np array): [x, y, r] per spot, enables the Hampel
+            test. without it only the robust z test runs
+
+        values (np array): value per row to test, default spotSignal
+
+        zThreshold, hampelThreshold, neighbours: see outlierConfig
+
+    Returns:
+        flags (np structured array): one row per spotTable row, fields in
+            outlierDtype. scores are nan where they can't be computed (MAD 0)
+    """
+    zThreshold = outlierConfig["zThreshold"] if zThreshold is None else zThreshold
+    if hampelThreshold is None:
+        hampelThreshold = outlierConfig["hampelThreshold"]
+    values = spotSignal(spotTable) if values is None else np.asarray(values, dtype=np.float64)
+    numSpots = int(spotTable["spot"].max()) + 1 if len(spotTable) else 0
+    flags = np.zeros(len(spotTable), dtype=outlierDtype)
+    flags["image"] = spotTable["image"]
+    flags["spot"] = spotTable["spot"]
+    flags["value"] = values
+    if numSpots == 0:
+        return flags
+    if len(spotTable) % numSpots:
+        raise ValueError("spot table rows must be whole images of " + str(numSpots) + " spots")
+    grid = values.reshape(-1, numSpots)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        median, mad = _medianMad(grid, axis=1)
+        zScore = 0.6745 * (grid - median) / mad
+        hampelScore = np.full(grid.shape, np.nan)
+        if spotInfo is not None:
+            windows = neighbourWindows(spotInfo, neighbours)
+            # (images, spots, window) without a python loop
+            localMedian, localMad = _medianMad(grid[:, windows], axis=2)
+            localScale = madScale * madCorrection(windows.shape[1]) * localMad[..., 0]
+            hampelScore = (grid - localMedian[..., 0]) / localScale
+    flags["zScore"] = zScore.ravel()
+    flags["hampelScore"] = hampelScore.ravel()
+    flags["outlier"] = ((np.abs(flags["zScore"]) > zThreshold) |
+                        (np.abs(flags["hampelScore"]) > hampelThreshold))
+    return flags
+
+
+class RunningSpotStats():
+    """ Streaming per batch, per spot position statistics across captures
+
+    Welford's running mean and variance: update and score cost the same for
+    the first capture and the thousandth, and only count / mean / m2 per spot
+    are kept. Saved as json, like the circle dictionaries. changed tells
+    whether there is anything new to save since loading or the last save.
+
+    Args:
+        path (str): json file save() writes to by default
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.batches = {}
+        self.changed = False
+
+    def _state(self, batch, numSpots):
+        state = self.batches.get(batch)
+        if state is None or len(state["mean"]) != numSpots:
+            state = {"count": np.zeros(numSpots, dtype=np.int64),
+                     "mean": np.zeros(numSpots),
+                     "m2": np.zeros(numSpots)}
+            self.batches[batch] = state
+        return state
+
+    def update(self, batch, values, exclude=None):
+        """ adds one capture, values has one entry per spot. spots where
+            exclude is True (e.g. flagOutliers "outlier") or the value is
+            nan leave the history unchanged
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        state = self._state(batch, len(values))
+        use = np.isfinite(values)
+        if exclude is not None:
+            use = use & ~np.asarray(exclude, dtype=bool).ravel()
+        state["count"][use] += 1
+        delta = values[use] - state["mean"][use]
+        state["mean"][use] += delta / state["count"][use]
+        state["m2"][use] += delta * (values[use] - state["mean"][use])
+        self.changed = True
+
+    def stats(self, batch):
+        """ count, mean and standard deviation per spot, None for a new batch """
+        state = self.batches.get(batch)
+        if state is None:
+            return None
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std = np.sqrt(state["m2"] / (state["count"] - 1))
+        return {"count": state["count"].copy(), "mean": state["mean"].copy(), "std": std}
+
+    def score(self, batch, values, threshold=None, minHistory=None):
+        """ z of each spot against that spot's history
+
+        Returns:
+            zScore (np array): nan where the spot has fewer than minHistory
+                earlier captures
+
+            outlier (np array): bool, |zScore| > threshold
+        """
+        threshold = outlierConfig["historyThreshold"] if threshold is None else threshold
+        minHistory = outlierConfig["minHistory"] if minHistory is None else minHistory
+        values = np.asarray(values, dtype=np.float64).ravel()
+        zScore = np.full(len(values), np.nan)
+        stats = self.stats(batch)
+        if stats is not None and len(stats["mean"]) == len(values):
+            enough = stats["count"] >= max(minHistory, 2)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                zScore[enough] = (values[enough] - stats["mean"][enough]) / stats["std"][enough]
+        with np.errstate(invalid="ignore"):
+            return zScore, np.abs(zScore) > threshold
+
+    def save(self, path=None):
+        path = self.path if path is None else path
+        data = {batch: {name: state[name].tolist() for name in ("count", "mean", "m2")}
+                for batch, state in self.batches.items()}
+        with open(path, "w") as outFile:
+            json.dump(data, outFile)
+        self.changed = False
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """ the saved history, or an empty one that saves to path """
+        history = cls(path)
+        if os.path.exists(path):
+            with open(path, "r") as inFile:
+                data = json.load(inFile)
+            for batch, state in data.items():
+                history.batches[batch] = {"count": np.asarray(state["count"], dtype=np.int64),
+                                          "mean": np.asarray(state["mean"], dtype=np.float64),
+                                          "m2": np.asarray(state["m2"], dtype=np.float64)}
+        return history
@@ -0,0 +1,223 @@
+"""
+Append only results store: one SQLite file holding every analyzed image and
+its per-spot measurements, so trends over months of runs are a query instead
+of re-reading tiffs.
+1) images: file, batch, device, capture time, match offset, metadata json
+2) spots: one row per (image, spot), the spotTable fields
+3) indexes on (batch, captured), (device, captured) and captured, so range
+   queries by batch, device and time only touch the rows they return
+
+    store = ResultsStore("results.db")
+    store.addResults(results, batch="leptin-1")       # one transaction
+    series = store.spotSeries("leptin-1", "mean", start=time.time() - 30 * 86400)
+
+usage:
+    python resultsStore.py results.db --batch leptin-1 --days 30
+"""
+
+import argparse
+import datetime
+import json
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from spotAnalysis import spotTableDtype
+
+# spotTable fields kept per spot, everything but the image index
+spotFields = [name for name in spotTableDtype.names if name != "image"]
+
+_schema = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    file TEXT,
+    batch TEXT,
+    device TEXT,
+    captured REAL,
+    matchCol INTEGER,
+    matchRow INTEGER,
+    metadata TEXT);
+CREATE INDEX IF NOT EXISTS imagesBatch ON images (batch, captured);
+CREATE INDEX IF NOT EXISTS imagesDevice ON images (device, captured);
+CREATE INDEX IF NOT EXISTS imagesCaptured ON images (captured);
+CREATE TABLE IF NOT EXISTS spots (
+    imageId INTEGER NOT NULL REFERENCES images (id),
+    %s,
+    PRIMARY KEY (imageId, spot)) WITHOUT ROWID;
+""" % ",\n    ".join(name + (" INTEGER" if spotTableDtype[name].kind == "i" else " REAL")
+                      for name in spotFields)
+
+
+def _timeValue(when):
+    """ unix seconds from a number, a datetime or None """
+    if when is None or isinstance(when, (int, float)):
+        return when
+    return when.timestamp()
+
+
+class ResultsStore():
+    """ SQLite store of analysis results, inserts only
+
+    Args:
+        path (str): database file, created with its schema if missing
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # one writer, many readers; fsync per checkpoint instead of per insert
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_schema)
+
+    def addResults(self, results, batch=None):
+        """ bulk insert in one transaction
+
+        Args:
+            results (list): batchAnalysis style dicts: spotTable and match,
+                plus optional file, batch, device, captured (unix seconds or
+                datetime) and metadata. results with an error get an image
+                row, with the error in its metadata, and no spots
+
+            batch (str): batch of results that don't name one
+
+        Returns:
+            imageIds (list): row id of every inserted image
+        """
+        imageIds = []
+        with self.connection:
+            cursor = self.connection.cursor()
+            for result in results:
+                match = result.get("match")
+                metadata = result.get("metadata")
+                if "error" in result:
+                    metadata = dict(metadata or {}, error=result["error"])
+                captured = _timeValue(result.get("captured"))
+                cursor.execute("INSERT INTO images (file, batch, device, captured, matchCol,"
+                               " matchRow, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (result.get("file"),
+                                result.get("batch", batch),
+                                result.get("device"),
+                                time.time() if captured is None else captured,
+                                None if match is None else int(match[0]),
+                                None if match is None else int(match[1]),
+                                None if metadata is None else json.dumps(metadata)))
+                imageId = cursor.lastrowid
+                imageIds.append(imageId)
+                if "error" in result:
+                    continue
+                spotTable = result["spotTable"]
+                columns = [spotTable[name].tolist() for name in spotFields]
+                cursor.executemany("INSERT INTO spots (imageId, " + ", ".join(spotFields)
+                                   + ") VALUES (" + ", ".join("?" * (len(spotFields) + 1)) + ")",
+                                   ((imageId,) + row for row in zip(*columns)))
+        return imageIds
+
+    def _where(self, batch, device, start, end):
+        clauses = []
+        values = []
+        for clause, value in (("images.batch = ?", batch),
+                              ("images.device = ?", device),
+                              ("images.captured >= ?", _timeValue(start)),
+                              ("images.captured < ?", _timeValue(end))):
+            if value is not None:
+                clauses.append(clause)
+                values.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", values
+
+    def images(self, batch=None, device=None, start=None, end=None, limit=None):
+        """ image rows in capture order, filtered by any of batch, device and
+            capture time range [start, end)
+
+        Returns:
+            images (list): dicts with id, file, batch, device, captured,
+                matchCol, matchRow and metadata
+        """
+        where, values = self._where(batch, device, start, end)
+        query = ("SELECT id, file, batch, device, captured, matchCol, matchRow, metadata"
+                 " FROM images" + where + " ORDER BY captured")
+        if limit is not None:
+            query = query + " LIMIT " + str(int(limit))
+        rows = []
+        for row in self.connection.execute(query, values):
+            record = dict(zip(("id", "file", "batch", "device", "captured",
+                               "matchCol", "matchRow", "metadata"), row))
+            if record["metadata"] is not None:
+                record["metadata"] = json.loads(record["metadata"])
+            rows.append(record)
+        return rows
+
+    def spotSeries(self, batch=None, field="mean", spot=None, device=None,
+                   start=None, end=None):
+        """ one spotTable field over time
+
+        Args:
+            field (str): any spotTable field, e.g. mean, bgMedian, integrated
+
+            spot (int): a single spot position, default every spot
+
+        Returns:
+            series (dict): np arrays imageId, captured, spot and value, one
+                entry per (image, spot) in capture order
+        """
+        if field not in spotFields:
+            raise ValueError("unknown spot field " + str(field))
+        where, values = self._where(batch, device, start, end)
+        if spot is not None:
+            where = (where + " AND" if where else " WHERE") + " spots.spot = ?"
+            values.append(int(spot))
+        rows = self.connection.execute(
+            "SELECT images.id, images.captured, spots.spot, spots." + field +
+            " FROM images JOIN spots ON spots.imageId = images.id" + where +
+            " ORDER BY images.captured, spots.spot", values).fetchall()
+        columns = list(zip(*rows)) if rows else [(), (), (), ()]
+        return {"imageId": np.asarray(columns[0], dtype=np.int64),
+                "captured": np.asarray(columns[1], dtype=np.float64),
+                "spot": np.asarray(columns[2], dtype=np.int32),
+                "value": np.asarray(columns[3], dtype=np.float64)}
+
+    def spotTable(self, imageId):
+        """ the stored spotTable of one image """
+        rows = self.connection.execute("SELECT " + ", ".join(spotFields) + " FROM spots"
+                                       " WHERE imageId = ? ORDER BY spot", (imageId,)).fetchall()
+        spotTable = np.zeros(len(rows), dtype=spotTableDtype)
+        for index, name in enumerate(spotFields):
+            spotTable[name] = [row[index] for row in rows]
+        return spotTable
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="query a D4Scope results store")
+    parser.add_argument("store", help="results .db")
+    parser.add_argument("--batch", default=None)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--days", type=float, default=None, help="only the last N days")
+    parser.add_argument("--field", default="mean", help="spotTable field to summarize")
+    args = parser.parse_args(argv)
+    store = ResultsStore(args.store)
+    start = time.time() - args.days * 86400 if args.days is not None else None
+    began = time.perf_counter()
+    series = store.spotSeries(args.batch, args.field, device=args.device, start=start)
+    elapsed = time.perf_counter() - began
+    store.close()
+    if len(series["value"]) == 0:
+        print("no results")
+        return 1
+    first = datetime.datetime.fromtimestamp(series["captured"].min())
+    last = datetime.datetime.fromtimestamp(series["captured"].max())
+    print(str(len(np.unique(series["imageId"]))) + " images, " + str(len(series["value"]))
+          + " spots from " + first.isoformat(" ", "seconds") + " to "
+          + last.isoformat(" ", "seconds") + " (" + str(round(elapsed * 1000, 1)) + " ms)")
+    for spot in np.unique(series["spot"]):
+        values = series["value"][series["spot"] == spot]
+        print("spot %3d  %s %9.2f  sd %8.2f" % (spot, args.field, np.nanmean(values),
+                                                np.nanstd(values)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
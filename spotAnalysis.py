@@ -0,0 +1,450 @@
+"""
+Spot analysis tools for circle dictionaries (standard_image.json). Will have:
+1) Spot mask engine: spot_info -> label image and flat pixel indices
+2) Per-spot quantification (mean, median, integrated, background annulus)
+3) Sub-pixel spot center refinement after the template match
+"""
+
+import warnings
+
+import numpy as np
+
+from stageTiming import timed
+
+# background ring around each spot, in pixels past the spot radius
+backgroundAnnulus = {"gap": 4,
+                     "width": 8}
+
+# masks are keyed by (spot_info bytes, shape), see spotMask
+_spotMaskCache = {}
+_backgroundCache = {}
+
+spotTableDtype = np.dtype([("image", np.int32),
+                           ("spot", np.int32),
+                           ("x", np.int32),
+                           ("y", np.int32),
+                           ("radius", np.int32),
+                           ("pixels", np.int64),
+                           ("mean", np.float64),
+                           ("median", np.float64),
+                           ("integrated", np.float64),
+                           ("bgPixels", np.int64),
+                           ("bgMean", np.float64),
+                           ("bgMedian", np.float64)])
+
+# search window past each spot radius, and when a refined center is trusted
+spotRefinement = {"margin": 6,
+                  "iterations": 2,
+                  "minContrast": 0.5}
+
+refinedDtype = np.dtype([("spot", np.int32),
+                         ("x", np.float64),
+                         ("y", np.float64),
+                         ("dx", np.float64),
+                         ("dy", np.float64),
+                         ("contrast", np.float64),
+                         ("roundness", np.float64),
+                         ("quality", np.float64),
+                         ("refined", np.bool_)])
+
+
+def _spotArray(spotInfo):
+    """ converts a spot_info list ([x, y, r] per spot) into an (n, 3) int32 array """
+    spots = np.asarray(spotInfo).reshape(-1, 3)
+    return np.ascontiguousarray(np.around(spots), dtype=np.int32)
+
+
+def spotPixels(spotInfo, shape=None):
+    """ Vectorized pixel membership for every spot in spot_info
+
+    Uses the same pixel rule as the original circlePixelID loop: columns
+    x - r to x + r - 1, and for each column the rows within the integer
+    half-height of the circle at that column. All spots are evaluated at once
+    on a shared (2R x 2R) offset grid, R being the largest radius.
+
+    Args:
+        spotInfo (list or np array): [x, y, r] per spot
+
+        shape (tuple): (rows, cols) of the image the spots live in. pixels
+            outside it are dropped. None keeps every pixel
+
+    Returns:
+        xs (np array): column of each pixel (int32)
+
+        ys (np array): row of each pixel (int32)
+
+        spotIds (np array): index into spotInfo of each pixel (int32)
+    """
+    spots = _spotArray(spotInfo)
+    if len(spots) == 0:
+        empty = np.zeros(0, dtype=np.int32)
+        return empty, empty, empty
+    maxRad = int(spots[:, 2].max())
+    offsets = np.arange(-maxRad, maxRad, dtype=np.int32)
+    dx = offsets[np.newaxis, np.newaxis, :]
+    dy = offsets[np.newaxis, :, np.newaxis]
+    rad = spots[:, 2, np.newaxis, np.newaxis]
+    halfHeight = np.sqrt(np.maximum(rad**2 - dx**2, 0)).astype(np.int32)
+    inside = ((dx >= -rad) & (dx < rad) &
+              (dy >= -halfHeight) & (dy < halfHeight))
+    spotIds, rowIdx, colIdx = np.nonzero(inside)
+    xs = spots[spotIds, 0] + offsets[colIdx]
+    ys = spots[spotIds, 1] + offsets[rowIdx]
+    if shape is None:
+        return xs.astype(np.int32), ys.astype(np.int32), spotIds.astype(np.int32)
+    inBounds = (xs >= 0) & (xs < shape[1]) & (ys >= 0) & (ys < shape[0])
+    return (xs[inBounds].astype(np.int32),
+            ys[inBounds].astype(np.int32),
+            spotIds[inBounds].astype(np.int32))
+
+
+def spotMask(spotInfo, shape):
+    """ Label image and flat index arrays for a circle dictionary
+
+    Results are cached by (spot_info, shape), so repeated calls with the same
+    dictionary are a dictionary lookup. The returned arrays are read only
+    because they are shared between callers.
+
+    Args:
+        spotInfo (list or np array): [x, y, r] per spot, as in
+            standard_image.json
+
+        shape (tuple): (rows, cols) of the label image
+
+    Returns:
+        labelImg (np array): int32 image, 0 = background, spot i = i + 1
+
+        pixelIdx (np array): flat (row * cols + col) indices of every spot
+            pixel, grouped by spot
+
+        pixelLabels (np array): label (spot index + 1) of each entry in
+            pixelIdx
+    """
+    spots = _spotArray(spotInfo)
+    shape = (int(shape[0]), int(shape[1]))
+    key = (spots.tobytes(), shape)
+    cached = _spotMaskCache.get(key)
+    if cached is not None:
+        return cached
+    xs, ys, spotIds = spotPixels(spots, shape)
+    labelImg = np.zeros(shape, dtype=np.int32)
+    # later spots win where circles overlap, same as the per-pixel loop did
+    labelImg[ys, xs] = spotIds + 1
+    pixelIdx = np.flatnonzero(labelImg)
+    pixelLabels = labelImg.ravel()[pixelIdx]
+    order = np.argsort(pixelLabels, kind="stable")
+    pixelIdx = pixelIdx[order]
+    pixelLabels = pixelLabels[order]
+    for each in (labelImg, pixelIdx, pixelLabels):
+        each.setflags(write=False)
+    cached = (labelImg, pixelIdx, pixelLabels)
+    _spotMaskCache[key] = cached
+    return cached
+
+
+def backgroundPixels(spotInfo, shape, gap=None, width=None):
+    """ Background annulus pixels for every spot, cached like spotMask
+
+    The annulus runs from r + gap to r + gap + width around each spot center.
+    Pixels that belong to any spot are left out, and a pixel may sit in the
+    annuli of two neighbouring spots. Coordinates are in pattern space and are
+    not clipped to shape, since the pattern usually sits inside a larger image.
+
+    Args:
+        spotInfo (list or np array): [x, y, r] per spot
+
+        shape (tuple): (rows, cols) of the pattern the spots were found in
+
+        gap (int): pixels between the spot edge and the annulus. defaults to
+            backgroundAnnulus["gap"]
+
+        width (int): annulus thickness. defaults to backgroundAnnulus["width"]
+
+    Returns:
+        xs (np array): column of each annulus pixel (int32)
+
+        ys (np array): row of each annulus pixel (int32)
+
+        pixelLabels (np array): label (spot index + 1) of each pixel
+    """
+    gap = backgroundAnnulus["gap"] if gap is None else int(gap)
+    width = backgroundAnnulus["width"] if width is None else int(width)
+    spots = _spotArray(spotInfo)
+    shape = (int(shape[0]), int(shape[1]))
+    key = (spots.tobytes(), shape, gap, width)
+    cached = _backgroundCache.get(key)
+    if cached is not None:
+        return cached
+    if len(spots) == 0:
+        empty = np.zeros(0, dtype=np.int32)
+        return empty, empty, empty
+    outer = int(spots[:, 2].max()) + gap + width
+    offsets = np.arange(-outer, outer + 1, dtype=np.int32)
+    dx = offsets[np.newaxis, np.newaxis, :]
+    dy = offsets[np.newaxis, :, np.newaxis]
+    distSq = dx**2 + dy**2
+    innerRad = spots[:, 2, np.newaxis, np.newaxis] + gap
+    ring = (distSq >= innerRad**2) & (distSq < (innerRad + width)**2)
+    spotIds, rowIdx, colIdx = np.nonzero(ring)
+    xs = spots[spotIds, 0] + offsets[colIdx]
+    ys = spots[spotIds, 1] + offsets[rowIdx]
+    labelImg, _, _ = spotMask(spots, shape)
+    inPattern = (xs >= 0) & (xs < shape[1]) & (ys >= 0) & (ys < shape[0])
+    onSpot = np.zeros(len(xs), dtype=bool)
+    onSpot[inPattern] = labelImg[ys[inPattern], xs[inPattern]] > 0
+    keep = ~onSpot
+    cached = (xs[keep].astype(np.int32),
+              ys[keep].astype(np.int32),
+              (spotIds[keep] + 1).astype(np.int32))
+    for each in cached:
+        each.setflags(write=False)
+    _backgroundCache[key] = cached
+    return cached
+
+
+def primeMaskCache(spotInfo, shape, masks, background=None, gap=None, width=None):
+    """ installs precomputed spotMask (and backgroundPixels) arrays, e.g. the
+        memory mapped ones of a .cdict (circleDictionary), so they are never
+        rebuilt. masks and background are the tuples those functions return
+    """
+    gap = backgroundAnnulus["gap"] if gap is None else int(gap)
+    width = backgroundAnnulus["width"] if width is None else int(width)
+    spotBytes = _spotArray(spotInfo).tobytes()
+    shape = (int(shape[0]), int(shape[1]))
+    _spotMaskCache[(spotBytes, shape)] = tuple(masks)
+    if background is not None:
+        _backgroundCache[(spotBytes, shape, gap, width)] = tuple(background)
+
+
+def _groupStats(values, groups, numGroups):
+    """ counts, sums and medians of values per group id in [0, numGroups)
+
+    one bincount pass for counts and sums, one lexsort for the medians.
+    empty groups get nan mean and median.
+    """
+    counts = np.bincount(groups, minlength=numGroups)
+    sums = np.bincount(groups, weights=values, minlength=numGroups)
+    order = np.lexsort((values, groups))
+    sortedVals = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(numGroups, np.nan)
+    filled = counts > 0
+    lowIdx = starts[filled] + (counts[filled] - 1) // 2
+    highIdx = starts[filled] + counts[filled] // 2
+    medians[filled] = (sortedVals[lowIdx] + sortedVals[highIdx]) / 2.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return counts, sums, means, medians
+
+
+@timed("refine")
+def refineSpotCenters(image, offset, spotInfo, margin=None, iterations=None,
+                      minContrast=None):
+    """ Sub-pixel center of every spot near where the template match puts it
+
+    Each spot gets a square window (largest radius + margin) around its
+    expected center. All windows are gathered with one fancy index into an
+    (n, w, w) stack, so the cost scales with the number of spots and not with
+    the image. Per window the background level and noise come from the median
+    and MAD of the corners outside radius + margin; pixels more than one noise
+    level above background inside that radius weight an intensity centroid.
+    The window is recentered on the centroid and the fit repeated.
+
+    Args:
+        image (np array): 2d image at any bit depth
+
+        offset (tuple): topLeftMatch (col, row) from templateMatch8b
+
+        spotInfo (list or np array): [x, y, r] per spot
+
+        margin (int): search distance past the spot radius, in pixels.
+            defaults to spotRefinement["margin"]
+
+        iterations (int): recentering passes, spotRefinement["iterations"]
+
+        minContrast (float): (spot mean - background) / noise below which a
+            spot keeps its expected center, spotRefinement["minContrast"]
+
+    Returns:
+        refined (np structured array): refinedDtype row per spot. x, y are
+            image coordinates, dx, dy the shift from the expected center,
+            quality in [0, 1] (contrast and roundness), refined is False
+            where the expected center was kept
+    """
+    margin = spotRefinement["margin"] if margin is None else int(margin)
+    iterations = spotRefinement["iterations"] if iterations is None else int(iterations)
+    minContrast = spotRefinement["minContrast"] if minContrast is None else minContrast
+    spots = _spotArray(spotInfo)
+    refined = np.zeros(len(spots), dtype=refinedDtype)
+    refined["spot"] = np.arange(len(spots))
+    if len(spots) == 0:
+        return refined
+    expectX = (spots[:, 0] + offset[0]).astype(np.float64)
+    expectY = (spots[:, 1] + offset[1]).astype(np.float64)
+    rad = spots[:, 2, np.newaxis, np.newaxis].astype(np.float64)
+    half = int(spots[:, 2].max()) + margin
+    offsets = np.arange(-half, half + 1)
+    dx = offsets[np.newaxis, np.newaxis, :].astype(np.float64)
+    dy = offsets[np.newaxis, :, np.newaxis].astype(np.float64)
+    distSq = dx**2 + dy**2
+    centerX = expectX.copy()
+    centerY = expectY.copy()
+    for each in range(max(iterations, 1)):
+        colIdx = np.rint(centerX).astype(np.int64)
+        rowIdx = np.rint(centerY).astype(np.int64)
+        xs = colIdx[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        ys = rowIdx[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        valid = ((xs >= 0) & (xs < image.shape[1]) &
+                 (ys >= 0) & (ys < image.shape[0]))
+        values = image[np.clip(ys, 0, image.shape[0] - 1),
+                       np.clip(xs, 0, image.shape[1] - 1)].astype(np.float64)
+        aperture = (distSq <= (rad + margin)**2) & valid
+        corners = np.where(~aperture & valid, values, np.nan)
+        with warnings.catch_warnings():
+            # windows entirely off the image have no corners
+            warnings.simplefilter("ignore", RuntimeWarning)
+            background = np.nanmedian(corners, axis=(1, 2))
+            noise = 1.4826 * np.nanmedian(np.abs(corners - background[:, np.newaxis, np.newaxis]),
+                                          axis=(1, 2))
+        background = np.nan_to_num(background)
+        noise = np.maximum(np.nan_to_num(noise), 1.0)
+        level = (background + noise)[:, np.newaxis, np.newaxis]
+        weights = np.where(aperture, np.maximum(values - level, 0), 0)
+        totals = weights.sum(axis=(1, 2))
+        hasSignal = totals > 0
+        safeTotals = np.where(hasSignal, totals, 1.0)
+        shiftX = (weights * dx).sum(axis=(1, 2)) / safeTotals
+        shiftY = (weights * dy).sum(axis=(1, 2)) / safeTotals
+        centerX = np.where(hasSignal, colIdx + shiftX, centerX)
+        centerY = np.where(hasSignal, rowIdx + shiftY, centerY)
+
+    # spot contrast inside the radius around the final center
+    inSpot = (((xs - centerX[:, np.newaxis, np.newaxis])**2 +
+               (ys - centerY[:, np.newaxis, np.newaxis])**2) <= rad**2) & valid
+    spotCounts = np.maximum(inSpot.sum(axis=(1, 2)), 1)
+    spotMeans = np.where(inSpot, values, 0).sum(axis=(1, 2)) / spotCounts
+    contrast = (spotMeans - background) / noise
+    # roundness from the weighted second moments, 1 for a symmetric spot
+    relX = xs - centerX[:, np.newaxis, np.newaxis]
+    relY = ys - centerY[:, np.newaxis, np.newaxis]
+    sxx = (weights * relX**2).sum(axis=(1, 2)) / safeTotals
+    syy = (weights * relY**2).sum(axis=(1, 2)) / safeTotals
+    sxy = (weights * relX * relY).sum(axis=(1, 2)) / safeTotals
+    spread = np.sqrt((sxx - syy)**2 + 4 * sxy**2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        roundness = np.sqrt(np.maximum(sxx + syy - spread, 0) / (sxx + syy + spread))
+    roundness = np.where(hasSignal, np.nan_to_num(roundness), 0.0)
+    shifted = np.hypot(centerX - expectX, centerY - expectY)
+    trusted = hasSignal & (contrast >= minContrast) & (shifted <= margin)
+    refined["x"] = np.where(trusted, centerX, expectX)
+    refined["y"] = np.where(trusted, centerY, expectY)
+    refined["dx"] = refined["x"] - expectX
+    refined["dy"] = refined["y"] - expectY
+    refined["contrast"] = contrast
+    refined["roundness"] = roundness
+    # contrast term is 0.5 at twice minContrast, times roundness
+    positive = np.clip(contrast, 0, None)
+    refined["quality"] = np.where(hasSignal,
+                                  positive / (positive + 2 * minContrast) * roundness, 0.0)
+    refined["refined"] = trusted
+    return refined
+
+
+@timed("quantify")
+def quantifySpots(images, offsets, spotInfo, shape, spotShifts=None):
+    """ Per-spot intensity table for one image or a stack of images
+
+    Each image is matched against the same circle dictionary. The spot and
+    annulus pixels of every image are gathered by fancy indexing, then all
+    images and spots are reduced together with bincount, so the cost scales
+    with the number of spot pixels and not with spots times images.
+
+    Args:
+        images (np array or list): a single 2d image, a 3d stack, or a list of
+            2d images (sizes may differ). full bit depth is kept
+
+        offsets (tuple or list): topLeftMatch (col, row) from templateMatch8b,
+            or one per image
+
+        spotInfo (list or np array): [x, y, r] per spot, as in
+            standard_image.json
+
+        shape (tuple): (rows, cols) of the pattern, standard_image.json "shape"
+
+        spotShifts (np array): optional whole pixel (dx, dy) per spot, or
+            (images, spots, 2), e.g. rounded refineSpotCenters dx/dy. each
+            spot's pixels and annulus move with it
+
+    Returns:
+        spotTable (np structured array): one row per (image, spot), fields in
+            spotTableDtype. x and y are in image coordinates
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 2:
+        images = [images]
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    if len(offsets) == 1 and len(images) > 1:
+        offsets = np.repeat(offsets, len(images), axis=0)
+    if len(offsets) != len(images):
+        raise ValueError("need one offset per image, or a single offset")
+    spots = _spotArray(spotInfo)
+    numSpots = len(spots)
+    numGroups = len(images) * (numSpots + 1)
+    _, pixelIdx, pixelLabels = spotMask(spots, shape)
+    spotYs, spotXs = np.divmod(pixelIdx, int(shape[1]))
+    bgXs, bgYs, bgLabels = backgroundPixels(spots, shape)
+    if spotShifts is not None:
+        # label 0 (no spot) never moves
+        spotShifts = np.rint(np.asarray(spotShifts)).astype(np.int64).reshape(-1, numSpots, 2)
+        if len(spotShifts) == 1:
+            spotShifts = np.repeat(spotShifts, len(images), axis=0)
+        spotShifts = np.concatenate((np.zeros((len(images), 1, 2), dtype=np.int64),
+                                     spotShifts), axis=1)
+
+    spotVals, spotGroups, bgVals, bgGroups = [], [], [], []
+    for imageNum, (image, (col, row)) in enumerate(zip(images, offsets)):
+        groupBase = imageNum * (numSpots + 1)
+        xs = spotXs + col
+        ys = spotYs + row
+        if spotShifts is not None:
+            xs = xs + spotShifts[imageNum, pixelLabels, 0]
+            ys = ys + spotShifts[imageNum, pixelLabels, 1]
+        # a match near the frame edge puts part of the pattern off the image
+        inImage = ((xs >= 0) & (xs < image.shape[1]) &
+                   (ys >= 0) & (ys < image.shape[0]))
+        spotVals.append(image[ys[inImage], xs[inImage]].astype(np.float64))
+        spotGroups.append(pixelLabels[inImage] + groupBase)
+        xs = bgXs + col
+        ys = bgYs + row
+        if spotShifts is not None:
+            xs = xs + spotShifts[imageNum, bgLabels, 0]
+            ys = ys + spotShifts[imageNum, bgLabels, 1]
+        inImage = ((xs >= 0) & (xs < image.shape[1]) &
+                   (ys >= 0) & (ys < image.shape[0]))
+        bgVals.append(image[ys[inImage], xs[inImage]].astype(np.float64))
+        bgGroups.append(bgLabels[inImage] + groupBase)
+    counts, sums, means, medians = _groupStats(np.concatenate(spotVals),
+                                               np.concatenate(spotGroups),
+                                               numGroups)
+    bgCounts, _, bgMeans, bgMedians = _groupStats(np.concatenate(bgVals),
+                                                  np.concatenate(bgGroups),
+                                                  numGroups)
+
+    # drop label 0 (background) from every image block
+    rows = np.arange(numGroups).reshape(len(images), numSpots + 1)[:, 1:].ravel()
+    spotTable = np.zeros(len(rows), dtype=spotTableDtype)
+    spotTable["image"] = np.repeat(np.arange(len(images)), numSpots)
+    spotTable["spot"] = np.tile(np.arange(numSpots), len(images))
+    spotTable["x"] = np.tile(spots[:, 0], len(images)) + np.repeat(offsets[:, 0], numSpots)
+    spotTable["y"] = np.tile(spots[:, 1], len(images)) + np.repeat(offsets[:, 1], numSpots)
+    if spotShifts is not None:
+        spotTable["x"] += spotShifts[:, 1:, 0].ravel()
+        spotTable["y"] += spotShifts[:, 1:, 1].ravel()
+    spotTable["radius"] = np.tile(spots[:, 2], len(images))
+    spotTable["pixels"] = counts[rows]
+    spotTable["mean"] = means[rows]
+    spotTable["median"] = medians[rows]
+    spotTable["integrated"] = sums[rows]
+    spotTable["bgPixels"] = bgCounts[rows]
+    spotTable["bgMean"] = bgMeans[rows]
+    spotTable["bgMedian"] = bgMedians[rows]
+    return spotTable
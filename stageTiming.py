@@ -0,0 +1,177 @@
+"""
+Lightweight stage timing for capture -> convert -> match -> quantify -> save.
+1) span("match"): named spans timed with a monotonic clock
+2) rolling latency stats and a log-spaced histogram per span name
+3) counters (frames grabbed, frames dropped, ...)
+4) statusText() for the MainWindow status bar, export() to a json file
+
+Off by default; while off, span() hands back one shared no-op context and
+count() returns immediately, so the instrumented code pays a function call.
+Turn on with enable() or D4SCOPE_TRACE=1 (D4SCOPE_TRACE_FILE=path exports on
+exit from cmdDevTools / einsteinUI).
+
+    with span("capture"):
+        buffer = camera.GrabOne(timeout)
+    count("frames")
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# histogram bin edges in seconds, 4 per decade from 1 us to 100 s
+histogramEdges = [10**(exponent / 4.0) for exponent in range(-24, 9)]
+rollingWindow = 512
+
+_state = {"enabled": os.environ.get("D4SCOPE_TRACE", "") not in ("", "0")}
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_nullSpan = _NullSpan()
+
+
+class _StageStats():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.last = 0.0
+        self.recent = deque(maxlen=rollingWindow)
+        self.histogram = [0] * (len(histogramEdges) + 1)
+
+    def add(self, seconds):
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.last = seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        self.recent.append(seconds)
+        self.histogram[bisect.bisect_right(histogramEdges, seconds)] += 1
+
+    def summary(self):
+        recent = sorted(self.recent)
+        return {"count": self.count,
+                "last": self.last,
+                "mean": self.total / self.count if self.count else 0.0,
+                "p50": recent[len(recent) // 2] if recent else 0.0,
+                "p95": recent[min(int(len(recent) * 0.95), len(recent) - 1)] if recent else 0.0,
+                "max": self.maximum,
+                "histogram": list(self.histogram)}
+
+
+class _Span():
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable(on=True):
+    _state["enabled"] = on
+
+
+def isEnabled():
+    return _state["enabled"]
+
+
+def span(name):
+    """ context manager timing the enclosed block as stage name """
+    if not _state["enabled"]:
+        return _nullSpan
+    return _Span(name)
+
+
+def timed(name):
+    """ decorator version of span """
+    def decorator(func):
+        def wrapped(*args, **kwargs):
+            if not _state["enabled"]:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        wrapped.__name__ = func.__name__
+        wrapped.__doc__ = func.__doc__
+        return wrapped
+    return decorator
+
+
+def record(name, seconds):
+    """ adds one duration (seconds) to stage name, e.g. from a camera timestamp """
+    if not _state["enabled"]:
+        return
+    with _lock:
+        stats = _stages.get(name)
+        if stats is None:
+            stats = _stages[name] = _StageStats()
+        stats.add(seconds)
+
+
+def count(name, amount=1):
+    if not _state["enabled"]:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def summary():
+    """ {"stages": {name: stats}, "counters": {name: value}}, times in seconds """
+    with _lock:
+        return {"stages": {name: stats.summary() for name, stats in _stages.items()},
+                "counters": dict(_counters)}
+
+
+def statusText(stages=("capture", "convert", "match", "quantify", "save")):
+    """ one line for the status bar: last p50 of each stage in ms, plus counters """
+    report = summary()
+    parts = []
+    for name in stages:
+        stats = report["stages"].get(name)
+        if stats:
+            parts.append(name + " " + str(round(stats["p50"] * 1000, 1)) + "ms")
+    for name, value in sorted(report["counters"].items()):
+        parts.append(name + " " + str(value))
+    return "  ".join(parts)
+
+
+def export(filePath):
+    report = summary()
+    report["histogramEdges"] = histogramEdges
+    report["exported"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    with open(filePath, "w") as outFile:
+        json.dump(report, outFile, indent=2)
+    return filePath
+
+
+def exportFromEnvironment():
+    """ exports to D4SCOPE_TRACE_FILE if tracing is on and the variable is set """
+    filePath = os.environ.get("D4SCOPE_TRACE_FILE")
+    if filePath and _state["enabled"]:
+        return export(filePath)
+    return None
@@ -0,0 +1,311 @@
+"""
+Rotation and scale tolerant template matching. templateMatch8b assumes the
+chip sits exactly as in standard_image.tiff; a slightly turned cartridge or a
+focus change lowers its peak until the center prior wins. Here a bank of
+rotated and scaled templates is built once per circle dictionary (cached),
+and matched coarse to fine on a thread pool (cv2.matchTemplate releases the
+GIL):
+1) coarse: every bank entry against the pyrDown'd image, center prior as in
+   templateMatch8b. cheap, the cost is fixed by the bank and coarse sizes
+2) fine: only the best entries and the angle / scale neighbours of the best
+   one, at full resolution in small windows around their coarse peaks. when
+   the fine best isn't the coarse best its missing neighbours follow
+3) angle and scale between bank steps by a parabola through the neighbours
+4) guards: the unturned, unscaled entry is always scored as a baseline and a
+   turned / scaled entry has to beat it by bankConfig["minGain"]; below
+   bankConfig["minConfidence"] there is no chip to speak of and the plain
+   templateMatch8b answer is returned instead, flagged in "method"
+
+    match = matchRotated(image, circleDict.template)
+    spots = transformSpots(circleDict.spotInfo, circleDict.template.shape, match)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from matching import centerWeight, templateMatch8b
+from stageTiming import span, timed
+
+bankConfig = {"maxAngle": 6.0,      # degrees either way
+              "angleStep": 1.0,
+              "minScale": 0.94,
+              "maxScale": 1.06,
+              "scaleStep": 0.02,
+              "coarseLevels": 2,    # pyrDowns for the coarse pass
+              "candidates": 3,      # best coarse entries refined at full resolution
+              "minGain": 0.02,      # weighted score a turned entry needs over the baseline
+              "minConfidence": 0.2,  # below, fall back to templateMatch8b
+              "workers": 4}
+# zero mean correlation: TM_CCORR_NORMED is nearly flat on the bright chip
+# background, too flat to tell neighbouring angles and scales apart
+bankMethod = cv2.TM_CCOEFF_NORMED
+
+# banks by (template bytes, angles, scales, coarseLevels)
+_bankCache = {}
+_pool = []
+
+
+def _threadPool():
+    if not _pool:
+        _pool.append(ThreadPoolExecutor(max_workers=bankConfig["workers"]))
+    return _pool[0]
+
+
+def _steps(low, high, step):
+    count = int(round((high - low) / step)) + 1
+    return np.round(np.linspace(low, high, count), 6)
+
+
+class TemplateBank():
+    """ Rotated and scaled copies of one template, each with its coarse level
+
+    Entry (angleIdx, scaleIdx) is the template turned by angles[angleIdx]
+    degrees (counterclockwise, cv2.getRotationMatrix2D) and scaled by
+    scales[scaleIdx] about its center, on a canvas of the scaled size;
+    corners uncovered by the rotation repeat the border pixels.
+
+    Args:
+        template (np array): 8 bit standard image
+
+        angles, scales (np array): bank steps, default from bankConfig
+
+        coarseLevels (int): pyrDowns of the coarse copies
+    """
+    def __init__(self, template, angles=None, scales=None, coarseLevels=None):
+        if angles is None:
+            angles = _steps(-bankConfig["maxAngle"], bankConfig["maxAngle"],
+                            bankConfig["angleStep"])
+        if scales is None:
+            scales = _steps(bankConfig["minScale"], bankConfig["maxScale"],
+                            bankConfig["scaleStep"])
+        self.template = np.ascontiguousarray(template, dtype=np.uint8)
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self.scales = np.asarray(scales, dtype=np.float64)
+        self.coarseLevels = bankConfig["coarseLevels"] if coarseLevels is None else coarseLevels
+        rows, cols = self.template.shape
+        self.center = ((cols - 1) / 2.0, (rows - 1) / 2.0)
+        self.entries = {}
+        with span("match/bank"):
+            for angleIdx, angle in enumerate(self.angles):
+                for scaleIdx, scale in enumerate(self.scales):
+                    self.entries[(angleIdx, scaleIdx)] = self._entry(angle, scale)
+
+    def _entry(self, angle, scale):
+        rows, cols = self.template.shape
+        size = (max(int(round(cols * scale)), 8), max(int(round(rows * scale)), 8))
+        warpCenter = ((size[0] - 1) / 2.0, (size[1] - 1) / 2.0)
+        warp = cv2.getRotationMatrix2D(self.center, float(angle), float(scale))
+        warp[0, 2] += warpCenter[0] - self.center[0]
+        warp[1, 2] += warpCenter[1] - self.center[1]
+        warped = cv2.warpAffine(self.template, warp, size, flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+        coarse = warped
+        for each in range(self.coarseLevels):
+            coarse = cv2.pyrDown(coarse)
+        return {"template": warped, "coarse": coarse, "warpCenter": warpCenter}
+
+    def identity(self):
+        """ key of the unturned, unscaled entry, None if the bank has none """
+        angleIdx = np.flatnonzero(np.isclose(self.angles, 0.0))
+        scaleIdx = np.flatnonzero(np.isclose(self.scales, 1.0))
+        if len(angleIdx) == 0 or len(scaleIdx) == 0:
+            return None
+        return (int(angleIdx[0]), int(scaleIdx[0]))
+
+    def neighbours(self, key):
+        """ key and its bank neighbours, one angle and / or scale step away """
+        return [(key[0] + angleStep, key[1] + scaleStep)
+                for angleStep in (-1, 0, 1) for scaleStep in (-1, 0, 1)
+                if (key[0] + angleStep, key[1] + scaleStep) in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def templateBank(template, angles=None, scales=None, coarseLevels=None):
+    """ the cached TemplateBank of template, built on first use """
+    key = (template.shape, template.tobytes(),
+           None if angles is None else tuple(angles),
+           None if scales is None else tuple(scales), coarseLevels,
+           bankConfig["maxAngle"], bankConfig["angleStep"], bankConfig["minScale"],
+           bankConfig["maxScale"], bankConfig["scaleStep"], bankConfig["coarseLevels"])
+    bank = _bankCache.get(key)
+    if bank is None:
+        bank = _bankCache[key] = TemplateBank(template, angles, scales, coarseLevels)
+    return bank
+
+
+def _priorCenter(imageShape, patternShape):
+    """ templateMatch8b's expected top left for a pattern of this shape """
+    return (int((imageShape[1] - patternShape[1]) / 2),
+            int((imageShape[0] - patternShape[0]) / 2) - 200)
+
+
+def _coarseMatch(image, entry, scale, fullShape):
+    pattern = entry["coarse"]
+    if pattern.shape[0] > image.shape[0] or pattern.shape[1] > image.shape[1]:
+        return -1.0, (0, 0)
+    res = cv2.matchTemplate(image, pattern, bankMethod)
+    centerCol, centerRow = _priorCenter(fullShape, entry["template"].shape)
+    # anticorrelation isn't a match, and the prior mustn't favour it far away
+    weighted = np.maximum(res, 0) * centerWeight(np.arange(res.shape[1]) * scale,
+                                  np.arange(res.shape[0]) * scale,
+                                  centerCol, centerRow)
+    _, peakVal, _, peakLoc = cv2.minMaxLoc(weighted)
+    return peakVal, (peakLoc[0] * scale, peakLoc[1] * scale)
+
+
+def _fineMatch(image8b, entry, coarseLoc, margin):
+    pattern = entry["template"]
+    rows, cols = pattern.shape
+    maxCol = image8b.shape[1] - cols
+    maxRow = image8b.shape[0] - rows
+    if maxCol < 0 or maxRow < 0:
+        return -1.0, -1.0, (0, 0)
+    colStart = min(max(coarseLoc[0] - margin, 0), maxCol)
+    rowStart = min(max(coarseLoc[1] - margin, 0), maxRow)
+    colEnd = min(coarseLoc[0] + margin, maxCol)
+    rowEnd = min(coarseLoc[1] + margin, maxRow)
+    window = image8b[rowStart:rowEnd + rows, colStart:colEnd + cols]
+    res = cv2.matchTemplate(window, pattern, bankMethod)
+    centerCol, centerRow = _priorCenter(image8b.shape, pattern.shape)
+    weighted = np.maximum(res, 0) * centerWeight(np.arange(res.shape[1]) + colStart,
+                                  np.arange(res.shape[0]) + rowStart,
+                                  centerCol, centerRow)
+    _, peakVal, _, peakLoc = cv2.minMaxLoc(weighted)
+    return peakVal, float(res[peakLoc[1], peakLoc[0]]), (peakLoc[0] + colStart,
+                                                         peakLoc[1] + rowStart)
+
+
+def _vertex(low, mid, high):
+    """ offset (-0.5..0.5 steps) of a parabola's peak through three scores """
+    curvature = low - 2.0 * mid + high
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (low - high) / curvature, -0.5, 0.5))
+
+
+@timed("match")
+def matchRotated(image, template, bank=None, candidates=None):
+    """ template match tolerant to small rotations and scale changes
+
+    Both passes weigh the correlation by templateMatch8b's center prior.
+
+    Args:
+        image (np array): frame at any bit depth
+
+        template (np array): 8 bit standard image (circle dictionary template)
+
+        bank (TemplateBank): default the cached bank of template
+
+        candidates (int): coarse entries refined, see bankConfig
+
+    Returns:
+        match (dict): offset (col, row) where the unturned template's top
+            left sits, templateMatch8b style; angle (degrees,
+            counterclockwise) and scale of the chip relative to the
+            template; confidence (normalized correlation peak, 0-1);
+            evaluated (bank entries matched at full resolution); method:
+            "rotated", "identity" (no turned / scaled entry beat the
+            baseline) or "templateMatch8b" (confidence too low, fallback)
+    """
+    bank = templateBank(template) if bank is None else bank
+    candidates = bankConfig["candidates"] if candidates is None else candidates
+    with span("match/normalize"):
+        image8b = cv2.normalize(image, None, 0, 255, norm_type=cv2.NORM_MINMAX,
+                                dtype=cv2.CV_8U)
+        coarseImage = image8b
+        for each in range(bank.coarseLevels):
+            coarseImage = cv2.pyrDown(coarseImage)
+    scale = 2**bank.coarseLevels
+    pool = _threadPool()
+    keys = list(bank.entries)
+    with span("match/coarse"):
+        coarse = dict(zip(keys, pool.map(lambda key: _coarseMatch(coarseImage, bank.entries[key],
+                                                                  scale, image8b.shape),
+                                             keys)))
+    ranked = sorted(keys, key=lambda key: coarse[key][0], reverse=True)
+    identity = bank.identity()
+    # the best coarse entries, every bank neighbour of the best one and the baseline
+    refine = set(ranked[:candidates]) | set(bank.neighbours(ranked[0]))
+    if identity is not None:
+        refine.add(identity)
+    margin = 2 * scale + 2
+    fine = {}
+    with span("match/fine"):
+        # the fine best can sit next to the coarse best, its own neighbours
+        # are needed for the parabola: a second round picks them up
+        for each in range(3):
+            missing = sorted(key for key in refine if key not in fine)
+            if not missing:
+                break
+            fine.update(zip(missing, pool.map(lambda key: _fineMatch(image8b, bank.entries[key],
+                                                                     coarse[key][1], margin),
+                                              missing)))
+            best = max(fine, key=lambda key: fine[key][0])
+            method = "rotated"
+            if identity is not None and best != identity and \
+                    fine[best][0] < fine[identity][0] + bankConfig["minGain"]:
+                best = identity
+            if best == identity:
+                method = "identity"
+            refine = set(fine) | set(bank.neighbours(best))
+    _, confidence, topLeft = fine[best]
+    if confidence < bankConfig["minConfidence"]:
+        print("rotated match confidence " + str(round(confidence, 3))
+              + " too low, using templateMatch8b")
+        offset, _ = templateMatch8b(image, template)
+        rows, cols = template.shape
+        return {"offset": tuple(int(each) for each in offset),
+                "center": (offset[0] + (cols - 1) / 2.0, offset[1] + (rows - 1) / 2.0),
+                "angle": 0.0,
+                "scale": 1.0,
+                "confidence": confidence,
+                "evaluated": len(fine),
+                "method": "templateMatch8b"}
+    angleIdx, scaleIdx = best
+    angle = bank.angles[angleIdx]
+    matchScale = bank.scales[scaleIdx]
+    # within half a step either way, also around the baseline
+    if (angleIdx - 1, scaleIdx) in fine and (angleIdx + 1, scaleIdx) in fine:
+        angle = angle + (bank.angles[1] - bank.angles[0]) * _vertex(
+            fine[(angleIdx - 1, scaleIdx)][1], confidence, fine[(angleIdx + 1, scaleIdx)][1])
+    if (angleIdx, scaleIdx - 1) in fine and (angleIdx, scaleIdx + 1) in fine:
+        matchScale = matchScale + (bank.scales[1] - bank.scales[0]) * _vertex(
+            fine[(angleIdx, scaleIdx - 1)][1], confidence, fine[(angleIdx, scaleIdx + 1)][1])
+    warpCenter = bank.entries[best]["warpCenter"]
+    centerCol = topLeft[0] + warpCenter[0]
+    centerRow = topLeft[1] + warpCenter[1]
+    return {"offset": (int(round(centerCol - bank.center[0])),
+                       int(round(centerRow - bank.center[1]))),
+            "center": (centerCol, centerRow),
+            "angle": float(angle),
+            "scale": float(matchScale),
+            "confidence": confidence,
+            "evaluated": len(fine),
+            "method": method}
+
+
+def transformSpots(spotInfo, templateShape, match):
+    """ spot_info moved into the image by a matchRotated match
+
+    Returns:
+        spots (np array): (n, 3) float [x, y, r] in image coordinates
+    """
+    spots = np.asarray(spotInfo, dtype=np.float64).reshape(-1, 3)
+    rows, cols = templateShape[:2]
+    center = np.array([(cols - 1) / 2.0, (rows - 1) / 2.0])
+    linear = cv2.getRotationMatrix2D((0.0, 0.0), match["angle"], match["scale"])[:, :2]
+    moved = (spots[:, :2] - center) @ linear.T + np.asarray(match["center"])
+    return np.column_stack((moved, spots[:, 2] * match["scale"]))
+
+
+def spotShifts(spotInfo, templateShape, match):
+    """ whole pixel (dx, dy) per spot from match["offset"] to its turned and
+        scaled position, for quantifySpots(..., spotShifts=...)
+    """
+    spots = np.asarray(spotInfo, dtype=np.float64).reshape(-1, 3)
+    moved = transformSpots(spots, templateShape, match)
+    return np.rint(moved[:, :2] - spots[:, :2] - np.asarray(match["offset"])).astype(np.int64)